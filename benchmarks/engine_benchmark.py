@@ -0,0 +1,61 @@
+"""
+Compare the thread and async engines against a simulated high-latency fleet.
+
+No real SSH is involved: executor.run_command is replaced with a stub that
+sleeps for a fixed per-command latency, which is what dominates wall time on
+a large fleet.
+
+    python -m benchmarks.engine_benchmark --hosts 2000 --latency 0.2 --concurrency 64 256
+"""
+import argparse
+import time
+from core import executor, task_runner
+from core.async_engine import AsyncEngine
+
+def make_fleet(count):
+    return [
+        {"ip": f"10.0.{i // 256}.{i % 256}", "username": "bench", "password": "bench", "group": "bench"}
+        for i in range(count)
+    ]
+
+def fake_run_command(latency):
+    def run_command(host, user, password, command):
+        time.sleep(latency)
+        return {"host": host, "output": "ok", "error": ""}
+    return run_command
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark mini-ansible execution engines")
+    parser.add_argument("--hosts", type=int, default=1000)
+    parser.add_argument("--latency", type=float, default=0.2, help="Simulated seconds per remote command")
+    parser.add_argument("--tasks", type=int, default=3)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[256],
+                        help="Concurrent hosts for both engines (thread forks / async offload workers); "
+                             "several values are swept")
+    args = parser.parse_args()
+
+    executor.run_command = fake_run_command(args.latency)
+    fleet = make_fleet(args.hosts)
+    task = {"name": "bench", "module": "shell", "args": {"cmd": "true"}}
+
+    print(f"hosts={args.hosts} tasks={args.tasks} latency={args.latency}s")
+    # Both engines get the same concurrency so the comparison is of the engine model, not the pool size
+    for concurrency in args.concurrency:
+        start = time.perf_counter()
+        for _ in range(args.tasks):
+            task_runner.run_on_all_hosts(fleet, task, playbook_state=task_runner.PlaybookState(),
+                                         forks=concurrency)
+        thread_elapsed = time.perf_counter() - start
+
+        engine = AsyncEngine(offload_workers=concurrency)
+        start = time.perf_counter()
+        for _ in range(args.tasks):
+            engine.run_on_all_hosts(fleet, task, playbook_state=task_runner.PlaybookState())
+        async_elapsed = time.perf_counter() - start
+        engine.close()
+
+        print(f"thread engine: {thread_elapsed:.2f}s (forks={concurrency})")
+        print(f"async engine:  {async_elapsed:.2f}s (offload_workers={concurrency})")
+
+if __name__ == "__main__":
+    main()
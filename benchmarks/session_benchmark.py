@@ -0,0 +1,133 @@
+"""
+Compare per-command overhead of a fresh exec channel against a persistent shell session.
+
+Without --host an in-process paramiko SSH server on 127.0.0.1 stands in for a
+target (commands run through the local `sh`). Pass --host/--user/--password to
+measure a real sshd instead.
+
+    python -m benchmarks.session_benchmark --commands 500
+    python -m benchmarks.session_benchmark --host 127.0.0.1 --user me --password secret
+"""
+import argparse
+import socket
+import subprocess
+import threading
+import time
+import paramiko
+from core import executor
+
+class StandInServer(paramiko.ServerInterface):
+    """Accept any password and run exec requests with the local sh"""
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED_OPEN_REQUEST
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=run_exec, args=(channel, command.decode()), daemon=True).start()
+        return True
+
+def run_exec(channel, command):
+    process = subprocess.Popen(["sh", "-c", command], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+
+    def pump_stdin():
+        while data := channel.recv(65536):
+            process.stdin.write(data)
+            process.stdin.flush()
+        process.stdin.close()
+
+    def pump(stream, send):
+        while data := stream.read1(65536):
+            send(data)
+
+    threads = [
+        threading.Thread(target=pump_stdin, daemon=True),
+        threading.Thread(target=pump, args=(process.stdout, channel.sendall), daemon=True),
+        threading.Thread(target=pump, args=(process.stderr, channel.sendall_stderr), daemon=True),
+    ]
+    for thread in threads:
+        thread.start()
+    threads[1].join()
+    threads[2].join()
+    status = process.wait()
+    # Killed by a signal: report it the way a shell would
+    channel.send_exit_status(status if status >= 0 else 128 - status)
+    channel.shutdown_write()
+    channel.close()
+
+def start_stand_in():
+    """Serve SSH on an ephemeral localhost port; returns the port"""
+    host_key = paramiko.RSAKey.generate(2048)
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(16)
+
+    def serve(sock):
+        # Small frames otherwise wait out delayed ACKs on loopback, which would swamp the numbers
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        transport = paramiko.Transport(sock)
+        transport.add_server_key(host_key)
+        transport.start_server(server=StandInServer())
+        # Accepted channels are kept referenced; paramiko closes a channel once it is garbage collected
+        channels = []
+        while transport.is_active():
+            channel = transport.accept(timeout=1)
+            if channel is not None:
+                channels.append(channel)
+                channels = [open_channel for open_channel in channels if not open_channel.closed]
+
+    def accept_loop():
+        while True:
+            sock, _ = listener.accept()
+            threading.Thread(target=serve, args=(sock,), daemon=True).start()
+
+    threading.Thread(target=accept_loop, daemon=True).start()
+    return listener.getsockname()[1]
+
+def measure(host, user, password, commands, command):
+    # Warm the pool (and the session) so only per-command cost is measured
+    executor.run_command(host, user, password, command)
+    start = time.perf_counter()
+    for _ in range(commands):
+        result = executor.run_command(host, user, password, command)
+        if result["error"]:
+            raise SystemExit(f"command failed: {result['error']}")
+    return (time.perf_counter() - start) / commands
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark exec channels against persistent shell sessions")
+    parser.add_argument("--host", help="Real SSH host (default: in-process stand-in on 127.0.0.1)")
+    parser.add_argument("--user", default="bench")
+    parser.add_argument("--password", default="bench")
+    parser.add_argument("--commands", type=int, default=300)
+    parser.add_argument("--command", default="true")
+    args = parser.parse_args()
+
+    host = args.host
+    if host is None:
+        executor.connection_pool.port = start_stand_in()
+        host = "127.0.0.1"
+
+    executor.shell_sessions.enabled = False
+    exec_time = measure(host, args.user, args.password, args.commands, args.command)
+    executor.shell_sessions.enabled = True
+    session_time = measure(host, args.user, args.password, args.commands, args.command)
+
+    print(f"commands        : {args.commands} x {args.command!r} on {host}")
+    print(f"exec channel    : {exec_time * 1000:.3f} ms/command")
+    print(f"shell session   : {session_time * 1000:.3f} ms/command")
+    print(f"speedup         : {exec_time / session_time:.1f}x")
+
+    executor.shell_sessions.close_all()
+    executor.connection_pool.close_all()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+Measure the per-iteration cost of preparing a task for one host and loop item.
+
+"legacy" re-normalizes the task and walks it with VariableProcessor.process_dict
+on every iteration (the pre-compilation behaviour); "compiled" normalizes and
+parses once with compile_task and only resolves placeholders per iteration.
+
+    python -m benchmarks.task_compile_benchmark --hosts 5000 --items 50
+"""
+import argparse
+import time
+from core.task_runner import VariableProcessor, compile_task, normalize_task_syntax
+
+TASK = {
+    "name": "Deploy site config",
+    "template": {
+        "src": "templates/site.conf.j2",
+        "dest": "/etc/nginx/sites-enabled/{{ item }}.conf",
+        "owner": "www-data",
+        "group": "www-data",
+        "mode": "0644",
+    },
+    "become": True,
+    "vars": {"listen_port": 8080},
+    "tags": ["nginx", "config", "sites"],
+    "notify": ["reload nginx"],
+    "when": "{{ deploy_sites }} == True",
+}
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark task compilation")
+    parser.add_argument("--hosts", type=int, default=5000)
+    parser.add_argument("--items", type=int, default=50)
+    args = parser.parse_args()
+
+    play_vars = {"deploy_sites": True, "env": "prod"}
+    hosts = [{"ip": f"10.0.{i // 256}.{i % 256}", "username": "u", "password": "p", "group": "web"}
+             for i in range(args.hosts)]
+    items = [f"site{i}" for i in range(args.items)]
+    iterations = args.hosts * args.items
+
+    def facts(host):
+        return {"mini_ansible_host": host["ip"], "mini_ansible_user": host["username"],
+                "mini_ansible_host_group": host["group"], "mini_ansible_password": host["password"]}
+
+    start = time.perf_counter()
+    for host in hosts:
+        for item in items:
+            processor = VariableProcessor(dict(play_vars), facts(host), {"item": item})
+            processor.process_dict(normalize_task_syntax(TASK))
+    legacy = time.perf_counter() - start
+
+    start = time.perf_counter()
+    compiled = compile_task(TASK)
+    for host in hosts:
+        for item in items:
+            compiled.render(VariableProcessor(play_vars, facts(host), {"item": item}))
+    fast = time.perf_counter() - start
+
+    print(f"{args.hosts} hosts x {args.items} items = {iterations} iterations")
+    print(f"legacy:   {legacy:.2f}s ({legacy / iterations * 1e6:.2f} us/iteration)")
+    print(f"compiled: {fast:.2f}s ({fast / iterations * 1e6:.2f} us/iteration)")
+
+if __name__ == "__main__":
+    main()
@@ -7,13 +7,22 @@ def main():
     parser.add_argument("command", choices=["run"], help="What to do")
     parser.add_argument("playbook", help="Path to YAML playbook file")
     parser.add_argument("--inventory", default="./examples/inventory.ini", help="Path to inventory file")
+    parser.add_argument("--engine", choices=["thread", "async"], default="thread", help="Execution engine used to run tasks across hosts")
+    parser.add_argument("--forks", type=int, default=None, help="Maximum number of hosts to run a task on in parallel (default: 10)")
+    parser.add_argument("--shell-sessions", action="store_true", help="Run commands on one persistent remote shell per host")
+    parser.add_argument("--pipelining", action="store_true", help="Send runs of consecutive shell/file/service/systemd tasks to each host as one script")
+    parser.add_argument("--max-output", type=int, default=None, help="Bytes of each command output stream kept in memory per result; the rest is spilled to disk (default: 1048576)")
+    parser.add_argument("--spill-dir", default=None, help="Directory for spilled command output, one subdirectory per host")
+    parser.add_argument("--live-output", action="store_true", help="Print command output lines as they arrive")
 
     args = parser.parse_args()
 
     if args.command == "run":
         hosts = get_inventory(args.inventory)
         playbook = load_playbook(args.playbook)
-        run_playbook(hosts, playbook)
+        run_playbook(hosts, playbook, engine=args.engine, forks=args.forks, shell_sessions=args.shell_sessions,
+                     pipelining=args.pipelining, max_output=args.max_output, spill_dir=args.spill_dir,
+                     live_output=args.live_output)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
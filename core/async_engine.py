@@ -0,0 +1,127 @@
+import asyncio
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from . import task_runner
+
+class AsyncEngine:
+    """
+    Drive host sessions from a single asyncio event loop.
+
+    Every host gets its own coroutine, so thousands of hosts can be in flight at
+    once. The blocking parts (paramiko I/O inside module run() calls) are pushed
+    to a bounded offload pool, which is what actually limits concurrent SSH work.
+    """
+    def __init__(self, max_concurrency=1000, offload_workers=64):
+        self.max_concurrency = max_concurrency
+        self.offload_workers = offload_workers
+        self.runner = asyncio.Runner()
+        self.offload_pool = ThreadPoolExecutor(
+            max_workers=offload_workers,
+            thread_name_prefix="mini-ansible-offload"
+        )
+
+    async def _run_host(self, semaphore, dispatched_at, task_timings, task, host, play_vars, global_become,
+                        playbook_state, streaming_output):
+        async with semaphore:
+            loop = asyncio.get_running_loop()
+            try:
+                result = await loop.run_in_executor(
+                    self.offload_pool,
+                    task_runner.timed_run_task,
+                    dispatched_at,
+                    task_timings,
+                    task,
+                    host,
+                    play_vars,
+                    global_become,
+                    playbook_state,
+                    streaming_output,
+                    True
+                )
+            except Exception as e:
+                return task_runner.handle_task_exception(host, task, e, playbook_state, streaming_output)
+
+        # A deferred module result is awaited without holding a fork or an offload thread
+        if isinstance(result, Future):
+            try:
+                return await asyncio.wrap_future(result)
+            except Exception as e:
+                return task_runner.handle_task_exception(host, task, e, playbook_state, streaming_output)
+        return result
+
+    async def _run_all(self, active_hosts, task, play_vars, global_become, playbook_state, streaming_output,
+                       forks, task_timings):
+        semaphore = asyncio.Semaphore(forks or self.max_concurrency)
+        dispatched_at = time.monotonic()
+        coros = [
+            self._run_host(semaphore, dispatched_at, task_timings, task, host, play_vars, global_become,
+                           playbook_state, streaming_output)
+            for host in active_hosts
+        ]
+        # Collect in completion order, matching the threaded engine
+        return [await coro for coro in asyncio.as_completed(coros)]
+
+    def run_on_all_hosts(self, hosts, task, play_vars=None, global_become=False, playbook_state=None, streaming_output=None,
+                         worker_pool=None, forks=None, task_timings=None):
+        """Async counterpart of task_runner.run_on_all_hosts (worker_pool is unused; the engine owns its offload pool)"""
+        active_hosts = task_runner.select_task_hosts(hosts, task, playbook_state)
+        if not active_hosts:
+            return []
+
+        return self.runner.run(
+            self._run_all(active_hosts, task, play_vars, global_become, playbook_state, streaming_output,
+                          forks, task_timings)
+        )
+
+    async def _run_host_tasks(self, semaphore, dispatched_at, task_timings, host, tasks, play_vars, global_become,
+                              playbook_state, streaming_output, pipelining):
+        loop = asyncio.get_running_loop()
+        walk = task_runner.walk_host_tasks(host, tasks, play_vars, global_become, playbook_state, streaming_output,
+                                           dispatched_at, task_timings, pipelining)
+        deferred = None
+        while True:
+            async with semaphore:
+                try:
+                    results, deferred = await loop.run_in_executor(
+                        self.offload_pool,
+                        task_runner.advance_host_walk,
+                        walk,
+                        deferred
+                    )
+                except Exception as e:
+                    return [task_runner.handle_task_exception(host, {}, e, playbook_state, streaming_output)]
+            if deferred is None:
+                return results
+            # A deferred module is awaited without holding a fork or an offload thread; the walk reads its outcome
+            await asyncio.wait([asyncio.wrap_future(deferred)])
+
+    async def _run_free(self, active_hosts, tasks, play_vars, global_become, playbook_state, streaming_output,
+                        forks, task_timings, pipelining):
+        semaphore = asyncio.Semaphore(forks or self.max_concurrency)
+        dispatched_at = time.monotonic()
+        coros = [
+            self._run_host_tasks(semaphore, dispatched_at, task_timings, host, tasks, play_vars, global_become,
+                                 playbook_state, streaming_output, pipelining)
+            for host in active_hosts
+        ]
+        results = []
+        for coro in asyncio.as_completed(coros):
+            results.extend(await coro)
+        return results
+
+    def run_play_free(self, hosts, tasks, play_vars=None, global_become=False, playbook_state=None, streaming_output=None,
+                      worker_pool=None, forks=None, task_timings=None, pipelining=False):
+        """Async counterpart of task_runner.run_play_free"""
+        active_hosts = playbook_state.get_active_hosts(hosts) if playbook_state else hosts
+        if not active_hosts:
+            print("No active hosts available for this play")
+            return []
+
+        return self.runner.run(
+            self._run_free(active_hosts, tasks, play_vars, global_become, playbook_state, streaming_output,
+                           forks, task_timings, pipelining)
+        )
+
+    def close(self):
+        self.runner.close()
+        self.offload_pool.shutdown(wait=True)
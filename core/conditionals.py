@@ -0,0 +1,364 @@
+import re
+from functools import lru_cache
+
+class ConditionError(ValueError):
+    """Raised when a when: expression cannot be parsed"""
+
+TOKEN_PATTERN = re.compile(r'''
+    \s*(?:
+        (?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')
+      | (?P<number>-?\d+(?:\.\d+)?(?![\w.]))
+      | (?P<op>==|!=|<=|>=|<|>|\{\{|\}\}|[()\[\].,])
+      | (?P<name>[A-Za-z_][\w-]*)
+    )''', re.VERBOSE)
+
+KEYWORDS = {"and", "or", "not", "in", "is"}
+LITERALS = {
+    "true": True, "True": True, "false": False, "False": False,
+    "none": None, "None": None, "null": None
+}
+FALSY_STRINGS = {"", "false", "no", "off", "0", "none", "null"}
+
+# Sentinel returned when a variable path cannot be resolved
+UNDEFINED = object()
+
+def tokenize(source):
+    tokens = []
+    position = 0
+    source = source.rstrip()
+    while position < len(source):
+        match = TOKEN_PATTERN.match(source, position)
+        if not match:
+            raise ConditionError(f"Unexpected character in condition at {position}: {source!r}")
+        position = match.end()
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == "string":
+            # Only quotes and backslashes are escaped; anything else (non-ASCII too) is kept as written
+            value = re.sub(r"""\\([\\'"])""", r"\1", value[1:-1])
+        elif kind == "number":
+            value = float(value) if "." in value else int(value)
+        elif kind == "name" and value in KEYWORDS:
+            kind = "op"
+        tokens.append((kind, value))
+    return tokens
+
+def is_truthy(value):
+    if isinstance(value, str):
+        return value.strip().lower() not in FALSY_STRINGS
+    if value is UNDEFINED:
+        return False
+    return bool(value)
+
+def _as_number(value):
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return value
+    if isinstance(value, str):
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return None
+
+def values_equal(left, right):
+    if left == right:
+        return True
+    if isinstance(left, bool) or isinstance(right, bool):
+        return str(left).lower() == str(right).lower()
+    left_number, right_number = _as_number(left), _as_number(right)
+    if left_number is not None and right_number is not None:
+        return left_number == right_number
+    return str(left) == str(right)
+
+def values_order(left, right):
+    """Return -1/0/1 comparing numerically when possible, otherwise as strings"""
+    left_number, right_number = _as_number(left), _as_number(right)
+    if left_number is not None and right_number is not None:
+        left, right = left_number, right_number
+    else:
+        left, right = str(left), str(right)
+    return (left > right) - (left < right)
+
+def contains(container, value):
+    if isinstance(container, str):
+        return str(value) in container
+    if isinstance(container, dict):
+        return value in container or str(value) in (str(k) for k in container)
+    if isinstance(container, (list, tuple, set)):
+        return any(values_equal(value, item) for item in container)
+    return False
+
+COMPARATORS = {
+    "==": values_equal,
+    "!=": lambda a, b: not values_equal(a, b),
+    "<": lambda a, b: values_order(a, b) < 0,
+    "<=": lambda a, b: values_order(a, b) <= 0,
+    ">": lambda a, b: values_order(a, b) > 0,
+    ">=": lambda a, b: values_order(a, b) >= 0,
+    "in": lambda a, b: contains(b, a),
+    "not in": lambda a, b: not contains(b, a),
+}
+
+TESTS = {
+    "defined": lambda v: v is not UNDEFINED,
+    "undefined": lambda v: v is UNDEFINED,
+    "none": lambda v: v is None,
+    "true": lambda v: v is True,
+    "false": lambda v: v is False,
+}
+
+class Literal:
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def evaluate(self, lookup):
+        return self.value
+
+class ListLiteral:
+    __slots__ = ("items",)
+
+    def __init__(self, items):
+        self.items = items
+
+    def evaluate(self, lookup):
+        return [item.evaluate(lookup) for item in self.items]
+
+class Variable:
+    """A variable reference with optional .attr / [key] access"""
+    __slots__ = ("name", "path")
+
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+
+    def resolve(self, lookup):
+        found, value = lookup(self.name)
+        if not found:
+            return UNDEFINED
+        for key in self.path:
+            if isinstance(value, dict) and key in value:
+                value = value[key]
+            elif isinstance(value, (list, tuple)) and isinstance(key, int) and -len(value) <= key < len(value):
+                value = value[key]
+            elif isinstance(key, str) and hasattr(value, key) and not key.startswith("_"):
+                value = getattr(value, key)
+            else:
+                return UNDEFINED
+        return value
+
+    def evaluate(self, lookup):
+        value = self.resolve(lookup)
+        # A bare unknown name is treated as a string, so "env == production" keeps working
+        if value is UNDEFINED and not self.path:
+            return self.name
+        return value
+
+class Not:
+    __slots__ = ("operand",)
+
+    def __init__(self, operand):
+        self.operand = operand
+
+    def evaluate(self, lookup):
+        return not is_truthy(self.operand.evaluate(lookup))
+
+class BoolOp:
+    __slots__ = ("op", "operands")
+
+    def __init__(self, op, operands):
+        self.op = op
+        self.operands = operands
+
+    def evaluate(self, lookup):
+        if self.op == "and":
+            return all(is_truthy(operand.evaluate(lookup)) for operand in self.operands)
+        return any(is_truthy(operand.evaluate(lookup)) for operand in self.operands)
+
+class Compare:
+    __slots__ = ("op", "left", "right")
+
+    def __init__(self, op, left, right):
+        self.op = op
+        self.left = left
+        self.right = right
+
+    def evaluate(self, lookup):
+        return COMPARATORS[self.op](self.left.evaluate(lookup), self.right.evaluate(lookup))
+
+class Test:
+    """`x is [not] defined` style tests"""
+    __slots__ = ("operand", "test", "negate")
+
+    def __init__(self, operand, test, negate):
+        self.operand = operand
+        self.test = test
+        self.negate = negate
+
+    def evaluate(self, lookup):
+        if isinstance(self.operand, Variable):
+            value = self.operand.resolve(lookup)
+        else:
+            value = self.operand.evaluate(lookup)
+        return TESTS[self.test](value) != self.negate
+
+class Parser:
+    """Recursive descent parser producing the node classes above"""
+    def __init__(self, source):
+        self.source = source
+        self.tokens = tokenize(source)
+        self.position = 0
+
+    def peek(self, offset=0):
+        index = self.position + offset
+        return self.tokens[index] if index < len(self.tokens) else (None, None)
+
+    def accept(self, value):
+        kind, token = self.peek()
+        if kind == "op" and token == value:
+            self.position += 1
+            return True
+        return False
+
+    def expect(self, value):
+        if not self.accept(value):
+            raise ConditionError(f"Expected '{value}' in condition: {self.source!r}")
+
+    def parse(self):
+        node = self.parse_or()
+        if self.position != len(self.tokens):
+            raise ConditionError(f"Unexpected token {self.peek()[1]!r} in condition: {self.source!r}")
+        return node
+
+    def parse_or(self):
+        operands = [self.parse_and()]
+        while self.accept("or"):
+            operands.append(self.parse_and())
+        return operands[0] if len(operands) == 1 else BoolOp("or", operands)
+
+    def parse_and(self):
+        operands = [self.parse_not()]
+        while self.accept("and"):
+            operands.append(self.parse_not())
+        return operands[0] if len(operands) == 1 else BoolOp("and", operands)
+
+    def parse_not(self):
+        if self.accept("not"):
+            return Not(self.parse_not())
+        return self.parse_comparison()
+
+    def parse_comparison(self):
+        left = self.parse_primary()
+        kind, token = self.peek()
+        if kind != "op":
+            return left
+        if token in ("==", "!=", "<", "<=", ">", ">=", "in"):
+            self.position += 1
+            return Compare(token, left, self.parse_primary())
+        if token == "not" and self.peek(1) == ("op", "in"):
+            self.position += 2
+            return Compare("not in", left, self.parse_primary())
+        if token == "is":
+            self.position += 1
+            negate = self.accept("not")
+            kind, test = self.peek()
+            if kind != "name" or test.lower() not in TESTS:
+                raise ConditionError(f"Unknown test {test!r} in condition: {self.source!r}")
+            self.position += 1
+            return Test(left, test.lower(), negate)
+        return left
+
+    def parse_primary(self):
+        kind, token = self.peek()
+        if kind is None:
+            raise ConditionError(f"Unexpected end of condition: {self.source!r}")
+        self.position += 1
+
+        if kind in ("string", "number"):
+            return Literal(token)
+        if kind == "op" and token == "(":
+            node = self.parse_or()
+            self.expect(")")
+            return node
+        if kind == "op" and token == "{{":
+            # Legacy "{{ var }} == value" syntax: the braces just group an expression
+            node = self.parse_or()
+            self.expect("}}")
+            return node
+        if kind == "op" and token == "[":
+            items = []
+            if not self.accept("]"):
+                items.append(self.parse_or())
+                while self.accept(","):
+                    items.append(self.parse_or())
+                self.expect("]")
+            return ListLiteral(items)
+        if kind == "name":
+            if token in LITERALS:
+                return Literal(LITERALS[token])
+            path = []
+            while True:
+                if self.accept("."):
+                    kind, attr = self.peek()
+                    if kind not in ("name", "number"):
+                        raise ConditionError(f"Expected attribute after '.' in condition: {self.source!r}")
+                    self.position += 1
+                    path.append(attr)
+                elif self.accept("["):
+                    kind, key = self.peek()
+                    if kind not in ("string", "number"):
+                        raise ConditionError(f"Only literal subscripts are supported in condition: {self.source!r}")
+                    self.position += 1
+                    self.expect("]")
+                    path.append(key)
+                else:
+                    break
+            return Variable(token, tuple(path))
+
+        raise ConditionError(f"Unexpected token {token!r} in condition: {self.source!r}")
+
+# Split of an unparsable condition at its first comparison, for _compile_legacy_comparison
+LEGACY_COMPARISON = re.compile(r"(?P<left>.+?)\s*(?P<op>==|!=|\bnot\s+in\b|\bin\b)\s*(?P<right>.+)", re.DOTALL)
+
+def _compile_legacy_comparison(source):
+    """
+    Unquoted right-hand sides like `ip == 10.0.0.1` or `os == Ubuntu 22.04` don't
+    tokenize. The old evaluator compared them as plain strings, so do the same
+    when the left-hand side is a valid expression. Returns None otherwise.
+    """
+    match = LEGACY_COMPARISON.fullmatch(source.strip())
+    if not match:
+        return None
+    try:
+        left = Parser(match.group("left")).parse()
+    except ConditionError:
+        return None
+    op = "not in" if match.group("op").startswith("not") else match.group("op")
+    return Compare(op, left, Literal(match.group("right").strip().strip("\"'")))
+
+@lru_cache(maxsize=4096)
+def compile_condition(source):
+    """Parse a when: expression once; repeated sources come from the cache"""
+    try:
+        return Parser(source).parse()
+    except ConditionError:
+        node = _compile_legacy_comparison(source)
+        if node is None:
+            raise
+        return node
+
+def evaluate_condition(condition, lookup):
+    """
+    Evaluate a when: condition with a (found, value) lookup function.
+    Lists are treated as an implicit `and`, like Ansible.
+    """
+    if condition is None or condition == "":
+        return True
+    if isinstance(condition, list):
+        return all(evaluate_condition(item, lookup) for item in condition)
+    if isinstance(condition, bool):
+        return condition
+    return is_truthy(compile_condition(str(condition)).evaluate(lookup))
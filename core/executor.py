@@ -1,34 +1,794 @@
 import paramiko
 from paramiko.ssh_exception import SSHException, AuthenticationException, NoValidConnectionsError
+import re
+import select
+import shlex
 import socket
+import os
+import tempfile
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
 
-def run_command(host, user, password, command):
-    result = {
-        "host": host,
-        "output": "",
-        "error": ""
-    }
+# Default SSH channel window for SFTP; larger windows keep more writes in flight on long links
+DEFAULT_SFTP_WINDOW = 16 * 1024 * 1024
+# Bytes per SFTP write when streaming a file
+SFTP_CHUNK_SIZE = 1024 * 1024
+# Output kept in memory per stream of a command result; beyond it only a head/tail preview is kept
+DEFAULT_MAX_OUTPUT = 1024 * 1024
+
+class ConnectionPool:
+    """Thread-safe pool of authenticated SSH clients keyed by (host, user)"""
+    def __init__(self, max_per_host=4, idle_timeout=300, health_check_interval=30, connect_timeout=10, port=22):
+        self.max_per_host = max_per_host
+        self.port = port
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self.connect_timeout = connect_timeout
+        self.lock = threading.Lock()
+        self.available = threading.Condition(self.lock)
+        self.idle = defaultdict(list)  # (host, user) -> [(client, last_used)]
+        self.open_count = defaultdict(int)  # idle + checked out, per key
+        self.pinned = set()  # clients carrying long-lived channels (SFTP) that idle eviction must skip
+        self.stats = {"hits": 0, "misses": 0, "reconnects": 0, "evictions": 0}
+        self.last_sweep = 0.0
+
+    def _connect(self, host, user, password):
+        ssh = paramiko.SSHClient()
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        try:
+            ssh.connect(hostname=host, port=self.port, username=user, password=password,
+                        timeout=self.connect_timeout)
+        except Exception:
+            ssh.close()
+            raise
+        return ssh
+
+    def _is_healthy(self, client, last_used):
+        transport = client.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        # Only probe the wire when the connection has been sitting idle for a while
+        if time.time() - last_used > self.health_check_interval:
+            try:
+                transport.send_ignore()
+            except Exception:
+                return False
+        return True
+
+    def _evict_idle(self, now, key):
+        """
+        Close idle connections older than idle_timeout (lock must be held). Only
+        the acquiring key is checked each time; the whole pool is swept at most
+        once per health_check_interval, so a command doesn't cost O(hosts).
+        """
+        if now - self.last_sweep >= self.health_check_interval:
+            self.last_sweep = now
+            keys = list(self.idle.keys())
+        else:
+            keys = [key] if key in self.idle else []
+        for swept in keys:
+            keep = []
+            for client, last_used in self.idle[swept]:
+                if now - last_used > self.idle_timeout and client not in self.pinned:
+                    client.close()
+                    self.open_count[swept] -= 1
+                    self.stats["evictions"] += 1
+                else:
+                    keep.append((client, last_used))
+            self.idle[swept] = keep
+        self.available.notify_all()
+
+    def acquire(self, host, user, password):
+        """Check out a connected client, reusing an idle one when possible"""
+        key = (host, user)
+        with self.available:
+            self._evict_idle(time.time(), key)
+            while True:
+                while self.idle[key]:
+                    client, last_used = self.idle[key].pop()
+                    if self._is_healthy(client, last_used):
+                        self.stats["hits"] += 1
+                        return client
+                    client.close()
+                    self.open_count[key] -= 1
+                    self.stats["reconnects"] += 1
+                if self.open_count[key] < self.max_per_host:
+                    self.open_count[key] += 1
+                    self.stats["misses"] += 1
+                    break
+                self.available.wait()
+
+        # Connect outside the lock so other hosts are not serialized behind the handshake
+        try:
+            return self._connect(host, user, password)
+        except Exception:
+            with self.available:
+                self.open_count[key] -= 1
+                self.available.notify()
+            raise
+
+    def release(self, host, user, client, discard=False):
+        """Return a client to the pool, or close it if it is no longer usable"""
+        key = (host, user)
+        with self.available:
+            transport = client.get_transport()
+            if discard or transport is None or not transport.is_active():
+                client.close()
+                self.open_count[key] -= 1
+            else:
+                self.idle[key].append((client, time.time()))
+            self.available.notify()
+
+    def close_host(self, host, user=None):
+        """Close idle connections for a host (optionally only for one user)"""
+        with self.available:
+            for key in list(self.idle.keys()):
+                if key[0] == host and (user is None or key[1] == user):
+                    for client, _ in self.idle.pop(key):
+                        client.close()
+                        self.open_count[key] -= 1
+            self.available.notify_all()
+
+    def close_all(self):
+        with self.available:
+            for key, entries in self.idle.items():
+                for client, _ in entries:
+                    client.close()
+                    self.open_count[key] -= 1
+            self.idle.clear()
+            self.available.notify_all()
+
+    def pin(self, client):
+        with self.lock:
+            self.pinned.add(client)
+
+    def unpin(self, client):
+        with self.lock:
+            self.pinned.discard(client)
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats)
+
+connection_pool = ConnectionPool()
+
+class SFTPSessionCache:
+    """
+    SFTP sessions opened as extra channels on pooled SSH transports and kept
+    for the whole play, so file transfers skip the handshake and subsystem setup.
+    """
+    def __init__(self, pool):
+        self.pool = pool
+        self.lock = threading.Lock()
+        self.sessions = {}  # (host, user, window_size) -> (client, sftp)
+        self.session_locks = defaultdict(threading.Lock)
+        self.stats = {"opened": 0, "reused": 0}
+
+    def _is_open(self, client, sftp):
+        transport = client.get_transport()
+        return transport is not None and transport.is_active() and not sftp.get_channel().closed
+
+    def _open(self, host, user, password, window_size):
+        client = self.pool.acquire(host, user, password)
+        try:
+            sftp = paramiko.SFTPClient.from_transport(client.get_transport(), window_size=window_size)
+        except Exception:
+            self.pool.release(host, user, client, discard=True)
+            raise
+        # The transport stays in the pool for commands; the SFTP channel rides along on it
+        self.pool.pin(client)
+        self.pool.release(host, user, client)
+        return client, sftp
+
+    def _close(self, client, sftp):
+        sftp.close()
+        self.pool.unpin(client)
+
+    @contextmanager
+    def session(self, host, user, password, window_size=DEFAULT_SFTP_WINDOW):
+        key = (host, user, window_size)
+        with self.lock:
+            session_lock = self.session_locks[key]
+        # One SFTP request stream per session: transfers to the same host take turns
+        with session_lock:
+            with self.lock:
+                cached = self.sessions.get(key)
+            if cached and self._is_open(*cached):
+                with self.lock:
+                    self.stats["reused"] += 1
+            else:
+                if cached:
+                    self._close(*cached)
+                cached = self._open(host, user, password, window_size)
+                with self.lock:
+                    self.sessions[key] = cached
+                    self.stats["opened"] += 1
+            try:
+                yield cached[1]
+            except Exception:
+                # Remote file errors leave the session usable; a dead channel does not
+                if not self._is_open(*cached):
+                    with self.lock:
+                        self.sessions.pop(key, None)
+                    self._close(*cached)
+                raise
+
+    def close_host(self, host, user=None):
+        with self.lock:
+            closing = [self.sessions.pop(key) for key in list(self.sessions)
+                       if key[0] == host and (user is None or key[1] == user)]
+        for session in closing:
+            self._close(*session)
+
+    def close_all(self):
+        with self.lock:
+            closing = list(self.sessions.values())
+            self.sessions.clear()
+        for session in closing:
+            self._close(*session)
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats)
+
+sftp_sessions = SFTPSessionCache(connection_pool)
+
+class OutputLimits:
+    """How much command output a result keeps in memory, and where the rest is spilled"""
+    def __init__(self, max_bytes=DEFAULT_MAX_OUTPUT, spill_dir=None):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir or os.path.join(tempfile.gettempdir(), "mini-ansible-output")
+        self.lock = threading.Lock()
+        self.spilled = 0
+
+    def spill_path(self, host, stream):
+        """A new file for one spilled stream, grouped per host"""
+        directory = os.path.join(self.spill_dir, re.sub(r"[^\w.-]", "_", host))
+        os.makedirs(directory, exist_ok=True)
+        with self.lock:
+            self.spilled += 1
+        return os.path.join(directory, f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}.{stream}")
+
+output_limits = OutputLimits()
+
+# Per-thread callback(stream, line) fed every line of bounded command output as it arrives
+_line_listener = threading.local()
+
+@contextmanager
+def streaming_lines(callback):
+    """Within the block, bounded commands run by this thread report their output lines to callback"""
+    previous = getattr(_line_listener, "callback", None)
+    _line_listener.callback = callback
+    try:
+        yield
+    finally:
+        _line_listener.callback = previous
+
+class OutputCapture:
+    """
+    Incremental capture of one output stream. Up to max_bytes stays in memory;
+    past that the whole stream goes to a spill file and memory keeps only its
+    first and last max_bytes / 2 bytes. max_bytes=None keeps everything.
+    """
+    def __init__(self, host, stream, max_bytes=None, on_line=None):
+        self.host = host
+        self.stream = stream
+        self.max_bytes = max_bytes
+        self.on_line = on_line
+        self.total = 0
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.partial = bytearray()  # unterminated last line, held back from on_line
+        self.spill = None
+        self.path = None
+
+    def feed(self, data):
+        if not data:
+            return
+        self.total += len(data)
+        if self.on_line:
+            self.partial += data
+            *lines, rest = self.partial.split(b"\n")
+            self.partial = bytearray(rest)
+            for line in lines:
+                self.on_line(self.stream, line.decode(errors="replace"))
+
+        if self.spill is None and (self.max_bytes is None or self.total <= self.max_bytes):
+            self.head += data
+            return
+        half = self.max_bytes // 2
+        if self.spill is None:
+            self.path = output_limits.spill_path(self.host, self.stream)
+            self.spill = open(self.path, "wb")
+            self.spill.write(self.head)
+            self.head += data
+            self.tail = self.head[half:]
+            del self.head[half:]
+        else:
+            self.tail += data
+        self.spill.write(data)
+        if len(self.tail) > half:
+            del self.tail[:len(self.tail) - half]
+
+    def close(self):
+        """Close the spill file; safe to call more than once, and on error paths before finish()"""
+        if self.spill is not None and not self.spill.closed:
+            self.spill.close()
+
+    def finish(self):
+        """Text of the stream, or a head/tail preview pointing at the spill file"""
+        if self.on_line and self.partial:
+            self.on_line(self.stream, self.partial.decode(errors="replace"))
+            self.partial = bytearray()
+        if self.spill is None:
+            return self.head.decode(errors="replace").strip()
+        self.close()
+        omitted = self.total - len(self.head) - len(self.tail)
+        return (f"{self.head.decode(errors='replace')}\n"
+                f"... [{omitted} bytes omitted, full {self.stream} in {self.path}] ...\n"
+                f"{self.tail.decode(errors='replace')}").strip()
+
+class FramedCapture:
+    """
+    Capture of a framed multi-step script's stream (see task_runner.pipeline_script).
+    Frame lines "<token> <step>[ <status>]" are cut out as data arrives and each
+    step's output goes to its own bounded OutputCapture, so no step is held in
+    memory past the output limit. finish() returns what followed the last frame.
+    """
+    # Longest frame line, kept back unscanned so a frame split across reads is still found
+    FRAME_SIZE = 64
+
+    def __init__(self, host, stream, token):
+        self.host = host
+        self.stream = stream
+        self.pattern = re.compile(rb"\n" + re.escape(token.encode()) + rb" (\d+)(?: (\d+))?\n")
+        self.on_line = getattr(_line_listener, "callback", None)
+        self.steps = {}  # step -> (OutputCapture, status or None)
+        self.current = self._new_capture()
+        self.pending = bytearray()
+        self.total = 0
+
+    def _new_capture(self):
+        return OutputCapture(self.host, self.stream, output_limits.max_bytes, self.on_line)
+
+    @property
+    def path(self):
+        return self.current.path
+
+    def feed(self, data):
+        self.total += len(data)
+        self.pending += data
+        while match := self.pattern.search(self.pending):
+            self.current.feed(bytes(self.pending[:match.start()]))
+            status = int(match.group(2)) if match.group(2) is not None else None
+            self.steps[int(match.group(1))] = (self.current, status)
+            self.current = self._new_capture()
+            del self.pending[:match.end()]
+        if len(self.pending) > self.FRAME_SIZE:
+            self.current.feed(bytes(self.pending[:-self.FRAME_SIZE]))
+            del self.pending[:-self.FRAME_SIZE]
+
+    def close(self):
+        for capture, _ in self.steps.values():
+            capture.close()
+        self.current.close()
+
+    def finish(self):
+        """Output after the last frame (what a script that died mid-step printed)"""
+        self.current.feed(bytes(self.pending))
+        self.pending.clear()
+        return self.current.finish()
+
+def make_captures(host, bounded=True):
+    """stdout and stderr captures for one command; unbounded ones are for output a module parses"""
+    if not bounded:
+        return OutputCapture(host, "stdout"), OutputCapture(host, "stderr")
+    on_line = getattr(_line_listener, "callback", None)
+    return (OutputCapture(host, "stdout", output_limits.max_bytes, on_line),
+            OutputCapture(host, "stderr", output_limits.max_bytes, on_line))
+
+class CommandInterrupted(SSHException):
+    """The shell session broke after a command was sent, so it may have run (don't retry it)"""
+
+class ShellSession:
+    """
+    A long-lived remote shell on one channel. Each command is sent wrapped in
+    sentinels carrying its exit status, so running it costs a write and a read
+    instead of a new channel and login shell.
+
+    The session runs the user's $SHELL when it is a POSIX-family shell (bash,
+    zsh, ksh, dash, ash) and plain `sh` otherwise, so on hosts whose login shell
+    is e.g. fish or csh, commands must stick to POSIX sh syntax. Startup files
+    are not read, as with any non-interactive shell.
+    """
+    READ_SIZE = 65536
+    # exec'd by the login shell, whatever it is; the single-quoted script is sh
+    START = ("exec sh -c 'case \"${SHELL##*/}\" in bash|zsh|ksh|mksh|dash|ash) exec \"$SHELL\";; esac; "
+             "exec sh'")
+
+    def __init__(self, client):
+        self.client = client
+        self.channel = client.get_transport().open_session()
+        self.channel.exec_command(self.START)
+        self.lock = threading.Lock()
+
+    def is_open(self):
+        transport = self.client.get_transport()
+        return (transport is not None and transport.is_active()
+                and not self.channel.closed and not self.channel.exit_status_ready())
 
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    # Longest frame line, kept back unscanned so a sentinel split across reads is still found
+    FRAME_SIZE = 64
 
+    def run(self, command, stdout_capture, stderr_capture):
+        """Run one command, feeding its output to the captures; returns the exit status"""
+        token = uuid.uuid4().hex
+        # A subshell keeps cd/exit/set from leaking into the session; eval contains syntax errors
+        framed = (f"( eval {shlex.quote(command)} ) </dev/null; __rc=$?; "
+                  f"printf '\\n{token} %d\\n' $__rc; printf '\\n{token}\\n' >&2\n")
+        self.channel.sendall(framed.encode())
+        stdout, stderr = bytearray(), bytearray()
+        try:
+            return self._read_frame(token, stdout, stderr, stdout_capture, stderr_capture)
+        except (SSHException, socket.error) as e:
+            # Keep what the command printed before the session broke
+            stdout_capture.feed(bytes(stdout))
+            stderr_capture.feed(bytes(stderr))
+            raise CommandInterrupted(str(e)) from e
+
+    def _read_frame(self, token, stdout, stderr, stdout_capture, stderr_capture):
+        status_pattern = re.compile(rb"\n" + token.encode() + rb" (\d+)\n")
+        stderr_marker = b"\n" + token.encode() + b"\n"
+        status = None
+        stderr_done = False
+        while status is None or not stderr_done:
+            # The channel's fileno is readable when either stream has data
+            select.select([self.channel], [], [], 1.0)
+            while self.channel.recv_ready():
+                stdout += self.channel.recv(self.READ_SIZE)
+            while self.channel.recv_stderr_ready():
+                stderr += self.channel.recv_stderr(self.READ_SIZE)
+            if status is None:
+                match = status_pattern.search(stdout)
+                if match:
+                    status = int(match.group(1))
+                    stdout_capture.feed(bytes(stdout[:match.start()]))
+                    stdout.clear()
+                elif len(stdout) > self.FRAME_SIZE:
+                    stdout_capture.feed(bytes(stdout[:-self.FRAME_SIZE]))
+                    del stdout[:-self.FRAME_SIZE]
+            if not stderr_done:
+                index = stderr.find(stderr_marker)
+                if index >= 0:
+                    stderr_done = True
+                    stderr_capture.feed(bytes(stderr[:index]))
+                    stderr.clear()
+                elif len(stderr) > self.FRAME_SIZE:
+                    stderr_capture.feed(bytes(stderr[:-self.FRAME_SIZE]))
+                    del stderr[:-self.FRAME_SIZE]
+            if self.channel.exit_status_ready() and not self.channel.recv_ready() \
+                    and not self.channel.recv_stderr_ready() and (status is None or not stderr_done):
+                raise SSHException("remote shell session ended")
+        return status
+
+    def close(self):
+        self.channel.close()
+
+class ShellSessionManager:
+    """One ShellSession per (host, user), opened on a pooled transport and kept for the play"""
+    def __init__(self, pool):
+        self.pool = pool
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.sessions = {}  # (host, user) -> ShellSession
+        self.stats = {"opened": 0, "commands": 0, "fallbacks": 0}
+
+    def _open(self, host, user, password):
+        client = self.pool.acquire(host, user, password)
+        try:
+            session = ShellSession(client)
+        except Exception:
+            self.pool.release(host, user, client, discard=True)
+            raise
+        self.pool.pin(client)
+        self.pool.release(host, user, client)
+        return session
+
+    def _close(self, session):
+        session.close()
+        self.pool.unpin(session.client)
+
+    def run(self, host, user, password, command, stdout_capture, stderr_capture):
+        """
+        Run command on the host's session, feeding the captures. Returns the exit
+        status, or None when the session is busy with another command (use a plain channel).
+        """
+        key = (host, user)
+        with self.lock:
+            session = self.sessions.get(key)
+        if session is not None and not session.is_open():
+            with self.lock:
+                self.sessions.pop(key, None)
+            self._close(session)
+            session = None
+        if session is None:
+            opened = self._open(host, user, password)
+            with self.lock:
+                session = self.sessions.setdefault(key, opened)
+                if session is opened:
+                    self.stats["opened"] += 1
+            if session is not opened:
+                self._close(opened)
+
+        if not session.lock.acquire(blocking=False):
+            with self.lock:
+                self.stats["fallbacks"] += 1
+            return None
+        try:
+            status = session.run(command, stdout_capture, stderr_capture)
+        except Exception:
+            # A broken frame leaves the shell in an unknown state; start over next time
+            with self.lock:
+                if self.sessions.get(key) is session:
+                    del self.sessions[key]
+            self._close(session)
+            raise
+        finally:
+            session.lock.release()
+        with self.lock:
+            self.stats["commands"] += 1
+        return status
+
+    def close_host(self, host, user=None):
+        with self.lock:
+            closing = [self.sessions.pop(key) for key in list(self.sessions)
+                       if key[0] == host and (user is None or key[1] == user)]
+        for session in closing:
+            self._close(session)
+
+    def close_all(self):
+        with self.lock:
+            closing = list(self.sessions.values())
+            self.sessions.clear()
+        for session in closing:
+            self._close(session)
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats)
+
+shell_sessions = ShellSessionManager(connection_pool)
+
+class CommandResult(dict):
+    """
+    Result of one remote command. Still the {"host", "output", "error"} dict
+    modules have always used, now with the exit status (rc), the raw stderr,
+    the duration in seconds and the byte counts of both streams.
+
+    error is only set when the command failed: its stderr, or the exit status
+    when it printed nothing there. rc is None when the command never ran.
+    """
+    def __init__(self, host, output="", stderr="", rc=None, error=None, duration=0.0, stdout_bytes=0,
+                 stderr_bytes=0):
+        if error is None:
+            error = (stderr or f"exited with status {rc}") if rc else ""
+        super().__init__(host=host, output=output, error=error, rc=rc, stderr=stderr,
+                         duration=round(duration, 3), stdout_bytes=stdout_bytes, stderr_bytes=stderr_bytes)
+
+    @classmethod
+    def from_captures(cls, host, stdout_capture, stderr_capture, rc, duration):
+        """
+        Build the result from finished captures. Output that went over the cap is a
+        head/tail preview, and output_file / stderr_file name the spill files.
+        """
+        result = cls(host, stdout_capture.finish(), stderr_capture.finish(), rc, duration=duration,
+                     stdout_bytes=stdout_capture.total, stderr_bytes=stderr_capture.total)
+        if stdout_capture.path:
+            result["output_file"] = stdout_capture.path
+        if stderr_capture.path:
+            result["stderr_file"] = stderr_capture.path
+        return result
+
+    @property
+    def rc(self):
+        return self["rc"]
+
+    @property
+    def ok(self):
+        return self["rc"] == 0
+
+def _drain(channel, stdout_capture, stderr_capture, read_size=65536):
+    """
+    Feed stdout and stderr of an exec channel to their captures as data arrives,
+    reading both together so a command filling one stream can't stall on a full
+    window of the other. Returns the exit status, or None if the channel closed without one.
+    """
+    while True:
+        # The channel's fileno is readable when either stream has data (or it closes)
+        select.select([channel], [], [], 1.0)
+        while channel.recv_ready():
+            stdout_capture.feed(channel.recv(read_size))
+        while channel.recv_stderr_ready():
+            stderr_capture.feed(channel.recv_stderr(read_size))
+        # The exit status follows all of the command's data on the channel
+        if (channel.exit_status_ready() or channel.closed) and not channel.recv_ready() \
+                and not channel.recv_stderr_ready():
+            break
+    status = channel.recv_exit_status() if channel.exit_status_ready() else -1
+    return None if status == -1 else status
+
+def warm_up(host, user, password):
+    """Open (or validate) a pooled connection ahead of use. Returns an error string or None"""
     try:
-        ssh.connect(hostname=host, username=user, password=password, timeout=10)
-        stdin, stdout, stderr = ssh.exec_command(command)
-        result["output"] = stdout.read().decode().strip()
-        result["error"] = stderr.read().decode().strip()
+        ssh = connection_pool.acquire(host, user, password)
+    except Exception as e:
+        return f"Connection failed for host {host}: {e}"
+    connection_pool.release(host, user, ssh)
+    return None
+
+def _execute(host, user, password, command, feed=None, bounded=True, captures=None):
+    result = CommandResult(host)
+    started_at = time.monotonic()
+
+    ssh = None
+    discard = False
+    try:
+        ssh = connection_pool.acquire(host, user, password)
+        try:
+            stdin, stdout, stderr = ssh.exec_command(command)
+        except SSHException:
+            # The pooled transport died between the health check and use; retry once on a fresh one
+            connection_pool.release(host, user, ssh, discard=True)
+            ssh = None
+            with connection_pool.lock:
+                connection_pool.stats["reconnects"] += 1
+            ssh = connection_pool.acquire(host, user, password)
+            stdin, stdout, stderr = ssh.exec_command(command)
+        if feed:
+            feed(stdin)
+            stdin.flush()
+            stdin.channel.shutdown_write()
+        captures = stdout_capture, stderr_capture = captures or make_captures(host, bounded)
+        status = _drain(stdout.channel, stdout_capture, stderr_capture)
+        result = CommandResult.from_captures(host, stdout_capture, stderr_capture, status,
+                                             time.monotonic() - started_at)
+        if status is None:
+            discard = True
+            result["error"] = f"SSH error on host {host}: channel closed without an exit status"
 
     except AuthenticationException:
         result["error"] = f"Authentication failed for host {host}."
     except NoValidConnectionsError as e:
         result["error"] = f"Connection failed for host {host}: {e}"
     except socket.timeout:
+        discard = True
         result["error"] = f"Connection to host {host} timed out."
     except SSHException as e:
+        discard = True
         result["error"] = f"SSH error on host {host}: {e}"
     except Exception as e:
+        discard = True
         result["error"] = f"Unexpected error on host {host}: {e}"
     finally:
-        ssh.close()
+        # A failed drain never reaches finish(); don't leak its spill files
+        for capture in captures or ():
+            capture.close()
+        if ssh is not None:
+            connection_pool.release(host, user, ssh, discard=discard)
+
+    return result
+
+def _execute_in_session(host, user, password, command, bounded=True, captures=None):
+    """
+    Run command on the host's persistent shell. Returns None when a plain channel
+    should be used instead, which is only ever the case before the command was sent.
+    """
+    started_at = time.monotonic()
+    stdout_capture, stderr_capture = captures or make_captures(host, bounded)
+    try:
+        return _run_in_session(host, user, password, command, stdout_capture, stderr_capture, started_at)
+    finally:
+        stdout_capture.close()
+        stderr_capture.close()
+
+def _run_in_session(host, user, password, command, stdout_capture, stderr_capture, started_at):
+    try:
+        status = shell_sessions.run(host, user, password, command, stdout_capture, stderr_capture)
+    except AuthenticationException:
+        return CommandResult(host, error=f"Authentication failed for host {host}.")
+    except NoValidConnectionsError as e:
+        return CommandResult(host, error=f"Connection failed for host {host}: {e}")
+    except CommandInterrupted as e:
+        # The command may have run (or be running); running it again could do its work twice
+        result = CommandResult.from_captures(host, stdout_capture, stderr_capture, None,
+                                             time.monotonic() - started_at)
+        result["error"] = f"SSH error on host {host}: {e} (the command may have partly run)"
+        return result
+    except (SSHException, socket.error):
+        # The session could not start or the command could not be sent; the exec channel path reconnects
+        return None
+    except Exception as e:
+        return CommandResult(host, error=f"Unexpected error on host {host}: {e}")
+    if status is None:
+        return None
+    return CommandResult.from_captures(host, stdout_capture, stderr_capture, status, time.monotonic() - started_at)
+
+def run_command(host, user, password, command, bounded=True, captures=None):
+    """
+    Run a command and return its CommandResult. Output beyond output_limits is
+    spilled to disk and its lines go to the thread's streaming_lines listener;
+    pass bounded=False for output the caller parses, which is kept whole, or
+    (stdout, stderr) captures of your own, e.g. FramedCapture.
+    """
+    if shell_sessions.enabled:
+        result = _execute_in_session(host, user, password, command, bounded, captures)
+        if result is not None:
+            return result
+    return _execute(host, user, password, command, bounded=bounded, captures=captures)
 
+def run_command_with_input(host, user, password, command, feed, bounded=True):
+    """Run a command and stream data to its stdin: feed(stdin) writes bytes to the channel"""
+    return _execute(host, user, password, command, feed, bounded)
+
+def _sftp_call(host, user, password, operation, window_size=DEFAULT_SFTP_WINDOW):
+    """Run operation(sftp, result) on the host's cached SFTP session and map failures to result["error"]"""
+    result = {
+        "host": host,
+        "output": "",
+        "error": ""
+    }
+    try:
+        with sftp_sessions.session(host, user, password, window_size) as sftp:
+            operation(sftp, result)
+    except AuthenticationException:
+        result["error"] = f"Authentication failed for host {host}."
+    except NoValidConnectionsError as e:
+        result["error"] = f"Connection failed for host {host}: {e}"
+    except socket.timeout:
+        result["error"] = f"Connection to host {host} timed out."
+    except SSHException as e:
+        result["error"] = f"SSH error on host {host}: {e}"
+    except Exception as e:
+        result["error"] = f"SFTP error on host {host}: {e}"
     return result
+
+def put(host, user, password, src, remote_path, buffer=None, window_size=DEFAULT_SFTP_WINDOW):
+    """Upload a local file (or a bytes-like buffer holding it) with pipelined SFTP writes"""
+    def upload(sftp, result):
+        with sftp.open(remote_path, "wb") as remote_file:
+            # Don't wait for an ack per write; close() collects them all
+            remote_file.set_pipelined(True)
+            if buffer is not None:
+                for offset in range(0, len(buffer), SFTP_CHUNK_SIZE):
+                    remote_file.write(buffer[offset:offset + SFTP_CHUNK_SIZE])
+            else:
+                with open(src, "rb") as local_file:
+                    while chunk := local_file.read(SFTP_CHUNK_SIZE):
+                        remote_file.write(chunk)
+        result["output"] = f"Uploaded to {remote_path}"
+    return _sftp_call(host, user, password, upload, window_size)
+
+def get(host, user, password, remote_path, local_path, window_size=DEFAULT_SFTP_WINDOW):
+    """Download a remote file to local_path"""
+    def download(sftp, result):
+        sftp.get(remote_path, local_path)
+        result["output"] = f"Downloaded {remote_path}"
+    return _sftp_call(host, user, password, download, window_size)
+
+def stat(host, user, password, remote_path):
+    """
+    Stat a remote path. result["stat"] holds size/mode/mtime/uid/gid, or None
+    when the path does not exist (which is not an error).
+    """
+    def do_stat(sftp, result):
+        try:
+            attrs = sftp.stat(remote_path)
+        except FileNotFoundError:
+            result["stat"] = None
+            return
+        result["stat"] = {"size": attrs.st_size, "mode": attrs.st_mode, "mtime": attrs.st_mtime,
+                          "uid": attrs.st_uid, "gid": attrs.st_gid}
+    return _sftp_call(host, user, password, do_stat)
@@ -0,0 +1,87 @@
+"""
+Ship-and-execute modules: Python source that runs on the target with python3.
+
+A payload module defines main(args) -> dict using only the standard library.
+The controller compresses its source once per version, sends it with the
+task's args as JSON over the command's stdin, and reads back one JSON result,
+so probe, decide and act happen in a single round trip.
+"""
+import base64
+import json
+import os
+import shlex
+import threading
+import zlib
+
+# Reads the payload and its args from stdin, runs main(args) and prints the result as JSON
+BOOTSTRAP = (
+    "import base64,json,sys,traceback,zlib\n"
+    "payload,args=sys.stdin.read().split('\\n',1)\n"
+    "scope={'__name__':'mini_ansible_payload'}\n"
+    "try:\n"
+    " exec(compile(zlib.decompress(base64.b64decode(payload)),'<payload>','exec'),scope)\n"
+    " result=scope['main'](json.loads(args))\n"
+    "except Exception as e:\n"
+    " traceback.print_exc()\n"
+    " result={'failed':True,'error':f'{type(e).__name__}: {e}'}\n"
+    "sys.stdout.write(json.dumps(result))\n"
+)
+
+# Built payloads: path -> (version, encoded payload bytes)
+_payloads = {}
+_payload_lock = threading.Lock()
+
+def build_payload(path):
+    """Compressed, base64 encoded source of a payload module, rebuilt only when the file changes"""
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    version = (stat.st_mtime_ns, stat.st_size)
+    with _payload_lock:
+        cached = _payloads.get(path)
+        if cached and cached[0] == version:
+            return cached
+    with open(path, "rb") as f:
+        source = f.read()
+    built = (version, base64.b64encode(zlib.compress(source, 9)))
+    with _payload_lock:
+        _payloads[path] = built
+    return built
+
+def payload_command(become=False):
+    command = f"python3 -c {shlex.quote(BOOTSTRAP)}"
+    return f"sudo {command}" if become else command
+
+def run_payload(host, user, password, path, args, executor, become=False):
+    """Run the payload module at path on host with args. Returns the module's result dict"""
+    _, encoded = build_payload(path)
+    data = encoded + b"\n" + json.dumps(args, default=str).encode("utf-8")
+
+    def feed(stdin):
+        stdin.write(data)
+
+    # The JSON result has to arrive whole
+    result = executor.run_command_with_input(host, user, password, payload_command(become), feed, bounded=False)
+    output = result.get("output", "")
+    try:
+        returned = json.loads(output)
+    except ValueError:
+        # No JSON means python3 never ran (missing, sudo refused) or the connection failed
+        return {"host": host, "output": output,
+                "error": result.get("error") or "Module payload returned no result", "changed": False}
+    if not isinstance(returned, dict):
+        return {"host": host, "output": output, "error": "Module payload returned a non-dict result",
+                "changed": False}
+
+    error = returned.pop("error", "") or ""
+    if returned.pop("failed", False) and not error:
+        error = "Module payload failed"
+    if error and result.get("stderr"):
+        # The traceback printed on stderr says where it went wrong
+        error = f"{error}\n{result['stderr']}"
+    return {
+        "host": host,
+        "output": returned.pop("msg", "") or "",
+        "error": error,
+        "changed": bool(returned.pop("changed", False)),
+        **returned
+    }
@@ -1,13 +1,20 @@
-from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed, wait, FIRST_COMPLETED, TimeoutError
 import yaml
 import importlib
+import inspect
 import re
 import os
+import shlex
 import threading
 import time
 import signal
-from collections import defaultdict
+import sys
+import uuid
+from collections import defaultdict, deque
+from contextlib import nullcontext
+from functools import lru_cache
 from . import executor
+from .conditionals import ConditionError, evaluate_condition
 
 def normalize_task_syntax(task):
     """
@@ -24,7 +31,7 @@ def normalize_task_syntax(task):
     # List of known modules - you can expand this list
     known_modules = {
         'apt', 'yum', 'shell', 'copy', 'file', 'git', 'pip', 
-        'service', 'user', 'wait_for', 'systemd', 'template'
+        'service', 'user', 'wait_for', 'systemd', 'template', 'lineinfile'
     }
     
     # Look for direct module syntax
@@ -119,6 +126,10 @@ class PlaybookState:
                 active.append(host)
         return active
     
+    def failed_host_count(self, host_list):
+        """Number of hosts in host_list that have failed or become unreachable"""
+        return sum(1 for host in host_list if not self.get_host_state(host["ip"]).should_continue())
+    
     def should_run_once_task(self, task_id):
         """Check and mark if a run_once task should execute"""
         with self.lock:
@@ -127,10 +138,46 @@ class PlaybookState:
             self.run_once_tasks.add(task_id)
             return True
 
+class TaskTimings:
+    """Collect per-task queue wait and execution time for the play recap"""
+    def __init__(self):
+        self.tasks = {}  # task name -> aggregated timings, in first-seen order
+        self.lock = threading.Lock()
+    
+    def record(self, task_name, wait, elapsed):
+        with self.lock:
+            stats = self.tasks.setdefault(task_name, {
+                "count": 0, "wait": 0.0, "max_wait": 0.0, "exec": 0.0, "max_exec": 0.0
+            })
+            stats["count"] += 1
+            stats["wait"] += wait
+            stats["max_wait"] = max(stats["max_wait"], wait)
+            stats["exec"] += elapsed
+            stats["max_exec"] = max(stats["max_exec"], elapsed)
+    
+    def print_summary(self):
+        with self.lock:
+            if not self.tasks:
+                return
+            print("\nTASK TIMINGS (queue wait vs execution per host) ***")
+            print("=" * 60)
+            for task_name, stats in self.tasks.items():
+                count = stats["count"]
+                print(f"{task_name[:30]:<30} : wait avg={stats['wait'] / count:.2f}s max={stats['max_wait']:.2f}s"
+                      f" | exec avg={stats['exec'] / count:.2f}s max={stats['max_exec']:.2f}s ({count} hosts)")
+
 class StreamingOutput:
     """Handle streaming output with thread safety"""
-    def __init__(self):
+    def __init__(self, live=False):
         self.lock = threading.Lock()
+        # Print command output lines as they arrive, ahead of each host's result
+        self.live = live
+    
+    def print_line(self, host_ip, task_name, stream, line, loop_var=None):
+        with self.lock:
+            loop_info = f" (item={loop_var})" if loop_var else ""
+            prefix = "\033[91m!\033[0m" if stream == "stderr" else " "
+            print(f"{prefix} {host_ip} | {task_name}{loop_info} | {line}")
     
     def print_host_result(self, host_ip, task_name, result, loop_var=None):
         with self.lock:
@@ -222,6 +269,114 @@ class LoopProcessor:
         
         return None
 
+PLACEHOLDER_PATTERN = re.compile(r'\{\{\s*([^}]+)\s*\}\}')
+
+class TemplateString:
+    """A string pre-split into literal text and {{ variable }} placeholders"""
+    __slots__ = ("parts",)
+    
+    def __init__(self, text):
+        # parts alternates literal text and (var_name, original placeholder) tuples
+        self.parts = []
+        position = 0
+        for match in PLACEHOLDER_PATTERN.finditer(text):
+            if match.start() > position:
+                self.parts.append(text[position:match.start()])
+            self.parts.append((match.group(1).strip(), match.group(0)))
+            position = match.end()
+        if position < len(text):
+            self.parts.append(text[position:])
+    
+    def render(self, lookup):
+        rendered = []
+        for part in self.parts:
+            if isinstance(part, str):
+                rendered.append(part)
+            else:
+                found, value = lookup(part[0])
+                # Unknown variables are left untouched, like substitute_variables does
+                rendered.append(str(value) if found else part[1])
+        return "".join(rendered)
+
+class TemplateDict:
+    """A dict whose static values are shared and dynamic values rendered on demand"""
+    __slots__ = ("static", "dynamic")
+    
+    def __init__(self, static, dynamic):
+        self.static = static
+        self.dynamic = dynamic
+    
+    def render(self, lookup):
+        rendered = dict(self.static)
+        for key, node in self.dynamic.items():
+            rendered[key] = node.render(lookup)
+        return rendered
+
+class TemplateList:
+    """A list with at least one dynamic element"""
+    __slots__ = ("items",)
+    
+    def __init__(self, items):
+        self.items = items
+    
+    def render(self, lookup):
+        return [render_template(item, lookup) for item in self.items]
+
+TEMPLATE_NODES = (TemplateString, TemplateDict, TemplateList)
+
+def compile_template(data):
+    """
+    Pre-parse data once. Subtrees without placeholders are returned unchanged
+    (and shared between renders); anything else becomes a template node.
+    """
+    if isinstance(data, str):
+        return TemplateString(data) if PLACEHOLDER_PATTERN.search(data) else data
+    elif isinstance(data, dict):
+        static, dynamic = {}, {}
+        for key, value in data.items():
+            node = compile_template(value)
+            if isinstance(node, TEMPLATE_NODES):
+                dynamic[key] = node
+            else:
+                static[key] = value
+        return TemplateDict(static, dynamic) if dynamic else data
+    elif isinstance(data, list):
+        items = [compile_template(item) for item in data]
+        if any(isinstance(item, TEMPLATE_NODES) for item in items):
+            return TemplateList(items)
+        return data
+    return data
+
+def render_template(node, lookup):
+    """Render a compile_template() result with a (found, value) lookup function"""
+    if isinstance(node, TEMPLATE_NODES):
+        return node.render(lookup)
+    return node
+
+class CompiledTask:
+    """A task normalized and pre-parsed once per play, then rendered per host and loop item"""
+    def __init__(self, task):
+        self.raw = task
+        self.task = normalize_task_syntax(task)
+        self.name = task.get("name", "unnamed task")
+        # when: is evaluated by the expression compiler, not rendered as a template
+        self.when = self.task.get("when")
+        self.template = compile_template({k: v for k, v in self.task.items() if k != "when"})
+    
+    def get(self, key, default=None):
+        """Dict-style access to the normalized (unrendered) task"""
+        return self.task.get(key, default)
+    
+    def render(self, var_processor):
+        """Return the task with placeholders resolved for one host/loop item"""
+        return render_template(self.template, var_processor.lookup)
+
+def compile_task(task):
+    """Compile a task dict; already compiled tasks are returned as-is"""
+    if isinstance(task, CompiledTask):
+        return task
+    return CompiledTask(task)
+
 class VariableProcessor:
     """Handle variable substitution and conditionals"""
     
@@ -241,26 +396,34 @@ class VariableProcessor:
     def _detect_distribution(self):
         return "Ubuntu"
     
+    def lookup(self, var_name):
+        """Resolve a variable name, returning (found, value)"""
+        # Check loop vars first, then variables, then host facts
+        if var_name in self.loop_vars:
+            return True, self.loop_vars[var_name]
+        elif var_name in self.variables:
+            return True, self.variables[var_name]
+        elif var_name in self.host_facts:
+            return True, self.host_facts[var_name]
+        return False, None
+    
+    def all_variables(self):
+        """Every visible variable as one dict, with the same precedence as lookup()"""
+        merged = dict(self.host_facts)
+        merged.update(self.variables)
+        merged.update(self.loop_vars)
+        return merged
+    
     def substitute_variables(self, text):
         """Replace {{ variable }} with actual values"""
         if not isinstance(text, str):
             return text
-            
-        pattern = r'\{\{\s*([^}]+)\s*\}\}'
         
         def replace_var(match):
-            var_name = match.group(1).strip()
-            # Check loop vars first, then variables, then host facts
-            if var_name in self.loop_vars:
-                return str(self.loop_vars[var_name])
-            elif var_name in self.variables:
-                return str(self.variables[var_name])
-            elif var_name in self.host_facts:
-                return str(self.host_facts[var_name])
-            else:
-                return match.group(0)
+            found, value = self.lookup(match.group(1).strip())
+            return str(value) if found else match.group(0)
         
-        return re.sub(pattern, replace_var, text)
+        return PLACEHOLDER_PATTERN.sub(replace_var, text)
     
     def process_dict(self, data):
         """Recursively process dictionary for variable substitution"""
@@ -274,28 +437,17 @@ class VariableProcessor:
             return data
     
     def evaluate_condition(self, condition):
-        """Evaluate when conditions"""
-        if not condition:
-            return True
-        
-        condition = self.substitute_variables(condition)
+        """Evaluate when conditions (parsed once per source string and cached)"""
+        return evaluate_condition(condition, self.lookup)
 
-        operators = {
-            '==': lambda a, b: str(a) == str(b),
-            '!=': lambda a, b: str(a) != str(b),
-            'in': lambda a, b: str(a) in str(b),
-            'not in': lambda a, b: str(a) not in str(b)
-        }
-        
-        for op, func in operators.items():
-            if op in condition:
-                parts = condition.split(op, 1)
-                if len(parts) == 2:
-                    left = parts[0].strip().strip('"\'')
-                    right = parts[1].strip().strip('"\'')
-                    return func(left, right)
-        
-        return bool(condition)
+def host_facts(host):
+    """Built-in per-host variables available to templates and conditions"""
+    return {
+        "mini_ansible_host": host["ip"],
+        "mini_ansible_user": host["username"],
+        "mini_ansible_host_group": host["group"],
+        "mini_ansible_password": host["password"]
+    }
 
 def load_playbook(file_path):
     with open(file_path, 'r') as f:
@@ -316,10 +468,34 @@ def run_task_with_timeout(task_func, timeout_seconds):
                 "timeout": True
             }
 
+@lru_cache(maxsize=None)
+def module_accepts_variables(mod):
+    """Modules opt in to receiving the task's variables by taking a `variables` keyword"""
+    return "variables" in inspect.signature(mod.run).parameters
+
+def chain_future(future, callback):
+    """Future resolving to callback(result) once future completes, without a thread blocking on it"""
+    chained = Future()
+    
+    def done(source):
+        try:
+            chained.set_result(callback(source.result()))
+        except Exception as e:
+            chained.set_exception(e)
+    
+    future.add_done_callback(done)
+    return chained
+
 def run_single_task_iteration(task, host, play_vars=None, task_vars=None, global_become=None, 
-                            playbook_state=None, streaming_output=None, loop_vars=None, timeout=None):
-    """Run a single iteration of a task (used for loops and regular tasks)"""
+                            playbook_state=None, streaming_output=None, loop_vars=None, timeout=None,
+                            defer=False):
+    """
+    Run a single iteration of a task (used for loops and regular tasks).
+    Modules may return a Future while they wait on something; with defer=True
+    a Future is returned in turn, otherwise it is waited on here.
+    """
     
+    task = compile_task(task)
     host_ip = host["ip"]
     host_state = playbook_state.get_host_state(host_ip) if playbook_state else None
     
@@ -333,30 +509,36 @@ def run_single_task_iteration(task, host, play_vars=None, task_vars=None, global
             "unreachable": host_state.unreachable
         }
     
-    # NORMALIZE TASK SYNTAX FIRST - before any processing
-    normalized_task = normalize_task_syntax(task)
-    
     # Merge variables: play_vars < task_vars < loop_vars
-    all_vars = {}
-    if play_vars:
-        all_vars.update(play_vars)
     if task_vars:
+        all_vars = {}
+        if play_vars:
+            all_vars.update(play_vars)
         all_vars.update(task_vars)
+    else:
+        all_vars = play_vars or {}
     
     # Initialize variable processor with loop variables
-    var_processor = VariableProcessor(all_vars, {
-        "mini_ansible_host": host["ip"],
-        "mini_ansible_user": host["username"],
-        "mini_ansible_host_group": host["group"],
-        "mini_ansible_password": host["password"]
-    }, loop_vars)
+    var_processor = VariableProcessor(all_vars, host_facts(host), loop_vars)
     
-    # Process normalized task for variable substitution
-    processed_task = var_processor.process_dict(normalized_task)
+    # Check conditions before rendering anything else
+    try:
+        condition_met = var_processor.evaluate_condition(task.when)
+    except ConditionError as e:
+        result = {
+            "host": host_ip,
+            "output": "",
+            "error": f"Invalid when condition: {e}",
+            "failed": True
+        }
+        if host_state:
+            host_state.mark_failed(result["error"])
+        if streaming_output:
+            loop_var = loop_vars.get("item") if loop_vars else None
+            streaming_output.print_host_result(host_ip, task.name, result, loop_var)
+        return result
     
-    # Check conditions
-    when_condition = processed_task.get("when")
-    if not var_processor.evaluate_condition(when_condition):
+    if not condition_met:
         result = {
             "host": host_ip,
             "output": "",
@@ -368,10 +550,13 @@ def run_single_task_iteration(task, host, play_vars=None, task_vars=None, global
         # Stream output immediately
         if streaming_output:
             loop_var = loop_vars.get("item") if loop_vars else None
-            streaming_output.print_host_result(host_ip, task.get("name", "unnamed task"), result, loop_var)
+            streaming_output.print_host_result(host_ip, task.name, result, loop_var)
         
         return result
     
+    # Resolve only the placeholders of the pre-compiled task
+    processed_task = task.render(var_processor)
+    
     # Now we're guaranteed to have 'module' and 'args' keys
     module_name = processed_task["module"]
     args = processed_task.get("args", {})
@@ -388,15 +573,28 @@ def run_single_task_iteration(task, host, play_vars=None, task_vars=None, global
                 "failed": True
             }
 
+        kwargs = {"become": become}
+        if module_accepts_variables(mod):
+            kwargs["variables"] = var_processor.all_variables()
+
+        # Set here, on the thread that runs the module (a timeout runs it on another one)
+        if streaming_output and streaming_output.live:
+            loop_var = loop_vars.get("item") if loop_vars else None
+            listener = executor.streaming_lines(
+                lambda stream, line: streaming_output.print_line(host_ip, task.name, stream, line, loop_var))
+        else:
+            listener = nullcontext()
+
         try:
-            return mod.run(
-                host["ip"],
-                host["username"],
-                host["password"],
-                args,
-                executor,
-                become=become
-            )
+            with listener:
+                return mod.run(
+                    host["ip"],
+                    host["username"],
+                    host["password"],
+                    args,
+                    executor,
+                    **kwargs
+                )
         except Exception as e:
             return {
                 "host": host_ip,
@@ -408,11 +606,33 @@ def run_single_task_iteration(task, host, play_vars=None, task_vars=None, global
     # Execute with timeout if specified
     if timeout:
         result = run_task_with_timeout(execute_task, timeout)
+        if isinstance(result, Future):
+            result = wait_deferred(result, host_ip, timeout)
         if result.get("timeout"):
             result["failed"] = True
     else:
         result = execute_task()
     
+    if isinstance(result, Future):
+        if defer:
+            return chain_future(result, lambda deferred: finish_task_iteration(
+                deferred, task, host_ip, host_state, streaming_output, loop_vars))
+        result = wait_deferred(result, host_ip)
+    
+    return finish_task_iteration(result, task, host_ip, host_state, streaming_output, loop_vars)
+
+def wait_deferred(future, host_ip, timeout=None):
+    """Block on a module's deferred result, turning failures into a result dict"""
+    try:
+        return future.result(timeout=timeout)
+    except TimeoutError:
+        future.cancel()
+        return {"host": host_ip, "output": "", "error": f"Task timed out after {timeout} seconds", "timeout": True}
+    except Exception as e:
+        return {"host": host_ip, "output": "", "error": f"Unexpected error: {str(e)}", "failed": True}
+
+def finish_task_iteration(result, task, host_ip, host_state, streaming_output, loop_vars):
+    """Classify a module result, record it on the host and stream it"""
     # Handle module loading errors
     if result.get("failed") and "not found" in result.get("error", ""):
         if host_state:
@@ -420,7 +640,7 @@ def run_single_task_iteration(task, host, play_vars=None, task_vars=None, global
         
         if streaming_output:
             loop_var = loop_vars.get("item") if loop_vars else None
-            streaming_output.print_host_result(host_ip, task.get("name", "unnamed task"), result, loop_var)
+            streaming_output.print_host_result(host_ip, task.name, result, loop_var)
         
         return result
     
@@ -443,15 +663,160 @@ def run_single_task_iteration(task, host, play_vars=None, task_vars=None, global
     # Stream output immediately
     if streaming_output:
         loop_var = loop_vars.get("item") if loop_vars else None
-        streaming_output.print_host_result(host_ip, task.get("name", "unnamed task"), result, loop_var)
+        streaming_output.print_host_result(host_ip, task.name, result, loop_var)
     
     return result
 
-def run_task(task, host, play_vars=None, global_become=None, playbook_state=None, streaming_output=None):
-    """Enhanced task runner with loops, run_once, timeout, and task vars"""
+LOOP_KEYS = ("with_items", "with_sequence", "loop")
+
+# Package modules whose loops can be folded into a single call, and the arg that takes the item list
+SQUASH_MODULES = {"apt": "name", "yum": "name", "pip": "name"}
+
+# Modules whose loops fold each item's fully rendered args into a list arg, and the key identifying an entry
+SQUASH_ARGS_MODULES = {"file": ("files", "path")}
+
+def resolve_loop_source(task_dict, variables):
+    """Expand with_items/loop written as a single "{{ var }}" reference into the variable's value"""
+    for key in ("with_items", "loop"):
+        source = task_dict.get(key)
+        if isinstance(source, str):
+            match = PLACEHOLDER_PATTERN.fullmatch(source.strip())
+            if match and match.group(1).strip() in variables:
+                return {**task_dict, key: variables[match.group(1).strip()]}
+    return task_dict
+
+def template_uses(node, var_name):
+    """Check whether a compiled template references a variable"""
+    if isinstance(node, TemplateString):
+        return any(not isinstance(part, str) and part[0] == var_name for part in node.parts)
+    if isinstance(node, TemplateDict):
+        return any(template_uses(child, var_name) for child in node.dynamic.values())
+    if isinstance(node, TemplateList):
+        return any(template_uses(child, var_name) for child in node.items)
+    return False
+
+def squash_arg(task):
+    """
+    Return the arg to fold loop items into when the loop can run as one module
+    call: a package module whose item list arg is exactly "{{ item }}" and no
+    other arg depends on the item. Returns None otherwise.
+    """
+    if task.get("module") in SQUASH_ARGS_MODULES:
+        # Only args may vary per item; the item must not change become, timeouts and so on
+        if not isinstance(task.template, TemplateDict) or "files" in task.task.get("args", {}):
+            return None
+        other_keys = [node for key, node in task.template.dynamic.items() if key not in ("args", "name")]
+        if any(template_uses(node, "item") for node in other_keys):
+            return None
+        return SQUASH_ARGS_MODULES[task.get("module")][0]
+
+    arg = SQUASH_MODULES.get(task.get("module"))
+    if not arg or not isinstance(task.template, TemplateDict):
+        return None
+    args_node = task.template.dynamic.get("args")
+    if not isinstance(args_node, TemplateDict):
+        return None
+    item_node = args_node.dynamic.get(arg)
+    if not isinstance(item_node, TemplateString) or item_node.parts != [("item", item_node.parts[0][1])]:
+        return None
+    other_args = [node for key, node in args_node.dynamic.items() if key != arg]
+    if any(template_uses(node, "item") for node in other_args):
+        return None
+    return arg
+
+def run_squashed_loop(task, arg, host, loop_items, play_vars=None, global_become=None, playbook_state=None,
+                      streaming_output=None, timeout=None):
+    """Run a package (or file) loop as one module invocation and report the outcome per item"""
+    host_ip = host["ip"]
+    facts = host_facts(host)
+    results = [None] * len(loop_items)
+    active = []
+    entries = {}  # index -> rendered args, for modules that take whole per-item args
+    fold_args = task.get("module") in SQUASH_ARGS_MODULES
+    
+    # Per-item when: conditions still decide which items are included
+    for index, loop_vars in enumerate(loop_items):
+        var_processor = VariableProcessor(play_vars, dict(facts), loop_vars)
+        try:
+            condition_met = var_processor.evaluate_condition(task.when)
+        except ConditionError as e:
+            results[index] = {
+                "host": host_ip,
+                "output": "",
+                "error": f"Invalid when condition: {e}",
+                "failed": True
+            }
+            if playbook_state:
+                playbook_state.get_host_state(host_ip).mark_failed(results[index]["error"])
+            if streaming_output:
+                streaming_output.print_host_result(host_ip, task.name, results[index], loop_vars.get("item"))
+            # Like the item-by-item loop, stop at the failing item; nothing has run yet
+            if not task.get("ignore_errors", False):
+                return results[:index + 1]
+            continue
+        if condition_met:
+            active.append(index)
+            if fold_args:
+                entries[index] = render_template(task.template, var_processor.lookup).get("args", {})
+        else:
+            results[index] = {
+                "host": host_ip,
+                "output": "",
+                "error": "",
+                "skipped": True,
+                "msg": "Skipped due to when condition"
+            }
+            if streaming_output:
+                streaming_output.print_host_result(host_ip, task.name, results[index], loop_vars.get("item"))
+    
+    if active:
+        squashed = {k: v for k, v in task.task.items() if k not in LOOP_KEYS and k != "when"}
+        if fold_args:
+            key = SQUASH_ARGS_MODULES[task.get("module")][1]
+            squashed["args"] = {arg: [entries[index] for index in active]}
+            item_keys = {index: entries[index].get(key) for index in active}
+        else:
+            squashed["args"] = {**task.task["args"], arg: [str(loop_items[index]["item"]) for index in active]}
+            item_keys = {index: str(loop_items[index]["item"]) for index in active}
+        result = run_single_task_iteration(
+            squashed, host, play_vars, None, global_become,
+            playbook_state, None, None, timeout
+        )
+        
+        # Modules that know which items they touched report them; otherwise every item shares the outcome
+        changed_items = result.get("changed_files" if fold_args else "changed_packages")
+        for position, index in enumerate(active):
+            item = item_keys[index]
+            item_result = {
+                "host": host_ip,
+                "output": result.get("output", "") if position == len(active) - 1 else "",
+                "error": result.get("error", ""),
+                "changed": item in changed_items if changed_items is not None else bool(result.get("changed")),
+                "squashed": True
+            }
+            for flag in ("failed", "unreachable", "skipped"):
+                if result.get(flag):
+                    item_result[flag] = result[flag]
+            results[index] = item_result
+            if streaming_output:
+                streaming_output.print_host_result(host_ip, task.name, item_result, loop_items[index].get("item"))
+    
+    return results
+
+def run_task(task, host, play_vars=None, global_become=None, playbook_state=None, streaming_output=None,
+             defer=False):
+    """
+    Enhanced task runner with loops, run_once, timeout, and task vars.
+    With defer=True a single (non-loop) task may return a Future, see run_single_task_iteration.
+    """
+    
+    task = compile_task(task)
     
-    # Extract task-level variables
+    # Extract task-level variables and merge them once for all loop items
     task_vars = task.get("vars", {})
+    if task_vars:
+        play_vars = {**(play_vars or {}), **task_vars}
+        task_vars = None
     
     # Check for timeout
     timeout = task.get("timeout")
@@ -470,9 +835,27 @@ def run_task(task, host, play_vars=None, global_become=None, playbook_state=None
             }
     
     # Check for loops
-    loop_items = LoopProcessor.process_loop(task)
+    loop_items = LoopProcessor.process_loop(resolve_loop_source(task.task, play_vars or {}))
     
-    if loop_items:
+    squash = squash_arg(task) if loop_items else None
+    if loop_items and squash:
+        results = run_squashed_loop(
+            task, squash, host, loop_items, play_vars, global_become,
+            playbook_state, streaming_output, timeout
+        )
+        
+        failed_count = sum(1 for r in results if r.get("failed"))
+        changed_count = sum(1 for r in results if r.get("changed"))
+        
+        return {
+            "host": host["ip"],
+            "output": f"Loop completed: {len(results)} items in one {task.get('module')} call, {changed_count} changed, {failed_count} failed",
+            "error": "" if failed_count == 0 else f"{failed_count} loop iterations failed",
+            "failed": failed_count > 0,
+            "changed": changed_count > 0,
+            "loop_results": results
+        }
+    elif loop_items:
         # Execute task for each loop item
         results = []
         for loop_item in loop_items:
@@ -502,11 +885,11 @@ def run_task(task, host, play_vars=None, global_become=None, playbook_state=None
         # Execute single task
         return run_single_task_iteration(
             task, host, play_vars, task_vars, global_become, 
-            playbook_state, streaming_output, None, timeout
+            playbook_state, streaming_output, None, timeout, defer
         )
 
-def run_on_all_hosts(hosts, task, play_vars=None, global_become=False, playbook_state=None, streaming_output=None):
-    """Run task on all hosts with streaming output and error handling"""
+def select_task_hosts(hosts, task, playbook_state=None):
+    """Return the hosts a task should run on, honouring failures and run_once"""
     
     # Filter out failed/unreachable hosts
     active_hosts = playbook_state.get_active_hosts(hosts) if playbook_state else hosts
@@ -519,62 +902,489 @@ def run_on_all_hosts(hosts, task, play_vars=None, global_become=False, playbook_
     if task.get("run_once", False):
         active_hosts = active_hosts[:1]
     
+    return active_hosts
+
+def handle_task_exception(host, task, exc, playbook_state=None, streaming_output=None):
+    """Turn an exception raised by run_task into a failed result"""
+    error_result = {
+        "host": host["ip"],
+        "output": "",
+        "error": f"Task execution failed: {str(exc)}",
+        "failed": True
+    }
+    
+    # Mark host as failed
+    if playbook_state:
+        host_state = playbook_state.get_host_state(host["ip"])
+        host_state.mark_failed(error_result["error"])
+    
+    # Stream the error
+    if streaming_output:
+        streaming_output.print_host_result(
+            host["ip"], 
+            task.get("name", "unnamed task"), 
+            error_result
+        )
+    
+    return error_result
+
+def timed_run_task(dispatched_at, task_timings, task, host, play_vars=None, global_become=None,
+                   playbook_state=None, streaming_output=None, defer=False):
+    """run_task wrapper that records how long the host waited for a fork and how long it ran"""
+    started_at = time.monotonic()
+    result = None
+    try:
+        result = run_task(task, host, play_vars, global_become, playbook_state, streaming_output, defer)
+        return result
+    finally:
+        if task_timings:
+            name = task.get("name", "unnamed task")
+            if isinstance(result, Future):
+                # A deferred module is still running: stop the clock when it completes
+                result.add_done_callback(lambda _: task_timings.record(name, started_at - dispatched_at,
+                                                                       time.monotonic() - started_at))
+            else:
+                task_timings.record(name, started_at - dispatched_at, time.monotonic() - started_at)
+
+def dispatch_to_hosts(worker_pool, forks, hosts, func):
+    """
+    Run func(host) for every host on worker_pool, keeping at most `forks` hosts
+    in flight. Yields (host, future) pairs as they complete.
+    """
+    pending_hosts = iter(hosts)
+    future_to_host = {}
+    
+    def submit_next():
+        host = next(pending_hosts, None)
+        if host is not None:
+            future_to_host[worker_pool.submit(func, host)] = host
+    
+    for _ in range(forks):
+        submit_next()
+    
+    while future_to_host:
+        done, _ = wait(future_to_host, return_when=FIRST_COMPLETED)
+        for future in done:
+            host = future_to_host.pop(future)
+            submit_next()
+            yield host, future
+
+def run_on_all_hosts(hosts, task, play_vars=None, global_become=False, playbook_state=None, streaming_output=None,
+                     worker_pool=None, forks=10, task_timings=None):
+    """Run task on all hosts with streaming output and error handling"""
+    
+    active_hosts = select_task_hosts(hosts, task, playbook_state)
+    if not active_hosts:
+        return []
+    
+    # Fall back to a private pool when called outside run_playbook
+    own_pool = worker_pool is None
+    if own_pool:
+        worker_pool = ThreadPoolExecutor(max_workers=min(len(active_hosts), forks))
+    
     results = []
+    dispatched_at = time.monotonic()
     
-    with ThreadPoolExecutor(max_workers=min(len(active_hosts), 10)) as executor:
-        # Submit all tasks
-        future_to_host = {
-            executor.submit(
-                run_task, 
-                task, 
-                host, 
-                play_vars, 
-                global_become, 
-                playbook_state, 
-                streaming_output
-            ): host for host in active_hosts
-        }
-        
+    def run_host(host):
+        return timed_run_task(dispatched_at, task_timings, task, host, play_vars, global_become,
+                              playbook_state, streaming_output, defer=True)
+    
+    # Hosts whose module is waiting without holding a fork
+    deferred = {}
+    
+    try:
         # Process results as they complete (streaming)
-        for future in as_completed(future_to_host):
-            host = future_to_host[future]
+        for host, future in dispatch_to_hosts(worker_pool, forks, active_hosts, run_host):
             try:
                 result = future.result()
+                if isinstance(result, Future):
+                    deferred[result] = host
+                    continue
                 results.append(result)
             except Exception as e:
-                error_result = {
-                    "host": host["ip"],
-                    "output": "",
-                    "error": f"Task execution failed: {str(e)}",
-                    "failed": True
-                }
-                results.append(error_result)
-                
-                # Mark host as failed
-                if playbook_state:
-                    host_state = playbook_state.get_host_state(host["ip"])
-                    host_state.mark_failed(error_result["error"])
-                
-                # Stream the error
-                if streaming_output:
-                    streaming_output.print_host_result(
-                        host["ip"], 
-                        task.get("name", "unnamed task"), 
-                        error_result
-                    )
+                results.append(handle_task_exception(host, task, e, playbook_state, streaming_output))
+        
+        for future in as_completed(deferred):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append(handle_task_exception(deferred[future], task, e, playbook_state, streaming_output))
+    finally:
+        if own_pool:
+            worker_pool.shutdown(wait=True)
+    
+    return results
+
+@lru_cache(maxsize=None)
+def pipeline_module(module_name):
+    """The module for module_name if it can build its command up front (has build_command), else None"""
+    if not isinstance(module_name, str):
+        return None
+    try:
+        mod = importlib.import_module(f"modules.{module_name}")
+    except ModuleNotFoundError:
+        return None
+    return mod if hasattr(mod, "build_command") else None
+
+def can_pipeline(task):
+    """Loops, run_once and timeouts need the task to run on its own"""
+    if any(key in task.task for key in LOOP_KEYS) or task.get("run_once") or task.get("timeout"):
+        return False
+    return pipeline_module(task.get("module")) is not None
+
+def pipeline_runs(tasks):
+    """
+    Split a task list into runs. Consecutive pipelinable tasks form one run;
+    every other task is a run of its own. when: conditions only see variables
+    and facts, never earlier results, so they don't break a run.
+    """
+    runs, current = [], []
+    for task in tasks:
+        if can_pipeline(task):
+            current.append(task)
+            continue
+        if current:
+            runs.append(current)
+            current = []
+        runs.append([task])
+    if current:
+        runs.append(current)
+    return runs
+
+def pipeline_step(task, host, play_vars=None, global_become=None):
+    """
+    Render one task of a pipelined run for a host. Returns (module, args, command)
+    or a finished result when the task doesn't run (skipped or invalid).
+    """
+    host_ip = host["ip"]
+    all_vars = {**(play_vars or {}), **task.get("vars", {})}
+    var_processor = VariableProcessor(all_vars, host_facts(host))
+    
+    try:
+        condition_met = var_processor.evaluate_condition(task.when)
+    except ConditionError as e:
+        return {"host": host_ip, "output": "", "error": f"Invalid when condition: {e}", "failed": True}
+    if not condition_met:
+        return {"host": host_ip, "output": "", "error": "", "skipped": True, "msg": "Skipped due to when condition"}
+    
+    processed_task = task.render(var_processor)
+    mod = pipeline_module(processed_task["module"])
+    args = processed_task.get("args", {})
+    try:
+        command = mod.build_command(args, processed_task.get("become", global_become))
+    except ValueError as e:
+        return {"host": host_ip, "output": "", "error": str(e), "failed": True}
+    return mod, args, command
+
+def pipeline_script(commands, token):
+    """
+    One script running every command in order. Each step is framed on both
+    streams by a token line carrying its exit status, and the script stops
+    after the first step that exits non-zero.
+    """
+    steps = []
+    for index, command in enumerate(commands):
+        steps.append(
+            f"( eval {shlex.quote(command)} ) </dev/null; __rc=$?; "
+            f"printf '\\n{token} {index} %d\\n' $__rc; printf '\\n{token} {index}\\n' >&2; "
+            f"[ $__rc -eq 0 ] || exit 0"
+        )
+    return "\n".join(steps)
+
+def run_pipeline(host, tasks, play_vars=None, global_become=None, dispatched_at=None, task_timings=None):
+    """
+    Run consecutive tasks on a host as one remote script. Returns one unfinished
+    result per task that ran or was skipped, stopping after the first failure.
+    """
+    host_ip = host["ip"]
+    started_at = time.monotonic()
+    results = []
+    planned = []  # (position, module, args) of every step in the script
+    commands = []
+    for position, task in enumerate(tasks):
+        step = pipeline_step(task, host, play_vars, global_become)
+        if isinstance(step, dict):
+            results.append(step)
+            if step.get("failed"):
+                break
+            continue
+        results.append(None)
+        planned.append((position, step[0], step[1]))
+        commands.append(step[2])
+    
+    if commands:
+        token = uuid.uuid4().hex
+        # Steps are cut out of the streams as they arrive, each bounded like a command of its own
+        stdout = executor.FramedCapture(host_ip, "stdout", token)
+        stderr = executor.FramedCapture(host_ip, "stderr", token)
+        try:
+            raw = executor.run_command(host_ip, host["username"], host["password"],
+                                       pipeline_script(commands, token), captures=(stdout, stderr))
+        finally:
+            stdout.close()
+            stderr.close()
+        
+        for index, (position, mod, args) in enumerate(planned):
+            if index not in stdout.steps or index not in stderr.steps:
+                # The script (or the connection) died before this step reported
+                error = raw.get("stderr") or raw.get("error") or "Pipelined run ended before this task reported"
+                results[position] = {"host": host_ip, "output": "", "error": error}
+                del results[position + 1:]
+                break
+            output_capture, status = stdout.steps[index]
+            result = executor.CommandResult.from_captures(host_ip, output_capture, stderr.steps[index][0],
+                                                          status, 0.0)
+            if hasattr(mod, "pipeline_result"):
+                result = mod.pipeline_result(host_ip, args, result)
+            results[position] = result
+            if status:
+                del results[position + 1:]
+                break
+    
+    if task_timings:
+        task_timings.record(f"{tasks[0].name} (+{len(tasks) - 1} pipelined)",
+                            started_at - (dispatched_at or started_at), time.monotonic() - started_at)
+    return results
+
+def finish_pipeline_step(host, task, result, playbook_state=None, streaming_output=None):
+    """Record and stream one task's share of a pipelined run, as if it had run alone"""
+    host_state = playbook_state.get_host_state(host["ip"]) if playbook_state else None
+    if result.get("skipped"):
+        if streaming_output:
+            streaming_output.print_host_result(host["ip"], task.name, result)
+        return result
+    return finish_task_iteration(result, task, host["ip"], host_state, streaming_output, None)
+
+def run_pipeline_on_all_hosts(hosts, tasks, play_vars=None, global_become=False, playbook_state=None,
+                              worker_pool=None, forks=10, task_timings=None):
+    """
+    Run a pipelined task run on every active host. Returns (host, results) pairs;
+    the results are not recorded or streamed yet, so the caller can report them task by task.
+    """
+    active_hosts = select_task_hosts(hosts, tasks[0], playbook_state)
+    if not active_hosts:
+        return []
+    
+    own_pool = worker_pool is None
+    if own_pool:
+        worker_pool = ThreadPoolExecutor(max_workers=min(len(active_hosts), forks))
+    
+    host_results = []
+    dispatched_at = time.monotonic()
+    
+    def run_host(host):
+        return run_pipeline(host, tasks, play_vars, global_become, dispatched_at, task_timings)
+    
+    try:
+        for host, future in dispatch_to_hosts(worker_pool, forks, active_hosts, run_host):
+            try:
+                host_results.append((host, future.result()))
+            except Exception as e:
+                host_results.append((host, [{"host": host["ip"], "output": "",
+                                             "error": f"Task execution failed: {str(e)}", "failed": True}]))
+    finally:
+        if own_pool:
+            worker_pool.shutdown(wait=True)
+    
+    return host_results
+
+def walk_host_tasks(host, tasks, play_vars=None, global_become=False, playbook_state=None, streaming_output=None,
+                    dispatched_at=None, task_timings=None, pipelining=False):
+    """
+    Walk the whole task list for one host (used by the free strategy). A generator:
+    when a module defers its result the walk yields that Future, so the caller can
+    give the fork back, and is resumed with it once completed. Returns the results.
+    """
+    results = []
+    host_state = playbook_state.get_host_state(host["ip"]) if playbook_state else None
+    
+    for run in (pipeline_runs(tasks) if pipelining else [[task] for task in tasks]):
+        if host_state and not host_state.should_continue():
+            break
+        if len(run) > 1:
+            try:
+                steps = run_pipeline(host, run, play_vars, global_become, dispatched_at, task_timings)
+            except Exception as e:
+                results.append(handle_task_exception(host, run[0], e, playbook_state, streaming_output))
+            else:
+                results.extend(finish_pipeline_step(host, task, step, playbook_state, streaming_output)
+                               for task, step in zip(run, steps))
+            dispatched_at = None
+            continue
+        task = run[0]
+        try:
+            result = timed_run_task(dispatched_at or time.monotonic(), task_timings, task, host, play_vars,
+                                    global_become, playbook_state, streaming_output, defer=True)
+            if isinstance(result, Future):
+                result = (yield result).result()
+        except Exception as e:
+            result = handle_task_exception(host, task, e, playbook_state, streaming_output)
+        results.append(result)
+        # Only the first task waits for a fork; later ones start immediately
+        dispatched_at = None
     
     return results
 
-def run_playbook(hosts, playbook):
-    """Enhanced playbook runner with proper error handling and streaming"""
+def advance_host_walk(walk, deferred=None):
+    """
+    Run a walk_host_tasks generator until it finishes or waits on a deferred module,
+    resuming it with the completed `deferred` Future if given. Returns (results, None)
+    once the walk is done, else (None, Future it waits on).
+    """
+    try:
+        waiting_on = walk.send(deferred) if deferred is not None else next(walk)
+    except StopIteration as done:
+        return done.value, None
+    return None, waiting_on
+
+def run_play_free(hosts, tasks, play_vars=None, global_become=False, playbook_state=None, streaming_output=None,
+                  worker_pool=None, forks=10, task_timings=None, pipelining=False):
+    """Free strategy: every host walks the task list on its own, without waiting for the others"""
+    
+    active_hosts = playbook_state.get_active_hosts(hosts) if playbook_state else hosts
+    if not active_hosts:
+        print("No active hosts available for this play")
+        return []
+    
+    own_pool = worker_pool is None
+    if own_pool:
+        worker_pool = ThreadPoolExecutor(max_workers=min(len(active_hosts), forks))
+    
+    results = []
+    dispatched_at = time.monotonic()
+    # Walks waiting for a fork (with the Future to resume them with), holding one, and parked on a module
+    ready = deque((walk_host_tasks(host, tasks, play_vars, global_become, playbook_state, streaming_output,
+                                   dispatched_at, task_timings, pipelining), None) for host in active_hosts)
+    running = {}
+    parked = {}
+    
+    try:
+        while ready or running or parked:
+            while ready and len(running) < forks:
+                walk, deferred = ready.popleft()
+                running[worker_pool.submit(advance_host_walk, walk, deferred)] = walk
+            done, _ = wait(list(running) + list(parked), return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in parked:
+                    # The module finished; the host queues for a fork again
+                    ready.append((parked.pop(future), future))
+                    continue
+                walk = running.pop(future)
+                host_results, waiting_on = future.result()
+                if waiting_on is None:
+                    results.extend(host_results)
+                else:
+                    parked[waiting_on] = walk
+    finally:
+        if own_pool:
+            worker_pool.shutdown(wait=True)
+    
+    return results
+
+def build_serial_batches(hosts, serial):
+    """
+    Split hosts into rolling batches. serial may be an int, a percentage string
+    like "10%", or a ramp list such as [1, 10, "25%"] whose last size repeats.
+    """
+    if not serial:
+        return [hosts]
+    
+    def batch_size(value):
+        if isinstance(value, str) and value.strip().endswith("%"):
+            size = int(len(hosts) * float(value.strip()[:-1]) / 100)
+        else:
+            size = int(value)
+        return max(size, 1)
+    
+    sizes = [batch_size(v) for v in serial] if isinstance(serial, list) else [batch_size(serial)]
+    
+    batches = []
+    position = 0
+    while position < len(hosts):
+        size = sizes[min(len(batches), len(sizes) - 1)]
+        batches.append(hosts[position:position + size])
+        position += size
+    return batches
+
+def warm_up_connections(hosts, worker_pool=None, forks=10):
+    """Open pooled SSH connections for a batch in parallel before its first task"""
+    own_pool = worker_pool is None
+    if own_pool:
+        worker_pool = ThreadPoolExecutor(max_workers=min(len(hosts), forks))
+    
+    def connect(host):
+        return executor.warm_up(host["ip"], host["username"], host["password"])
+    
+    try:
+        # Failures are left for the first task to report as unreachable
+        for _ in dispatch_to_hosts(worker_pool, forks, hosts, connect):
+            pass
+    finally:
+        if own_pool:
+            worker_pool.shutdown(wait=True)
+
+def release_connections(hosts):
+    """Close cached SFTP sessions and pooled SSH connections for a finished batch"""
+    for host in hosts:
+        executor.sftp_sessions.close_host(host["ip"], host["username"])
+        executor.shell_sessions.close_host(host["ip"], host["username"])
+        executor.connection_pool.close_host(host["ip"], host["username"])
+
+def max_fail_exceeded(batch, playbook_state, max_fail_percentage):
+    """Check a batch against max_fail_percentage (or total failure when serial is used without it)"""
+    if not batch:
+        return False
+    failed = playbook_state.failed_host_count(batch)
+    if max_fail_percentage is None:
+        return failed == len(batch)
+    return failed * 100.0 / len(batch) > float(max_fail_percentage)
+
+def run_playbook(hosts, playbook, engine="thread", forks=None, shell_sessions=False, pipelining=False,
+                 max_output=None, spill_dir=None, live_output=False):
+    """
+    Enhanced playbook runner with proper error handling and streaming.
+    With pipelining=True consecutive shell/file/service/systemd tasks run on each host as one script.
+    max_output caps the bytes of each output stream kept in memory per result (the rest is spilled
+    under spill_dir); live_output prints command output lines as they arrive.
+    """
+    
+    # Opt-in: run commands on one persistent remote shell per host instead of a channel each
+    executor.shell_sessions.enabled = shell_sessions
+    if max_output:
+        executor.output_limits.max_bytes = max_output
+    if spill_dir:
+        executor.output_limits.spill_dir = spill_dir
     
     playbook_state = PlaybookState()
-    streaming_output = StreamingOutput()
+    streaming_output = StreamingOutput(live=live_output)
+    task_timings = TaskTimings()
     
+    if engine == "async":
+        from .async_engine import AsyncEngine
+        async_engine = AsyncEngine()
+        default_forks = forks or async_engine.max_concurrency
+        # Pipelined runs and connection warm-up still block a thread per host: bound them by the offload pool
+        worker_pool = async_engine.offload_pool
+        run_hosts = async_engine.run_on_all_hosts
+        run_free = async_engine.run_play_free
+    else:
+        async_engine = None
+        default_forks = forks or 10
+        # One long-lived pool for the whole run, sized for the largest play
+        max_forks = max([default_forks] + [play.get("forks", 0) for play in playbook])
+        worker_pool = ThreadPoolExecutor(max_workers=max_forks, thread_name_prefix="mini-ansible-fork")
+        run_hosts = run_on_all_hosts
+        run_free = run_play_free
+    
+    aborted = False
     for play in playbook:
+        # Normalize and pre-parse every task once for the whole play
+        compiled_tasks = [compile_task(task) for task in play.get("tasks", [])]
         target_inventory_group = play.get("hosts", "all")
         play_vars = play.get("vars", {})
         global_become = play.get("become", False)
+        play_forks = play.get("forks", default_forks)
+        strategy = play.get("strategy", "linear")
 
         print(f"\nPLAY [{play.get('name', 'Unnamed Play')}] ***")
         print("=" * 60)
@@ -599,31 +1409,116 @@ def run_playbook(hosts, playbook):
                 host_with_group["group"] = target_inventory_group
                 available_hosts.append(host_with_group)
 
-        # Execute tasks
-        for task in play.get("tasks", []):
-            task_name = task.get("name", "Unnamed Task")
-            print(f"\nTASK [{task_name}] ***")
-            print("-" * 40)
-            
-            results = run_on_all_hosts(
-                available_hosts, 
-                task, 
-                play_vars, 
-                global_become, 
-                playbook_state, 
-                streaming_output
-            )
-            
-            # Print summary for this task
-            if results:
+        if strategy not in ("linear", "free"):
+            print(f"Unknown strategy '{strategy}', falling back to linear")
+            strategy = "linear"
+
+        serial = play.get("serial")
+        max_fail_percentage = play.get("max_fail_percentage")
+        # Hosts that failed in an earlier play neither take a batch slot nor count against this play's batches
+        batches = build_serial_batches(playbook_state.get_active_hosts(available_hosts), serial)
+
+        for batch_number, batch in enumerate(batches, 1):
+            if serial:
+                print(f"\nBATCH [{batch_number}/{len(batches)}] {len(batch)} hosts ***")
+                warm_up_connections(batch, worker_pool, play_forks)
+
+            if strategy == "free":
+                tasks = compiled_tasks
+                print(f"\nTASKS [{len(tasks)} tasks, strategy: free] ***")
+                print("-" * 40)
+                
+                results = run_free(
+                    batch,
+                    tasks,
+                    play_vars,
+                    global_become,
+                    playbook_state,
+                    streaming_output,
+                    worker_pool=worker_pool,
+                    forks=play_forks,
+                    task_timings=task_timings,
+                    pipelining=pipelining
+                )
+                
                 failed_count = sum(1 for r in results if r.get("failed") or r.get("error"))
                 unreachable_count = sum(1 for r in results if r.get("unreachable"))
-                changed_count = sum(1 for r in results if r.get("changed"))
-                skipped_count = sum(1 for r in results if r.get("skipped"))
-                ok_count = len(results) - failed_count - unreachable_count - skipped_count
-                
                 if failed_count > 0 or unreachable_count > 0:
-                    print(f"Task failed on {failed_count} hosts, unreachable on {unreachable_count} hosts")
+                    print(f"Play had {failed_count} failed and {unreachable_count} unreachable task results")
+            else:
+                # Execute tasks; with pipelining, runs of simple tasks go to each host as one script
+                task_runs = pipeline_runs(compiled_tasks) if pipelining else [[task] for task in compiled_tasks]
+                for task_run in task_runs:
+                    if len(task_run) > 1:
+                        host_results = run_pipeline_on_all_hosts(
+                            batch,
+                            task_run,
+                            play_vars,
+                            global_become,
+                            playbook_state,
+                            worker_pool=worker_pool,
+                            forks=play_forks,
+                            task_timings=task_timings
+                        )
+                    
+                    for position, task in enumerate(task_run):
+                        task_name = task.raw.get("name", "Unnamed Task")
+                        print(f"\nTASK [{task_name}] ***")
+                        print("-" * 40)
+                        
+                        if len(task_run) > 1:
+                            # Hosts that stopped at an earlier step have no result here, as if deselected
+                            results = [
+                                finish_pipeline_step(host, task, steps[position], playbook_state, streaming_output)
+                                for host, steps in host_results if position < len(steps)
+                            ]
+                        else:
+                            results = run_hosts(
+                                batch, 
+                                task, 
+                                play_vars, 
+                                global_become, 
+                                playbook_state, 
+                                streaming_output,
+                                worker_pool=worker_pool,
+                                forks=play_forks,
+                                task_timings=task_timings
+                            )
+                        
+                        # Print summary for this task
+                        if results:
+                            failed_count = sum(1 for r in results if r.get("failed") or r.get("error"))
+                            unreachable_count = sum(1 for r in results if r.get("unreachable"))
+                            changed_count = sum(1 for r in results if r.get("changed"))
+                            skipped_count = sum(1 for r in results if r.get("skipped"))
+                            ok_count = len(results) - failed_count - unreachable_count - skipped_count
+                            
+                            if failed_count > 0 or unreachable_count > 0:
+                                print(f"Task failed on {failed_count} hosts, unreachable on {unreachable_count} hosts")
+                    
+                    # A pipelined run has already executed every step, so it is only checked as a whole
+                    if (serial or max_fail_percentage is not None) and \
+                            max_fail_exceeded(batch, playbook_state, max_fail_percentage):
+                        break
+
+            if serial:
+                release_connections(batch)
+
+            if (serial or max_fail_percentage is not None) and \
+                    max_fail_exceeded(batch, playbook_state, max_fail_percentage):
+                failed = playbook_state.failed_host_count(batch)
+                print(f"\nABORTING: {failed}/{len(batch)} hosts failed in batch {batch_number} "
+                      f"(max_fail_percentage={max_fail_percentage})")
+                aborted = True
+                break
+
+        if aborted:
+            break
+    
+    if async_engine:
+        async_engine.close()
+    else:
+        worker_pool.shutdown(wait=True)
     
     # Print final play recap
     print("\nPLAY RECAP ***")
@@ -643,6 +1538,32 @@ def run_playbook(hosts, playbook):
         
         print(f"{host_ip:<20} : {' '.join(status_parts)}")
 
+    task_timings.print_summary()
+    
+    # Connection reuse summary
+    pool_stats = executor.connection_pool.get_stats()
+    print(f"\nCONNECTIONS: hits={pool_stats['hits']} misses={pool_stats['misses']} "
+          f"reconnects={pool_stats['reconnects']} evictions={pool_stats['evictions']}")
+    sftp_stats = executor.sftp_sessions.get_stats()
+    print(f"SFTP SESSIONS: opened={sftp_stats['opened']} reused={sftp_stats['reused']}")
+    if executor.output_limits.spilled:
+        print(f"OUTPUT: {executor.output_limits.spilled} stream(s) over {executor.output_limits.max_bytes} bytes "
+              f"spilled to {executor.output_limits.spill_dir}")
+    executor.sftp_sessions.close_all()
+    if shell_sessions:
+        shell_stats = executor.shell_sessions.get_stats()
+        print(f"SHELL SESSIONS: opened={shell_stats['opened']} commands={shell_stats['commands']} "
+              f"fallbacks={shell_stats['fallbacks']}")
+        executor.shell_sessions.close_all()
+    cleanup_modules()
+    executor.connection_pool.close_all()
+
+def cleanup_modules():
+    """Call the cleanup() hook of every loaded module that shares state across hosts (caches, mapped files)"""
+    for name, mod in list(sys.modules.items()):
+        if name.startswith("modules.") and hasattr(mod, "cleanup"):
+            mod.cleanup()
+
 # Utility functions for module development
 def parse_module_args(args_string):
     """Parse module arguments from string format"""
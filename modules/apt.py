@@ -1,124 +1,198 @@
+import threading
+import time
 from utils.sudo import sudo_wrap
 
+UPGRADABLE_MARKER = "---UPGRADABLE---"
+CACHE_MARKER = "---CACHE---"
+
+# Controller-side record of when each host's package index was last known fresh
+_cache_updates = {}
+_cache_lock = threading.Lock()
+
+def _cache_is_fresh(host, cache_valid_time):
+    with _cache_lock:
+        updated_at = _cache_updates.get(host)
+    return updated_at is not None and time.time() - updated_at < cache_valid_time
+
+def _record_cache_update(host, updated_at):
+    with _cache_lock:
+        _cache_updates[host] = max(updated_at, _cache_updates.get(host, 0))
+
+def _update_cache_command(become, cache_valid_time):
+    """
+    Shell snippet that refreshes the package index and prints the cache age.
+    With cache_valid_time the decision is made remotely from the mtime of the
+    apt lists, so checking and updating cost no extra round trip.
+    """
+    update_cmd = "apt-get update >/dev/null"
+    if become:
+        update_cmd = sudo_wrap(update_cmd)
+    if not cache_valid_time:
+        return f"{update_cmd} && echo '{CACHE_MARKER} updated 0'"
+
+    stamp = ("$(stat -c %Y /var/lib/apt/periodic/update-success-stamp /var/lib/apt/lists 2>/dev/null "
+             "| sort -n | tail -1)")
+    return (f"stamp={stamp}; age=$(( $(date +%s) - ${{stamp:-0}} )); "
+            f"if [ \"$age\" -ge {int(cache_valid_time)} ]; then {update_cmd} && echo '{CACHE_MARKER} updated 0'; "
+            f"else echo \"{CACHE_MARKER} fresh $age\"; fi")
+
+def _probe_packages(host, user, password, packages, executor, become, update_cache, check_upgrades,
+                    cache_valid_time=None):
+    """
+    Query the state of every package in one round trip.
+
+    Optionally refreshes the package index first and lists upgradable packages,
+    so state/upgrade decisions can be made locally.
+    Returns (pkg_status, upgradable, cache_updated, error_result).
+    """
+    commands = []
+
+    # Reading the dpkg database does not need root
+    if packages:
+        pkg_list = " ".join(packages)
+        commands.append(f"dpkg-query -W -f='${{Package}}\\t${{db:Status-Abbrev}}\\n' {pkg_list} 2>/dev/null")
+    if check_upgrades:
+        commands.append(f"echo '{UPGRADABLE_MARKER}'")
+        commands.append("apt list --upgradable 2>/dev/null")
+
+    # dpkg-query exits 1 when a package is unknown, which is an answer here, not a failure
+    script = "; ".join(commands + ["true"])
+    if update_cache:
+        # A failed index refresh is the only thing that fails the probe
+        script = f"{{ {_update_cache_command(become, cache_valid_time)}; }} && {{ {script}; }}"
+
+    probed_at = time.time()
+    result = executor.run_command(host, user, password, script, bounded=False)
+    if result.get("error"):
+        return None, None, False, result
+
+    output = result.get("output", "")
+    cache_updated = False
+    if update_cache:
+        cache_line, _, output = output.partition("\n")
+        _, action, age = (cache_line.split() + ["", "", "0"])[:3]
+        cache_updated = action == "updated"
+        _record_cache_update(host, probed_at - int(age) if age.isdigit() else probed_at)
+
+    status_output, _, upgrade_output = output.partition(UPGRADABLE_MARKER)
+
+    pkg_status = {pkg: "absent" for pkg in packages}
+    for line in status_output.splitlines():
+        name, _, abbrev = line.partition("\t")
+        name = name.strip()
+        if name not in pkg_status:
+            continue
+        abbrev = abbrev.strip()
+        if abbrev.startswith("ii"):
+            pkg_status[name] = "present"
+        elif abbrev.startswith("rc"):
+            pkg_status[name] = "removed-config"  # Removed but config files remain
+        elif abbrev.startswith("un") or not abbrev:
+            pkg_status[name] = "absent"
+        else:
+            pkg_status[name] = "unknown"
+
+    upgradable = set()
+    for line in upgrade_output.splitlines():
+        if "/" in line:
+            upgradable.add(line.split("/", 1)[0].strip())
+
+    return pkg_status, upgradable, cache_updated, None
+
 def run(host, user, password, args, executor, become=False):
     """apt module with idempotent state handling"""
-    
+
     # Handle both single package and list of packages
     packages = args.get("name")
     if isinstance(packages, str):
         packages = [packages]
     elif isinstance(packages, list):
         pass
+    elif packages is None and args.get("update_cache"):
+        # Cache refresh only
+        packages = []
     else:
         return {"host": host, "output": "", "error": "Package name must be string or list", "changed": False}
-    
+
     state = args.get("state", "present")
     update_cache = args.get("update_cache", False)
-    
-    commands = []
-    changed = False
-    
-    # Update cache if requested
-    if update_cache:
-        commands.append("apt-get update")
-        changed = True  # Cache update is always considered a change
-    
-    # Check current package states
-    pkg_status = {}
-    for pkg in packages:
-        check_cmd = f"dpkg -l {pkg} 2>/dev/null | grep -E '^ii|^rc' || echo 'not-installed'"
-        if become:
-            check_cmd = sudo_wrap(check_cmd)
-        
-        result = executor.run_command(host, user, password, check_cmd)
-        if result.get("error"):
-            return result
-        
-        output = result.get("output", "").strip()
-        if "not-installed" in output:
-            pkg_status[pkg] = "absent"
-        elif output.startswith("ii"):
-            pkg_status[pkg] = "present"
-        elif output.startswith("rc"):
-            pkg_status[pkg] = "removed-config"  # Removed but config files remain
-        else:
-            pkg_status[pkg] = "unknown"
-    
+    cache_valid_time = args.get("cache_valid_time")
+    if cache_valid_time is not None:
+        try:
+            cache_valid_time = int(cache_valid_time)
+        except (TypeError, ValueError):
+            return {"host": host, "output": "", "error": "cache_valid_time must be a number of seconds", "changed": False}
+
+    if state not in ("present", "absent", "latest"):
+        return {"host": host, "output": "", "error": f"Unknown state '{state}' for apt module", "changed": False}
+
+    # Skip even the remote freshness check when this run already updated the host recently
+    if update_cache and cache_valid_time and _cache_is_fresh(host, cache_valid_time):
+        update_cache = False
+        if not packages:
+            # A cache-only task has nothing left to ask the host
+            return {
+                "host": host,
+                "output": "Package cache is still valid",
+                "error": "",
+                "changed": False,
+                "changed_packages": []
+            }
+
+    # Check current package states (and available upgrades) in a single round trip
+    pkg_status, upgradable, cache_updated, error_result = _probe_packages(
+        host, user, password, packages, executor, become, update_cache, state == "latest", cache_valid_time
+    )
+    if error_result:
+        return error_result
+
+    # A cache refresh counts as a change; a cache that was still valid does not
+    changed = cache_updated
+
     # Handle different states
+    command = None
+    changed_packages = []
     if state == "present":
-        packages_to_install = [pkg for pkg in packages if pkg_status[pkg] in ["absent", "removed-config"]]
-        if packages_to_install:
-            pkg_list = " ".join(packages_to_install)
-            commands.append(f"apt-get install -y {pkg_list}")
-            changed = True
-            
+        changed_packages = [pkg for pkg in packages if pkg_status[pkg] in ["absent", "removed-config"]]
+        if changed_packages:
+            command = f"apt-get install -y {' '.join(changed_packages)}"
+
     elif state == "absent":
-        packages_to_remove = [pkg for pkg in packages if pkg_status[pkg] == "present"]
-        if packages_to_remove:
-            pkg_list = " ".join(packages_to_remove)
-            commands.append(f"apt-get remove -y {pkg_list}")
-            changed = True
-            
+        changed_packages = [pkg for pkg in packages if pkg_status[pkg] == "present"]
+        if changed_packages:
+            command = f"apt-get remove -y {' '.join(changed_packages)}"
+
     elif state == "latest":
-        # For latest, we need to check if updates are available
-        packages_to_upgrade = []
-        for pkg in packages:
-            if pkg_status[pkg] == "absent":
-                # Package not installed, will be installed
-                packages_to_upgrade.append(pkg)
-                changed = True
-            elif pkg_status[pkg] == "present":
-                # Check if upgrade is available
-                check_upgrade_cmd = f"apt list --upgradable 2>/dev/null | grep '^{pkg}/' || echo 'no-upgrade'"
-                if become:
-                    check_upgrade_cmd = sudo_wrap(check_upgrade_cmd)
-                
-                result = executor.run_command(host, user, password, check_upgrade_cmd)
-                if result.get("error"):
-                    return result
-                
-                if "no-upgrade" not in result.get("output", ""):
-                    packages_to_upgrade.append(pkg)
-                    changed = True
-        
-        if packages_to_upgrade:
-            # For new packages, use install; for existing, use upgrade
-            new_packages = [pkg for pkg in packages_to_upgrade if pkg_status[pkg] == "absent"]
-            existing_packages = [pkg for pkg in packages_to_upgrade if pkg_status[pkg] == "present"]
-            
-            if new_packages:
-                pkg_list = " ".join(new_packages)
-                commands.append(f"apt-get install -y {pkg_list}")
-            
-            if existing_packages:
-                pkg_list = " ".join(existing_packages)
-                commands.append(f"apt-get install -y --only-upgrade {pkg_list}")
-    else:
-        return {"host": host, "output": "", "error": f"Unknown state '{state}' for apt module", "changed": False}
-    
+        # Missing packages get installed, installed ones only if an upgrade is available;
+        # apt-get install handles both in one transaction
+        changed_packages = [
+            pkg for pkg in packages
+            if pkg_status[pkg] in ["absent", "removed-config"] or pkg in upgradable
+        ]
+        if changed_packages:
+            command = f"apt-get install -y {' '.join(changed_packages)}"
+
     # If no changes needed, return early
-    if not changed:
+    if not command:
+        if changed:
+            output = "Package cache updated"
+        elif not packages:
+            output = "Package cache is still valid"
+        else:
+            output = f"All packages already in desired state ({state})"
         return {
-            "host": host, 
-            "output": f"All packages already in desired state ({state})",
+            "host": host,
+            "output": output,
             "error": "",
-            "changed": False
+            "changed": changed,
+            "changed_packages": []
         }
-    
+
     # Apply sudo wrapper if needed
     if become:
-        commands = [sudo_wrap(cmd) for cmd in commands]
-
-    # Execute commands
-    if commands:
-        full_command = " && ".join(commands)
-        result = executor.run_command(host, user, password, full_command)
-        result["changed"] = changed
-        return result
-    
-    return {
-        "host": host,
-        "output": "No changes needed",
-        "error": "",
-        "changed": False
-    }
\ No newline at end of file
+        command = sudo_wrap(command)
+
+    result = executor.run_command(host, user, password, command)
+    result["changed"] = True
+    result["changed_packages"] = changed_packages
+    return result
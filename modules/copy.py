@@ -1,21 +1,443 @@
 import os
+import mmap
 import posixpath
-import paramiko
+import hashlib
+import shlex
+import tarfile
+import tempfile
+import threading
+import uuid
+from contextlib import contextmanager
+from utils import delta, relay
+from utils.sudo import sudo_wrap
+
+# Defaults for `distribute: true` peer relaying
+DEFAULT_RELAY_FANOUT = 4
+DEFAULT_RELAY_PORT = 8730
+DEFAULT_RELAY_TIMEOUT = 60
+
+# Local checksums shared by all host threads, keyed by (path, size, mtime)
+_checksum_cache = {}
+_checksum_locks = {}
+_checksum_lock = threading.Lock()
+
+def local_checksum(filepath):
+    """sha256 of a local file, streamed from disk and computed once per file version"""
+    stat = os.stat(filepath)
+    key = (os.path.abspath(filepath), stat.st_size, stat.st_mtime_ns)
+
+    with _checksum_lock:
+        if key in _checksum_cache:
+            return _checksum_cache[key]
+        file_lock = _checksum_locks.setdefault(key, threading.Lock())
+
+    # Hosts asking for the same file wait for the first one instead of hashing it again
+    with file_lock:
+        with _checksum_lock:
+            if key in _checksum_cache:
+                return _checksum_cache[key]
+        with open(filepath, "rb") as f:
+            digest = hashlib.file_digest(f, "sha256").hexdigest()
+        with _checksum_lock:
+            _checksum_cache[key] = digest
+            _checksum_locks.pop(key, None)
+    return digest
 
 def file_checksum(host, user, password, path, executor):
-    # Run 'sha256sum' on remote file and return checksum or None if no file
-    cmd = f"sha256sum {path} || echo 'FILE_NOT_FOUND'"
-    result = executor.run_command(host, user, password, cmd)
-    if "FILE_NOT_FOUND" in result["output"] or result["error"]:
+    # Run 'sha256sum' on remote file and return checksum or None if no file (or it can't be read)
+    result = executor.run_command(host, user, password, f"sha256sum -- {shlex.quote(path)}")
+    if result.get("rc") != 0 or not result["output"]:
         return None
     return result["output"].split()[0]
 
+def sftp_upload(host, user, password, src, remote_path, executor, transfer_window=None, buffer=None):
+    """Upload one local file (or a shared buffer holding it) over the host's cached SFTP session"""
+    kwargs = {"window_size": transfer_window} if transfer_window else {}
+    result = executor.put(host, user, password, src, remote_path, buffer=buffer, **kwargs)
+    if result.get("error"):
+        raise IOError(result["error"])
+
+def temp_path(dest):
+    """Remote upload path, unique per transfer so concurrent copies to one machine don't collide"""
+    return f"/tmp/.mini-ansible-{uuid.uuid4().hex[:12]}-{os.path.basename(dest)}"
+
+def finalize_command(temp_dest, dest, mode=None, owner=None, group=None, become=False):
+    """Single command that moves an uploaded file into place and applies mode/ownership"""
+    commands = [f"mv {shlex.quote(temp_dest)} {shlex.quote(dest)}"]
+    if mode:
+        commands.append(f"chmod {mode} {shlex.quote(dest)}")
+    if owner:
+        commands.append(f"chown {owner}{':' + group if group else ''} {shlex.quote(dest)}")
+    elif group:
+        commands.append(f"chgrp {group} {shlex.quote(dest)}")
+    if become:
+        commands = [sudo_wrap(cmd) for cmd in commands]
+    return " && ".join(commands)
+
+# Encoded deltas shared by hosts that hold the same old copy, keyed by file version and remote signatures
+_delta_cache = {}
+_delta_locks = {}
+_delta_lock = threading.Lock()
+
+def cached_delta(src, signature_output, block_size, max_literal_ratio):
+    """
+    Path of a local file holding the delta from the remote copy described by
+    signature_output to src, encoded once and reused for every host with the same
+    old copy. None when there is no remote copy or the delta isn't worth sending.
+    """
+    stat = os.stat(src)
+    key = (os.path.abspath(src), stat.st_size, stat.st_mtime_ns, block_size, max_literal_ratio,
+           hashlib.sha256(signature_output.encode()).hexdigest())
+
+    with _delta_lock:
+        if key in _delta_cache:
+            return _delta_cache[key]
+        key_lock = _delta_locks.setdefault(key, threading.Lock())
+
+    # Hosts with the same old copy wait for the first one instead of encoding it again
+    with key_lock:
+        with _delta_lock:
+            if key in _delta_cache:
+                return _delta_cache[key]
+        path = None
+        signatures = delta.parse_signatures(signature_output)
+        if signatures is not None:
+            fd, path = tempfile.mkstemp(prefix="mini-ansible-delta-")
+            try:
+                with os.fdopen(fd, "wb") as out:
+                    literal_bytes = delta.write_delta(src, signatures, block_size, out, max_literal_ratio)
+            except BaseException:
+                os.unlink(path)
+                raise
+            if literal_bytes is None:
+                os.unlink(path)
+                path = None
+        with _delta_lock:
+            _delta_cache[key] = path
+            _delta_locks.pop(key, None)
+    return path
+
+def delta_upload(host, user, password, src, dest, temp_dest, local_sum, executor, become, transfer_window,
+                 block_size=None, max_literal_ratio=delta.DEFAULT_MAX_LITERAL_RATIO):
+    """
+    Send only the blocks of src that the remote copy of dest lacks, and rebuild
+    the new file at temp_dest on the remote side.
+    Returns bytes sent, or None when a delta isn't possible or worth it (caller falls back to a full upload).
+    """
+    sudo = "sudo " if become else ""
+    block_size = int(block_size or delta.block_size_for(os.path.getsize(src)))
+
+    sig_result = executor.run_command(host, user, password, sudo + delta.signature_command(dest, block_size),
+                                      bounded=False)
+    if sig_result.get("error"):
+        return None
+    delta_path = cached_delta(src, sig_result.get("output", ""), block_size, max_literal_ratio)
+    if delta_path is None:
+        return None
+
+    bytes_sent = os.path.getsize(delta_path)
+    remote_delta = f"{temp_dest}.delta"
+    sftp_upload(host, user, password, delta_path, remote_delta, executor, transfer_window)
+
+    patch_cmd = sudo + delta.patch_command(dest, remote_delta, temp_dest, block_size, local_sum)
+    patch_result = executor.run_command(host, user, password,
+                                        f"{patch_cmd}; {sudo}rm -f -- {shlex.quote(remote_delta)}")
+    if patch_result.get("error") or "PATCHED" not in patch_result.get("output", ""):
+        return None
+    return bytes_sent
+
+class Distribution:
+    """
+    Shared state for sending one file version to many hosts: a single read-only
+    mmap of the source used by every sender thread, and the set of hosts that
+    already hold the file and can relay it to their peers.
+    """
+    def __init__(self, src, fanout):
+        self.fanout = fanout
+        self.condition = threading.Condition()
+        self.controller_slots = fanout
+        self.seeds = {}  # host -> {"user", "password", "path", "slots": set of busy relay slots}
+        self.readers = 0
+        self.closed = False
+        with open(src, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+
+    @contextmanager
+    def reading(self):
+        """The shared buffer for one upload, or None once the distribution is closed (read the file instead)"""
+        with self.condition:
+            buffer = self.buffer
+            if buffer is not None:
+                self.readers += 1
+        try:
+            yield buffer
+        finally:
+            if buffer is not None:
+                with self.condition:
+                    self.readers -= 1
+                    if self.closed and not self.readers:
+                        self._unmap()
+
+    def close(self):
+        """Unmap the source as soon as no upload is reading it"""
+        with self.condition:
+            self.closed = True
+            if not self.readers:
+                self._unmap()
+
+    def _unmap(self):
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+        self.buffer = None
+
+    def add_seed(self, host, user, password, path):
+        with self.condition:
+            self.seeds.setdefault(host, {"user": user, "password": password, "path": path, "slots": set()})
+            self.condition.notify_all()
+
+    def drop_seed(self, host):
+        with self.condition:
+            self.seeds.pop(host, None)
+            self.condition.notify_all()
+
+    def acquire_source(self, host):
+        """
+        Block until a source is free for host. Returns (peer, slot) for a relaying
+        seed, or (None, None) when the controller should send the file itself.
+        Seeds are preferred so the controller uplink only feeds the top of the tree.
+        """
+        with self.condition:
+            while True:
+                candidates = [
+                    (len(seed["slots"]), peer) for peer, seed in self.seeds.items()
+                    if peer != host and len(seed["slots"]) < self.fanout
+                ]
+                if candidates:
+                    _, peer = min(candidates)
+                    slots = self.seeds[peer]["slots"]
+                    slot = next(i for i in range(self.fanout) if i not in slots)
+                    slots.add(slot)
+                    return peer, slot
+                if self.controller_slots > 0:
+                    self.controller_slots -= 1
+                    return None, None
+                self.condition.wait()
+
+    def seed_info(self, peer):
+        """(user, password, path) for a seed, or None if it has been dropped"""
+        with self.condition:
+            seed = self.seeds.get(peer)
+            return (seed["user"], seed["password"], seed["path"]) if seed else None
+
+    def release_source(self, peer, slot):
+        with self.condition:
+            if peer is None:
+                self.controller_slots += 1
+            elif peer in self.seeds:
+                self.seeds[peer]["slots"].discard(slot)
+            self.condition.notify_all()
+
+# Active distributions keyed by source path; a new file version replaces the old one
+_distributions = {}
+_distributions_lock = threading.Lock()
+
+def get_distribution(src, local_sum, fanout):
+    key = os.path.abspath(src)
+    with _distributions_lock:
+        checksum, distribution = _distributions.get(key, (None, None))
+        if checksum != local_sum:
+            if distribution is not None:
+                distribution.close()
+            distribution = Distribution(src, fanout)
+            _distributions[key] = (local_sum, distribution)
+        return distribution
+
+def relay_upload(distribution, peer, slot, host, user, password, temp_dest, local_sum, executor,
+                 become, port, timeout):
+    """
+    Have seed `peer` serve its copy of the file straight to host. Returns True
+    when host received a verified copy at temp_dest.
+    """
+    seed = distribution.seed_info(peer)
+    if seed is None:
+        return False
+    peer_user, peer_password, peer_path = seed
+    sudo = "sudo " if become else ""
+    served = {}
+    # Only the receiver told this token may fetch the file from the peer
+    token = relay.new_token().encode() + b"\n"
+
+    def send_token(stdin):
+        stdin.write(token)
+
+    def serve():
+        served.update(executor.run_command_with_input(
+            peer, peer_user, peer_password, sudo + relay.serve_command(peer_path, peer, port + slot, timeout),
+            send_token))
+
+    server = threading.Thread(target=serve, daemon=True)
+    server.start()
+    received = executor.run_command_with_input(host, user, password,
+                                               relay.receive_command(peer, port + slot, temp_dest, timeout),
+                                               send_token)
+    server.join(timeout + 5)
+
+    if received.get("error") or received.get("output", "").strip() != local_sum:
+        if served.get("error") or "SERVED" not in served.get("output", ""):
+            # The peer could not serve; stop handing it new children
+            distribution.drop_seed(peer)
+        return False
+    return True
+
+def distribute_upload(distribution, host, user, password, src, temp_dest, local_sum, executor, become,
+                      transfer_window, args):
+    """
+    Send src to host as part of a fan-out: from a seeded peer when relaying is
+    enabled and one is free, otherwise from the controller's shared buffer.
+    Returns a short description of where the bytes came from.
+    """
+    if not args.get("relay", False):
+        with distribution.reading() as buffer:
+            sftp_upload(host, user, password, src, temp_dest, executor, transfer_window, buffer=buffer)
+        return "controller"
+
+    port = int(args.get("relay_port", DEFAULT_RELAY_PORT))
+    timeout = int(args.get("relay_timeout", DEFAULT_RELAY_TIMEOUT))
+    peer, slot = distribution.acquire_source(host)
+    try:
+        if peer is not None and relay_upload(distribution, peer, slot, host, user, password, temp_dest,
+                                             local_sum, executor, become, port, timeout):
+            return f"relayed from {peer}"
+        with distribution.reading() as buffer:
+            sftp_upload(host, user, password, src, temp_dest, executor, transfer_window, buffer=buffer)
+        return "controller"
+    finally:
+        distribution.release_source(peer, slot)
+
+class CountingWriter:
+    """File-like wrapper that counts bytes written through it"""
+    def __init__(self, target):
+        self.target = target
+        self.bytes_written = 0
+
+    def write(self, data):
+        self.target.write(data)
+        self.bytes_written += len(data)
+        return len(data)
+
+    def flush(self):
+        self.target.flush()
+
+def local_manifest(src):
+    """
+    Map every regular file and symlink below src (relative path) to its sha256,
+    or "link:<target>" for a symlink, which is synced as a link and never followed.
+    """
+    manifest = {}
+    for root, dirs, files in os.walk(src):
+        dirs.sort()
+        # os.walk lists links to directories with the directories but doesn't descend into them
+        for name in sorted(files + [d for d in dirs if os.path.islink(os.path.join(root, d))]):
+            path = os.path.join(root, name)
+            rel = os.path.relpath(path, src).replace(os.sep, "/")
+            if os.path.islink(path):
+                manifest[rel] = f"link:{os.readlink(path)}"
+            elif os.path.isfile(path):
+                manifest[rel] = local_checksum(path)
+    return manifest
+
+def remote_manifest(host, user, password, dest, executor, become):
+    """Fetch {relative path: sha256 or "link:<target>"} for the remote directory in one round trip"""
+    quoted = shlex.quote(dest)
+    script = (f"if [ -d {quoted} ]; then cd {quoted} && find . -type f -exec sha256sum {{}} + && "
+              "find . -type l -exec sh -c 'for l; do printf \"link:%s  %s\\n\" \"$(readlink \"$l\")\" \"$l\"; "
+              "done' sh {} +; fi")
+    cmd = f"sudo sh -c {shlex.quote(script)}" if become else script
+    result = executor.run_command(host, user, password, cmd, bounded=False)
+    if result.get("error"):
+        return None, result
+    manifest = {}
+    for line in result.get("output", "").splitlines():
+        checksum, _, path = line.partition("  ")
+        if path.startswith("./"):
+            manifest[path[2:]] = checksum
+    return manifest, None
+
+def copy_directory(host, user, password, src, dest, args, executor, become):
+    """
+    Sync a local directory tree to dest: diff local and remote manifests, then
+    stream only new or changed files as a single tar over one channel.
+    """
+    mode = args.get("mode")
+    owner = args.get("owner")
+    group = args.get("group")
+    delete = args.get("delete", False)
+
+    local = local_manifest(src)
+    remote, error_result = remote_manifest(host, user, password, dest, executor, become)
+    if error_result:
+        return error_result
+
+    to_send = [rel for rel, checksum in local.items() if remote.get(rel) != checksum]
+    to_delete = sorted(set(remote) - set(local)) if delete else []
+
+    if not to_send and not to_delete:
+        return {"host": host, "output": f"Directory already up-to-date ({len(local)} files), skipping copy",
+                "error": "", "changed": False}
+
+    quoted_dest = shlex.quote(dest)
+    commands = [f"mkdir -p {quoted_dest}", f"cd {quoted_dest}"]
+    if to_send:
+        # Ownership and modes come from owner/group/mode, not from the controller's files
+        commands.append("tar --no-same-owner --no-same-permissions -xf -")
+        # chmod would follow a link to whatever it points at
+        files_sent = [rel for rel in to_send if not local[rel].startswith("link:")]
+        if mode and files_sent:
+            commands.append(f"chmod {mode} -- {' '.join(shlex.quote(rel) for rel in files_sent)}")
+    if to_delete:
+        commands.append(f"rm -f -- {' '.join(shlex.quote(rel) for rel in to_delete)}")
+    if owner or group:
+        commands.append(f"chown -R {owner or ''}:{group or ''} .")
+
+    counter = None
+
+    def send_tar(stdin):
+        nonlocal counter
+        counter = CountingWriter(stdin)
+        with tarfile.open(fileobj=counter, mode="w|") as tar:
+            for rel in to_send:
+                tar.add(os.path.join(src, rel), arcname=rel, recursive=False)
+
+    command = " && ".join(commands)
+    if become:
+        command = f"sudo sh -c {shlex.quote(command)}"
+    if to_send:
+        result = executor.run_command_with_input(host, user, password, command, send_tar)
+    else:
+        result = executor.run_command(host, user, password, command)
+    if result.get("error"):
+        return result
+
+    return {
+        "host": host,
+        "output": f"Synced '{src}' to '{dest}': {len(to_send)} sent, {len(to_delete)} deleted, "
+                  f"{len(local) - len(to_send)} unchanged",
+        "error": "",
+        "changed": True,
+        "files_sent": to_send,
+        "files_deleted": to_delete,
+        "bytes_sent": counter.bytes_written if counter else 0
+    }
+
 def run(host, user, password, args, executor, become=False):
     src = args.get("src")
     dest = args.get("dest")
     mode = args.get("mode")
     owner = args.get("owner")
     group = args.get("group")
+    transfer_window = int(args["transfer_window"]) if args.get("transfer_window") else None
+    use_delta = args.get("delta", False)
 
     result = {
         "host": host,
@@ -31,62 +453,81 @@ def run(host, user, password, args, executor, become=False):
         result["error"] = f"Source file '{src}' does not exist"
         return result
 
-    import hashlib
-    def local_checksum(filepath):
-        h = hashlib.sha256()
-        with open(filepath, "rb") as f:
-            h.update(f.read())
-        return h.hexdigest()
-        
+    if os.path.isdir(src):
+        return copy_directory(host, user, password, src, dest, args, executor, become)
+
     local_sum = local_checksum(src)
 
     remote_sum = file_checksum(host, user, password, dest, executor)
 
+    distribution = None
+    if args.get("distribute", False):
+        fanout = max(1, int(args.get("relay_fanout", DEFAULT_RELAY_FANOUT)))
+        distribution = get_distribution(src, local_sum, fanout)
+
     if remote_sum == local_sum:
+        if distribution:
+            distribution.add_seed(host, user, password, dest)
         return {"host": host, "output": "File already up-to-date, skipping copy", "error": ""}
 
 
-    temp_dest = f"/tmp/{os.path.basename(dest)}"
+    temp_dest = temp_path(dest)
+    file_size = os.path.getsize(src)
+    bytes_sent = None
 
     try:
-        transport = paramiko.Transport((host, 22))
-        transport.connect(username=user, password=password)
-        sftp = paramiko.SFTPClient.from_transport(transport)
-        sftp.put(src, temp_dest)
-        sftp.close()
-        transport.close()
-        result["output"] = f"Copied '{src}' to '{dest}'"
+        if distribution:
+            source = distribute_upload(distribution, host, user, password, src, temp_dest, local_sum,
+                                       executor, become, transfer_window, args)
+            # bytes_sent counts the controller's uplink; relayed copies cost it nothing
+            bytes_sent = file_size if source == "controller" else 0
+            result["output"] = f"Copied '{src}' to '{dest}' ({source})"
+        else:
+            # Delta mode only pays off when there is an old copy to diff against
+            if use_delta and remote_sum is not None:
+                bytes_sent = delta_upload(host, user, password, src, dest, temp_dest, local_sum, executor,
+                                          become, transfer_window, args.get("delta_block_size"),
+                                          float(args.get("delta_threshold", delta.DEFAULT_MAX_LITERAL_RATIO)))
+            if bytes_sent is None:
+                sftp_upload(host, user, password, src, temp_dest, executor, transfer_window)
+                bytes_sent = file_size
+                result["output"] = f"Copied '{src}' to '{dest}'"
+            else:
+                result["output"] = f"Copied '{src}' to '{dest}' (delta: sent {bytes_sent} of {file_size} bytes)"
     except Exception as e:
         result["error"] = f"SFTP copy failed: {e}"
         return result
 
-    # Move file from temp to final destination with sudo
-    mv_cmd = f"mv {temp_dest} {dest}"
-    if become:
-        mv_cmd = f"sudo {mv_cmd}"
-    mv_result = executor.run_command(host, user, password, mv_cmd)
-    result["output"] += f"\n{mv_result.get('output', '')}"
-    if mv_result.get("error"):
-        result["error"] += f"\nmove error: {mv_result['error']}"
+    result["changed"] = True
+    result["bytes_sent"] = bytes_sent
+    result["bytes_total"] = file_size
 
-    # Set permissions if specified
-    if mode:
-        cmd = f"chmod {mode} {dest}"
-        if become:
-            cmd = f"sudo {cmd}"
-        chmod_result = executor.run_command(host, user, password, cmd)
-        result["output"] += f"\n{chmod_result.get('output', '')}"
-        if chmod_result.get("error"):
-            result["error"] += f"\nchmod error: {chmod_result['error']}"
+    # Move into place and apply mode/ownership in one round trip
+    finalize_result = executor.run_command(host, user, password,
+                                           finalize_command(temp_dest, dest, mode, owner, group, become))
+    if finalize_result.get("output"):
+        result["output"] += f"\n{finalize_result['output']}"
+    if finalize_result.get("error"):
+        result["error"] = f"Failed to finalize '{dest}': {finalize_result['error']}"
 
-    if owner or group:
-        chown_str = f"{owner or ''}:{group or ''}"
-        cmd = f"chown {chown_str} {dest}"
-        if become:
-            cmd = f"sudo {cmd}"
-        chown_result = executor.run_command(host, user, password, cmd)
-        result["output"] += f"\n{chown_result.get('output', '')}"
-        if chown_result.get("error"):
-            result["error"] += f"\nchown error: {chown_result['error']}"
+    # Only a host holding the finished file may relay it to others
+    if distribution and not result["error"]:
+        distribution.add_seed(host, user, password, dest)
 
     return result
+
+def cleanup():
+    """End of run: unmap distributed sources and remove the cached delta files"""
+    with _distributions_lock:
+        distributions = [distribution for _, distribution in _distributions.values()]
+        _distributions.clear()
+    for distribution in distributions:
+        distribution.close()
+    with _delta_lock:
+        paths = [path for path in _delta_cache.values() if path]
+        _delta_cache.clear()
+    for path in paths:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
@@ -1,53 +1,310 @@
-from utils.sudo import sudo_wrap
+import base64
+import hashlib
+import shlex
+
+FILE_MARKER = "---FILE---"
+STATES = ("file", "directory", "absent", "link", "touch")
+
+# Prints one line per path: MISSING, or type, mode, owner, group, link target and (optionally) sha256.
+# Type and attributes are those of a symlink's target (as `[ -f ]`, chmod and chown see them), or of the
+# link itself when it dangles.
+PROBE_FUNCTION = (
+    "probe() { if [ -L \"$1\" ] || [ -e \"$1\" ]; then "
+    "printf '%s\\t%s' \"$(stat -L --printf '%F\\t%a\\t%U\\t%G' -- \"$1\" 2>/dev/null || "
+    "stat --printf '%F\\t%a\\t%U\\t%G' -- \"$1\")\" \"$(readlink -- \"$1\")\"; "
+    "if [ -n \"$2\" ] && [ -f \"$1\" ]; then "
+    "printf '\\t%s' \"$(sha256sum -- \"$1\" | cut -d' ' -f1)\"; fi; echo; "
+    "else echo MISSING; fi; }"
+)
+
+def _file_specs(args):
+    """Normalize the single-path and `files:` forms into a list of per-path specs"""
+    defaults = {key: value for key, value in args.items() if key != "files"}
+    files = args.get("files")
+    if files is None:
+        return [defaults]
+    if not isinstance(files, list):
+        raise ValueError("files must be a list")
+    specs = []
+    for entry in files:
+        if isinstance(entry, str):
+            entry = {"path": entry}
+        if not isinstance(entry, dict):
+            raise ValueError(f"Invalid files entry: {entry!r}")
+        specs.append({**defaults, **entry})
+    return specs
+
+def _content_bytes(content):
+    # Matches what `echo` used to write, so files created by older runs stay unchanged
+    content = str(content)
+    return (content if content.endswith("\n") else content + "\n").encode("utf-8")
+
+def _as_root(script, become):
+    return f"sudo sh -c {shlex.quote(script)}" if become else script
+
+def _probe(host, user, password, specs, executor, become):
+    """Stat every path in one round trip. Returns (list of stat dicts or None, error_result)"""
+    # The second argument asks for a checksum, only needed when content is managed
+    calls = []
+    for spec in specs:
+        want_checksum = "1" if spec.get("content") is not None else "''"
+        calls.append(f"probe {shlex.quote(spec['path'])} {want_checksum}")
+    script = f"{PROBE_FUNCTION}; " + "; ".join(calls)
+    result = executor.run_command(host, user, password, _as_root(script, become), bounded=False)
+    lines = result.get("output", "").splitlines()
+    if result.get("error") and len(lines) != len(specs):
+        return None, result
+
+    stats = []
+    for line in lines:
+        if line == "MISSING":
+            stats.append(None)
+            continue
+        fields = line.split("\t") + [""] * 6
+        stats.append({
+            "type": fields[0],
+            "mode": fields[1],
+            "owner": fields[2],
+            "group": fields[3],
+            "link": fields[4],
+            "checksum": fields[5]
+        })
+    if len(stats) != len(specs):
+        return None, {"host": host, "output": result.get("output", ""),
+                      "error": "Unexpected output from file probe"}
+    return stats, None
+
+def _mode_differs(current_mode, mode):
+    try:
+        return int(str(current_mode), 8) != int(str(mode), 8)
+    except ValueError:
+        # Symbolic modes (u+x) can't be compared locally; let chmod decide
+        return True
+
+def _plan(spec, current):
+    """
+    Work out the commands needed to bring one path into the desired state.
+    Returns (commands, actions) where actions describe each change.
+    """
+    path = spec["path"]
+    quoted = shlex.quote(path)
+    state = spec.get("state", "file")
+    mode = spec.get("mode")
+    owner = spec.get("owner")
+    group = spec.get("group")
+    content = spec.get("content")
+    src = spec.get("src")
+    commands, actions = [], []
+    exists = current is not None
+
+    if state == "absent":
+        if exists:
+            commands.append(f"rm -rf -- {quoted}")
+            actions.append("removed")
+        return commands, actions
 
-def run(host, user, password, args, executor, become=False):
-    """Idempotent file module for creating files, directories, symlinks"""
-    
-    path = args.get("path")
-    if not path:
-        return {"host": host, "output": "", "error": "Path is required for file module"}
-    
-    state = args.get("state", "file")
-    mode = args.get("mode")
-    owner = args.get("owner")
-    group = args.get("group")
-    content = args.get("content")
-    src = args.get("src")  # For symlinks
-    
-    commands = []
-
-    # Base condition checks for idempotency
     if state == "directory":
-        commands.append(f"test -d {path} || mkdir -p {path}")
-    elif state == "file":
-        if content:
-            # Only update if content differs
-            commands.append(f"echo '{content}' | cmp -s - {path} || echo '{content}' > {path}")
-        else:
-            commands.append(f"test -f {path} || touch {path}")
-    elif state == "absent":
-        commands.append(f"test ! -e {path} || rm -rf {path}")
+        if not exists:
+            commands.append(f"mkdir -p -- {quoted}")
+            actions.append("created directory")
+        elif current["type"] != "directory":
+            raise ValueError(f"{path} exists and is not a directory")
     elif state == "link":
         if not src:
-            return {"host": host, "output": "", "error": "src is required for symlink"}
-        commands.append(f"test -L {path} && [ \"$(readlink {path})\" = \"{src}\" ] || ln -sf {src} {path}")
+            raise ValueError("src is required for symlink")
+        # Only a symlink has a link target, whatever type it resolves to
+        if not exists or current["link"] != str(src):
+            commands.append(f"ln -sfn -- {shlex.quote(str(src))} {quoted}")
+            actions.append(f"linked to {src}")
+        # Attributes of a link are those of its target; leave them alone
+        return commands, actions
+    elif state == "touch":
+        commands.append(f"touch -- {quoted}")
+        actions.append("touched")
+    elif content is not None:
+        data = _content_bytes(content)
+        if not exists or hashlib.sha256(data).hexdigest() != current["checksum"]:
+            encoded = base64.b64encode(data).decode()
+            commands.append(f"printf '%s' {encoded} | base64 -d > {quoted}")
+            actions.append("content updated" if exists else "created file")
+    elif not exists:
+        commands.append(f"touch -- {quoted}")
+        actions.append("created file")
+    elif not current["type"].startswith("regular"):
+        raise ValueError(f"{path} exists and is not a regular file")
+
+    created = not exists
+    if mode is not None and (created or _mode_differs(current["mode"], mode)):
+        commands.append(f"chmod {mode} -- {quoted}")
+        actions.append(f"mode {mode}")
+    if owner and (created or current["owner"] != str(owner)):
+        commands.append(f"chown {owner} -- {quoted}")
+        actions.append(f"owner {owner}")
+    if group and (created or current["group"] != str(group)):
+        commands.append(f"chgrp {group} -- {quoted}")
+        actions.append(f"group {group}")
+    return commands, actions
+
+def _octal_mode(mode):
+    try:
+        return format(int(str(mode), 8), "o")
+    except ValueError:
+        return None
+
+def _ensure_script(spec, index):
+    """
+    Check-and-fix shell for one path, used when the task is pipelined and no
+    probe round trip is made. Prints a FILE_MARKER line when it changes anything.
+    """
+    path = spec["path"]
+    quoted = shlex.quote(path)
+    state = spec.get("state", "file")
+    mode = spec.get("mode")
+    owner = spec.get("owner")
+    group = spec.get("group")
+    content = spec.get("content")
+    src = spec.get("src")
+    mark = f"echo '{FILE_MARKER} {index} changed'"
+    exists = f"{{ [ -e {quoted} ] || [ -L {quoted} ]; }}"
+
+    def not_a(kind):
+        return f"{{ echo {shlex.quote(f'{path} exists and is not a {kind}')} >&2; false; }}"
+
+    if state == "absent":
+        return f"if {exists}; then rm -rf -- {quoted} && {mark}; fi"
+    if state == "link":
+        if not src:
+            raise ValueError("src is required for symlink")
+        target = shlex.quote(str(src))
+        return f"[ \"$(readlink -- {quoted})\" = {target} ] || {{ ln -sfn -- {target} {quoted} && {mark}; }}"
+
+    if state == "directory":
+        steps = [f"if ! {exists}; then mkdir -p -- {quoted} && {mark}; elif [ ! -d {quoted} ]; then {not_a('directory')}; fi"]
+    elif state == "touch":
+        steps = [f"touch -- {quoted} && {mark}"]
+    elif content is not None:
+        data = _content_bytes(content)
+        encoded = base64.b64encode(data).decode()
+        steps = [f"if [ ! -f {quoted} ] || [ \"$(sha256sum < {quoted} | cut -d' ' -f1)\" != "
+                 f"{hashlib.sha256(data).hexdigest()} ]; then printf '%s' {encoded} | base64 -d > {quoted} && {mark}; fi"]
     else:
-        return {"host": host, "output": "", "error": f"Unknown state '{state}' for file module"}
-
-    # Permissions and ownership (only if not absent)
-    if state != "absent":
-        if mode:
-            commands.append(f"test \"$(stat -c %a {path})\" = \"{mode}\" || chmod {mode} {path}")
-        
-        if owner:
-            commands.append(f"test \"$(stat -c %U {path})\" = \"{owner}\" || chown {owner} {path}")
-        if group:
-            commands.append(f"test \"$(stat -c %G {path})\" = \"{group}\" || chgrp {group} {path}")
-    
-    
-    if become:
-        commands = [sudo_wrap(cmd) for cmd in commands]
-
-    full_command = " && ".join(commands)
-    
-    return executor.run_command(host, user, password, full_command)
+        steps = [f"if ! {exists}; then touch -- {quoted} && {mark}; elif [ ! -f {quoted} ]; then {not_a('regular file')}; fi"]
+
+    if mode is not None:
+        # Symbolic modes can't be compared, so chmod always runs for them
+        current = _octal_mode(mode)
+        check = f"[ \"$(stat -L -c %a -- {quoted})\" = {current} ] || " if current else ""
+        steps.append(f"{check}{{ chmod {mode} -- {quoted} && {mark}; }}")
+    if owner:
+        steps.append(f"[ \"$(stat -L -c %U -- {quoted})\" = {shlex.quote(str(owner))} ] || "
+                     f"{{ chown {owner} -- {quoted} && {mark}; }}")
+    if group:
+        steps.append(f"[ \"$(stat -L -c %G -- {quoted})\" = {shlex.quote(str(group))} ] || "
+                     f"{{ chgrp {group} -- {quoted} && {mark}; }}")
+    return " && ".join(f"{{ {step}; }}" for step in steps)
+
+def build_command(args, become=False):
+    """
+    One self-checking script for every path, so the task can be pipelined with
+    its neighbours. Each path is handled on its own; the script fails if any did.
+    """
+    specs = _file_specs(args)
+    parts = ["__file_rc=0"]
+    for index, spec in enumerate(specs):
+        if not spec.get("path"):
+            raise ValueError("Path is required for file module")
+        if spec.get("state", "file") not in STATES:
+            raise ValueError(f"Unknown state '{spec['state']}' for file module")
+        parts.append(f"{{ {_ensure_script(spec, index)}; }} || __file_rc=1")
+    parts.append("[ $__file_rc -eq 0 ]")
+    return _as_root("; ".join(parts), become)
+
+def pipeline_result(host, args, result):
+    """Turn the output of a pipelined build_command script into this module's result"""
+    specs = _file_specs(args)
+    changed = set()
+    for line in result.get("output", "").splitlines():
+        if line.startswith(FILE_MARKER):
+            changed.add(int(line.split()[1]))
+    changed_files = [spec["path"] for index, spec in enumerate(specs) if index in changed]
+    if changed_files:
+        output = "\n".join(f"{path}: changed" for path in changed_files)
+    elif not result.get("error"):
+        output = f"{len(specs)} path(s) already in desired state"
+    else:
+        output = ""
+    return {**result, "output": output, "changed": bool(changed_files), "changed_files": changed_files}
+
+def run(host, user, password, args, executor, become=False):
+    """
+    Idempotent file module for creating files, directories, symlinks.
+    Accepts a single `path` or a `files:` list; all paths are stat'd in one
+    round trip and every needed change is applied in one more.
+    """
+    try:
+        specs = _file_specs(args)
+    except ValueError as e:
+        return {"host": host, "output": "", "error": str(e), "changed": False}
+
+    for spec in specs:
+        if not spec.get("path"):
+            return {"host": host, "output": "", "error": "Path is required for file module", "changed": False}
+        if spec.get("state", "file") not in STATES:
+            return {"host": host, "output": "", "error": f"Unknown state '{spec['state']}' for file module",
+                    "changed": False}
+
+    stats, error_result = _probe(host, user, password, specs, executor, become)
+    if error_result:
+        return error_result
+
+    plans = []
+    for spec, current in zip(specs, stats):
+        try:
+            plans.append(_plan(spec, current))
+        except ValueError as e:
+            return {"host": host, "output": "", "error": str(e), "changed": False}
+
+    # Each path's changes run as one unit and report back, so partial failures are attributed correctly
+    steps = []
+    for index, (commands, _) in enumerate(plans):
+        if commands:
+            steps.append(f"if {' && '.join(commands)}; then echo '{FILE_MARKER} {index} ok'; "
+                         f"else echo '{FILE_MARKER} {index} failed'; fi")
+
+    if not steps:
+        return {
+            "host": host,
+            "output": f"{len(specs)} path(s) already in desired state",
+            "error": "",
+            "changed": False,
+            "changed_files": []
+        }
+
+    result = executor.run_command(host, user, password, _as_root("; ".join(steps), become), bounded=False)
+
+    applied = set()
+    for line in result.get("output", "").splitlines():
+        if line.startswith(FILE_MARKER):
+            _, index, status = line.split()
+            if status == "ok":
+                applied.add(int(index))
+
+    changed_files = []
+    output = []
+    for index, (spec, (commands, actions)) in enumerate(zip(specs, plans)):
+        if not commands:
+            continue
+        if index in applied:
+            changed_files.append(spec["path"])
+            output.append(f"{spec['path']}: {', '.join(actions)}")
+        else:
+            output.append(f"{spec['path']}: failed ({', '.join(actions)})")
+
+    failed = len(applied) < len(steps)
+    return {
+        "host": host,
+        "output": "\n".join(output),
+        "error": (result.get("error") or result.get("stderr") or "Some file changes failed") if failed else "",
+        "changed": bool(changed_files),
+        "changed_files": changed_files
+    }
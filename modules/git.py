@@ -14,9 +14,6 @@ def run(host, user, password, args, executor, become=False):
     
     commands = []
     
-    # Check if git is installed
-    commands.append("which git || echo 'Git not installed' && exit 1")
-    
     # Clone or update repository
     if force:
         commands.append(f"rm -rf {dest}")
@@ -34,6 +31,9 @@ def run(host, user, password, args, executor, become=False):
     if become:
         commands = [sudo_wrap(cmd) for cmd in commands]
 
+    # Check if git is installed (no sudo needed, so it stays out of sudo_wrap)
+    commands.insert(0, "{ command -v git >/dev/null || { echo 'Git not installed' >&2; exit 1; }; }")
+
     full_command = " && ".join(commands)
     
     return executor.run_command(host, user, password, full_command)
@@ -0,0 +1,126 @@
+"""
+Ensure a line is present in (or absent from) a file.
+
+This is a payload module: main() runs on the target under python3 and only
+uses the standard library, so reading the file, deciding and rewriting it
+take one round trip.
+"""
+import os
+import re
+import tempfile
+
+def _find(lines, pattern):
+    """Index of the last line matching pattern, or None"""
+    matches = [index for index, line in enumerate(lines) if pattern.search(line)]
+    return matches[-1] if matches else None
+
+def _write(path, lines, mode=None):
+    # Replace atomically so readers never see a half-written file
+    directory = os.path.dirname(path) or "."
+    fd, temp = tempfile.mkstemp(dir=directory, prefix=".lineinfile.")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.writelines(lines)
+        if os.path.exists(path):
+            current = os.stat(path)
+            os.chmod(temp, current.st_mode & 0o7777)
+            try:
+                os.chown(temp, current.st_uid, current.st_gid)
+            except PermissionError:
+                pass
+        else:
+            # mkstemp creates 0600; a new file gets the usual 0666 & ~umask
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(temp, 0o666 & ~umask)
+        if mode is not None:
+            os.chmod(temp, int(str(mode), 8))
+        os.replace(temp, path)
+    except BaseException:
+        os.unlink(temp)
+        raise
+
+def _apply_mode(path, mode):
+    """Set mode on an unchanged file. Returns True if it was different"""
+    wanted = int(str(mode), 8)
+    if os.stat(path).st_mode & 0o7777 == wanted:
+        return False
+    os.chmod(path, wanted)
+    return True
+
+def main(args):
+    path = args.get("path")
+    if not path:
+        return {"failed": True, "error": "path is required for lineinfile module"}
+    line = args.get("line")
+    regexp = args.get("regexp")
+    state = args.get("state", "present")
+    insertafter = args.get("insertafter")
+    insertbefore = args.get("insertbefore")
+    create = args.get("create", False)
+    mode = args.get("mode")
+
+    if state not in ("present", "absent"):
+        return {"failed": True, "error": f"Unknown state '{state}' for lineinfile module"}
+    if state == "present" and line is None:
+        return {"failed": True, "error": "line is required with state=present"}
+    if state == "absent" and line is None and regexp is None:
+        return {"failed": True, "error": "line or regexp is required with state=absent"}
+    if mode is not None and not re.fullmatch(r"[0-7]{3,4}", str(mode)):
+        return {"failed": True, "error": f"Invalid mode '{mode}' for lineinfile module (use octal, e.g. '0644')"}
+
+    def unchanged(msg):
+        # The content is right, but mode still applies to an existing file
+        if mode is not None and os.path.exists(path) and _apply_mode(path, mode):
+            return {"changed": True, "msg": f"{msg}, mode changed"}
+        return {"changed": False, "msg": msg}
+
+    if os.path.exists(path):
+        with open(path) as f:
+            lines = f.readlines()
+    elif state == "absent":
+        return {"changed": False, "msg": f"{path} does not exist"}
+    elif not create:
+        return {"failed": True, "error": f"{path} does not exist (set create: true to create it)"}
+    else:
+        lines = []
+
+    if state == "absent":
+        pattern = re.compile(regexp) if regexp else None
+        kept = [l for l in lines if not (pattern.search(l) if pattern else l.rstrip("\n") == line)]
+        if len(kept) == len(lines):
+            return unchanged("line not present")
+        _write(path, kept, mode)
+        return {"changed": True, "msg": f"{len(lines) - len(kept)} line(s) removed", "removed": len(lines) - len(kept)}
+
+    new_line = line + "\n"
+    index = _find(lines, re.compile(regexp)) if regexp else None
+    if index is None:
+        index = next((i for i, l in enumerate(lines) if l.rstrip("\n") == line), None)
+    if index is not None:
+        if lines[index] == new_line:
+            return unchanged("line already present")
+        lines[index] = new_line
+        _write(path, lines, mode)
+        return {"changed": True, "msg": "line replaced"}
+
+    # Not found: insert relative to a marker line, or append
+    position = len(lines)
+    if insertbefore == "BOF":
+        position = 0
+    elif insertbefore:
+        found = _find(lines, re.compile(insertbefore))
+        position = found if found is not None else position
+    elif insertafter and insertafter != "EOF":
+        found = _find(lines, re.compile(insertafter))
+        position = found + 1 if found is not None else position
+    if position > 0 and not lines[position - 1].endswith("\n"):
+        lines[position - 1] += "\n"
+    lines.insert(position, new_line)
+    _write(path, lines, mode)
+    return {"changed": True, "msg": "line added"}
+
+def run(host, user, password, args, executor, become=False):
+    # Imported here: this file is also shipped to the target, where core isn't available
+    from core.payload import run_payload
+    return run_payload(host, user, password, __file__, args, executor, become)
@@ -1,12 +1,19 @@
-def run(host, user, password, args, executor, become=False):
+def build_command(args, become=False):
     service = args.get("name")
     state = args.get("state")
 
     if state not in ["start", "stop", "restart"]:
-        return {"error": f"Invalid state '{state}' for service module"}
+        raise ValueError(f"Invalid state '{state}' for service module")
 
     command = f"systemctl {state} {service}"
 
     if become:
         command = f"sudo {command}"
+    return command
+
+def run(host, user, password, args, executor, become=False):
+    try:
+        command = build_command(args, become)
+    except ValueError as e:
+        return {"error": str(e)}
     return executor.run_command(host, user, password, command)
@@ -1,13 +1,21 @@
-def run(host, user, password, args, executor, become=False):
+def build_command(args, become=False):
+    """The command this task runs; also used to pipeline it with neighbouring tasks"""
     command = args.get("cmd")
     if not command:
+        raise ValueError("Missing 'cmd' argument for shell module")
+    
+    if become:
+        command = f"sudo {command}"
+    return command
+
+def run(host, user, password, args, executor, become=False):
+    try:
+        command = build_command(args, become)
+    except ValueError as e:
         return {
             "host": host,
             "output": "",
-            "error": "Missing 'cmd' argument for shell module"
+            "error": str(e)
         }
-    
-    if become:
-        command = f"sudo {command}"
 
     return executor.run_command(host, user, password, command)
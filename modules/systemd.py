@@ -1,11 +1,11 @@
 from utils.sudo import sudo_wrap
 
-def run(host, user, password, args, executor, become=False):
-    """Systemd module for service management"""
+def build_command(args, become=False):
+    """Build the systemctl command line; raises ValueError for incomplete args"""
     
     name = args.get("name")
     if not name:
-        return {"host": host, "output": "", "error": "Service name is required"}
+        raise ValueError("Service name is required")
     
     state = args.get("state")
     enabled = args.get("enabled")
@@ -33,11 +33,18 @@ def run(host, user, password, args, executor, become=False):
             commands.append(f"systemctl disable {name}")
     
     if not commands:
-        return {"host": host, "output": "", "error": "No action specified for systemd module"}
+        raise ValueError("No action specified for systemd module")
     
     if become:
         commands = [sudo_wrap(cmd) for cmd in commands]
 
-    full_command = " && ".join(commands)
+    return " && ".join(commands)
+
+def run(host, user, password, args, executor, become=False):
+    """Systemd module for service management"""
+    try:
+        full_command = build_command(args, become)
+    except ValueError as e:
+        return {"host": host, "output": "", "error": str(e)}
     
     return executor.run_command(host, user, password, full_command)
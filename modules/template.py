@@ -1,36 +1,114 @@
-from utils.sudo import sudo_wrap
+import hashlib
+import json
+import os
+import threading
+import jinja2
+import jinja2.meta
+from modules.copy import file_checksum, finalize_command, temp_path
+
+# Rendered outputs kept per template version before the oldest are dropped
+MAX_RENDERED_PER_TEMPLATE = 1024
+
+# Parsed templates: path -> (version, render function, referenced variable names)
+_parsed = {}
+# Rendered bytes: (path, version) -> {referenced variable values: (content, sha256)}
+_rendered = {}
+_render_locks = {}
+_cache_lock = threading.Lock()
+
+_jinja_env = jinja2.Environment(keep_trailing_newline=True, undefined=jinja2.StrictUndefined)
+
+def parse_template(source):
+    """Compile template source. Returns (render(variables) -> str, names of referenced variables)"""
+    names = jinja2.meta.find_undeclared_variables(_jinja_env.parse(source))
+    template = _jinja_env.from_string(source)
+    return template.render, frozenset(names)
+
+def get_template(path):
+    """Parsed template for path, re-parsed only when the file changes"""
+    stat = os.stat(path)
+    version = (stat.st_mtime_ns, stat.st_size)
+    path = os.path.abspath(path)
+    with _cache_lock:
+        cached = _parsed.get(path)
+        if cached and cached[0] == version:
+            return cached
+    with open(path, "r", encoding="utf-8") as f:
+        render, names = parse_template(f.read())
+    with _cache_lock:
+        _parsed[path] = (version, render, names)
+        # Outputs of older versions can never be served again
+        for key in [key for key in _rendered if key[0] == path and key[1] != version]:
+            del _rendered[key]
+        return _parsed[path]
+
+def render_cached(path, variables):
+    """
+    Render the template at path, returning (content bytes, sha256). Hosts whose
+    referenced variables have the same values share one render.
+    """
+    version, render, names = get_template(path)
+    template_key = (os.path.abspath(path), version)
+    values_key = json.dumps(
+        [[name, name in variables, variables.get(name)] for name in sorted(names)], sort_keys=True, default=str
+    )
+    key = (template_key, values_key)
+
+    with _cache_lock:
+        cached = _rendered.get(template_key, {}).get(values_key)
+        if cached:
+            return cached
+        render_lock = _render_locks.setdefault(key, threading.Lock())
+
+    # Hosts with the same variables wait for the first render instead of repeating it
+    with render_lock:
+        with _cache_lock:
+            cached = _rendered.get(template_key, {}).get(values_key)
+            if cached:
+                return cached
+        try:
+            content = render(variables).encode("utf-8")
+            cached = (content, hashlib.sha256(content).hexdigest())
+            with _cache_lock:
+                outputs = _rendered.setdefault(template_key, {})
+                if len(outputs) >= MAX_RENDERED_PER_TEMPLATE:
+                    del outputs[next(iter(outputs))]
+                outputs[values_key] = cached
+        finally:
+            with _cache_lock:
+                _render_locks.pop(key, None)
+    return cached
+
+def run(host, user, password, args, executor, become=False, variables=None):
+    """Render a local template with the task's variables and push it when the remote file differs"""
 
-def run(host, user, password, args, executor, become=False):
-    """Template module - simplified version"""
-    
     src = args.get("src")
     dest = args.get("dest")
-    
+
     if not src or not dest:
         return {"host": host, "output": "", "error": "Both src and dest are required for template module"}
-    
-    #TODO: use jinja2
-    
-    commands = [f"cp {src} {dest}"]
-    
-    mode = args.get("mode")
-    owner = args.get("owner")
-    group = args.get("group")
-    
-    if mode:
-        commands.append(f"chmod {mode} {dest}")
-    
-    if owner:
-        if group:
-            commands.append(f"chown {owner}:{group} {dest}")
-        else:
-            commands.append(f"chown {owner} {dest}")
-    elif group:
-        commands.append(f"chgrp {group} {dest}")
-    
-    if become:
-        commands = [sudo_wrap(cmd) for cmd in commands]
-
-    full_command = " && ".join(commands)
-    
-    return executor.run_command(host, user, password, full_command)
\ No newline at end of file
+
+    if not os.path.isfile(src):
+        return {"host": host, "output": "", "error": f"Template '{src}' does not exist"}
+
+    try:
+        content, checksum = render_cached(src, variables or {})
+    except Exception as e:
+        return {"host": host, "output": "", "error": f"Failed to render template '{src}': {e}"}
+
+    if file_checksum(host, user, password, dest, executor) == checksum:
+        return {"host": host, "output": f"'{dest}' already up-to-date", "error": "", "changed": False}
+
+    temp_dest = temp_path(dest)
+    upload_result = executor.put(host, user, password, None, temp_dest, buffer=content)
+    if upload_result.get("error"):
+        return upload_result
+
+    result = executor.run_command(
+        host, user, password,
+        finalize_command(temp_dest, dest, args.get("mode"), args.get("owner"), args.get("group"), become)
+    )
+    if not result.get("error"):
+        result["output"] = f"Rendered '{src}' to '{dest}'"
+        result["changed"] = True
+    return result
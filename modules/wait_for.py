@@ -1,8 +1,89 @@
+import asyncio
+import random
+import threading
+import shlex
 import time
-import socket
-import subprocess
-import os
-from utils.sudo import sudo_wrap
+
+WAIT_MARKER = "---WAIT---"
+
+class PortWaiter:
+    """
+    One background asyncio loop that multiplexes every pending port check, so
+    waiting hosts cost a coroutine and a socket instead of a worker thread.
+    """
+    def __init__(self):
+        self.loop = None
+        self.lock = threading.Lock()
+
+    def _ensure_loop(self):
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(target=self.loop.run_forever, name="mini-ansible-wait-for", daemon=True).start()
+            return self.loop
+
+    def submit(self, coro):
+        """Schedule coro on the shared loop; returns a concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(coro, self._ensure_loop())
+
+port_waiter = PortWaiter()
+
+async def _port_open(host, port, connect_timeout):
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(host, int(port)), connect_timeout)
+    except (OSError, asyncio.TimeoutError):
+        return False
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        pass
+    return True
+
+async def _wait_for_port(host, check_host, port, state, timeout, delay, connect_timeout, sleep_time, max_sleep):
+    """Poll a port with jittered exponential backoff until it reaches state or timeout expires"""
+    if delay > 0:
+        await asyncio.sleep(delay)
+
+    start_time = time.monotonic()
+    deadline = start_time + timeout
+    attempts = 0
+    while True:
+        attempts += 1
+        port_open = await _port_open(check_host, port, min(connect_timeout, max(deadline - time.monotonic(), 0.1)))
+        elapsed = time.monotonic() - start_time
+
+        if state == "started" and port_open:
+            message = f"Port {port} on {check_host} is open"
+        elif state == "stopped" and not port_open:
+            message = f"Port {port} on {check_host} is closed"
+        elif state == "drained" and port_open:
+            message = f"Port {port} on {check_host} status checked"
+        else:
+            message = None
+
+        if message:
+            return {
+                "host": host,
+                "output": f"{message} (waited {elapsed:.1f}s, {attempts} attempts)",
+                "error": "",
+                "changed": False,
+                "elapsed": round(elapsed, 2)
+            }
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return {
+                "host": host,
+                "output": "",
+                "error": f"Timeout waiting for condition after {timeout} seconds",
+                "changed": False,
+                "elapsed": round(elapsed, 2)
+            }
+
+        # Full jitter keeps thousands of hosts restarting together from probing in lockstep
+        backoff = min(max_sleep, sleep_time * 2 ** (attempts - 1))
+        await asyncio.sleep(min(random.uniform(0, backoff), remaining))
 
 def run(host, user, password, args, executor, become=False):
     """
@@ -12,11 +93,17 @@ def run(host, user, password, args, executor, become=False):
     - host: hostname/IP to check (default: current host)
     - port: port number to check
     - path: file path to check for existence
+    - search_regex: with path, also wait until the file contents match this regex
     - timeout: maximum time to wait in seconds (default: 300)
     - delay: initial delay before starting checks (default: 0)
-    - sleep: time between retries (default: 1)
+    - sleep: time between retries; for ports, the first backoff step (default: 1)
+    - max_sleep: cap for the port backoff (default: 10)
     - state: started/stopped/present/absent/drained (default: started)
     - connect_timeout: timeout for individual connection attempts (default: 5)
+
+    Port checks return a Future resolved by the shared wait loop, so the
+    calling worker thread is free while the host waits. Path checks run as a
+    single loop on the remote side.
     """
     
     # Extract parameters
@@ -25,7 +112,8 @@ def run(host, user, password, args, executor, become=False):
     path = args.get("path")
     timeout = int(args.get("timeout", 300))
     delay = int(args.get("delay", 0))
-    sleep_time = int(args.get("sleep", 1))
+    sleep_time = float(args.get("sleep", 1))
+    max_sleep = float(args.get("max_sleep", 10))
     state = args.get("state", "started")
     connect_timeout = int(args.get("connect_timeout", 5))
     
@@ -38,107 +126,88 @@ def run(host, user, password, args, executor, become=False):
             "changed": False
         }
     
-    # Initial delay
-    if delay > 0:
-        time.sleep(delay)
-    
-    start_time = time.time()
-    
-    while True:
-        current_time = time.time()
-        elapsed = current_time - start_time
-        
-        if elapsed >= timeout:
-            return {
-                "host": host,
-                "output": "",
-                "error": f"Timeout waiting for condition after {timeout} seconds",
-                "changed": False
-            }
-        
-        try:
-            if port:
-                # Check port connectivity
-                result = _check_port(check_host, port, connect_timeout, state)
-            elif path:
-                # Check file/directory existence
-                result = _check_path(host, user, password, path, executor, become, state)
-            
-            if result["success"]:
-                return {
-                    "host": host,
-                    "output": result["message"],
-                    "error": "",
-                    "changed": False,
-                    "elapsed": int(elapsed)
-                }
-                
-        except Exception as e:
-            # Continue trying unless it's the last attempt
-            if elapsed + sleep_time >= timeout:
-                return {
-                    "host": host,
-                    "output": "",
-                    "error": f"Error during wait: {str(e)}",
-                    "changed": False
-                }
-        
-        time.sleep(sleep_time)
-
-def _check_port(host, port, connect_timeout, state):
-    """Check if port is open/closed"""
-    try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(connect_timeout)
-        result = sock.connect_ex((host, int(port)))
-        sock.close()
-        
-        port_open = (result == 0)
-        
-        if state == "started" and port_open:
-            return {"success": True, "message": f"Port {port} on {host} is open"}
-        elif state == "stopped" and not port_open:
-            return {"success": True, "message": f"Port {port} on {host} is closed"}
-        elif state == "drained":
-            # For drained state, we might want to check if connections are being accepted
-            # but existing connections are being closed gracefully
-            # This is a simplified check
-            return {"success": port_open, "message": f"Port {port} on {host} status checked"}
-        else:
-            return {"success": False, "message": f"Port {port} on {host} not in expected state"}
-            
-    except Exception as e:
-        if state == "stopped":
-            # If we can't connect and we want it stopped, that might be success
-            return {"success": True, "message": f"Port {port} on {host} is not accessible (stopped)"}
-        return {"success": False, "message": f"Error checking port: {str(e)}"}
-
-def _check_path(host, user, password, path, executor, become, state):
-    """Check if file/directory exists"""
-    
-    # Use test command to check file existence
-    if state in ["present", "started"]:
-        check_cmd = f"test -e '{path}'"
-        expected_success = True
-    elif state in ["absent", "stopped"]:
-        check_cmd = f"test ! -e '{path}'"
-        expected_success = True
-    else:
-        return {"success": False, "message": f"Unsupported state '{state}' for path checking"}
+    if port:
+        return port_waiter.submit(_wait_for_port(
+            host, check_host, port, state, timeout, delay, connect_timeout, sleep_time, max_sleep
+        ))
     
+    return _wait_for_path(host, user, password, path, executor, become, state, timeout, delay, sleep_time,
+                          args.get("search_regex"))
+
+# search REGEX FILE: Python re semantics (\d, \s, lazy quantifiers, multiline ^/$) via python3 on the
+# target, else grep -P where it is supported, else POSIX grep -E
+SEARCH_FUNCTION = (
+    "if command -v python3 >/dev/null 2>&1; then search() { python3 -c "
+    + shlex.quote("import re, sys\n"
+                  "with open(sys.argv[2], errors='replace') as f:\n"
+                  "    sys.exit(0 if re.search(sys.argv[1], f.read(), re.M) else 1)")
+    + " \"$1\" \"$2\" 2>/dev/null; }; "
+    "elif echo | grep -Pq '' 2>/dev/null; then search() { grep -Pq -- \"$1\" \"$2\"; }; "
+    "else search() { grep -Eq -- \"$1\" \"$2\"; }; fi; "
+)
+
+def _path_wait_script(path, state, timeout, delay, sleep_time, search_regex):
+    """
+    Shell loop that waits for the path condition on the remote side and prints
+    one WAIT_MARKER line. Uses inotifywait on the parent directory when it is
+    installed and plain sleeps otherwise.
+    """
+    quoted = shlex.quote(path)
+    condition = f"[ -e {quoted} ]"
+    matcher = ""
+    if search_regex:
+        condition += f" && search {shlex.quote(str(search_regex))} {quoted}"
+        matcher = SEARCH_FUNCTION
+    if state in ("absent", "stopped"):
+        condition = f"! {{ {condition}; }}"
+    # inotify events can be missed between the check and the watch, so waits are capped anyway
+    watch_cap = max(1, int(sleep_time) * 5)
+    return (
+        f"{matcher}sleep {int(delay)}; start=$(date +%s); deadline=$((start + {int(timeout)})); "
+        f"parent=$(dirname -- {quoted}); "
+        f"if command -v inotifywait >/dev/null 2>&1; then watch=inotify; else watch=poll; fi; "
+        f"while true; do "
+        f"now=$(date +%s); "
+        f"if {condition}; then echo \"{WAIT_MARKER} ok $((now - start)) $watch\"; exit 0; fi; "
+        f"if [ $now -ge $deadline ]; then echo \"{WAIT_MARKER} timeout $((now - start)) $watch\"; exit 0; fi; "
+        f"left=$((deadline - now)); "
+        f"if [ $watch = inotify ] && [ -d \"$parent\" ]; then "
+        f"inotifywait -qq -t $((left < {watch_cap} ? left : {watch_cap})) "
+        f"-e create,moved_to,moved_from,delete,modify,close_write,attrib -- \"$parent\" >/dev/null 2>&1; "
+        f"else sleep {sleep_time}; fi; "
+        f"done"
+    )
+
+def _wait_for_path(host, user, password, path, executor, become, state, timeout, delay, sleep_time, search_regex):
+    """Wait for a path (and optionally a regex in it) in one remote loop over a single channel"""
+    if state not in ("present", "started", "absent", "stopped"):
+        return {"host": host, "output": "", "error": f"Unsupported state '{state}' for path checking",
+                "changed": False}
+
+    script = _path_wait_script(path, state, timeout, delay, sleep_time, search_regex)
     if become:
-        check_cmd = sudo_wrap(check_cmd)
-    
-    result = executor.run_command(host, user, password, check_cmd)
-    
-    # Check exit code (test command returns 0 for true, 1 for false)
-    # We need to determine success based on the command output/error
-    command_succeeded = not result.get("error") or "exit status 0" in result.get("error", "")
-    
-    if command_succeeded == expected_success:
-        if state in ["present", "started"]:
-            return {"success": True, "message": f"Path {path} exists"}
-        else:
-            return {"success": True, "message": f"Path {path} does not exist"}
+        script = f"sudo sh -c {shlex.quote(script)}"
+    result = executor.run_command(host, user, password, script)
+
+    marker = next((line.split() for line in result.get("output", "").splitlines()
+                   if line.startswith(WAIT_MARKER)), None)
+    if not marker or len(marker) != 4:
+        return {"host": host, "output": result.get("output", ""),
+                "error": result.get("error") or "wait_for path loop produced no result", "changed": False}
+
+    _, outcome, waited, watch = marker
+    if outcome != "ok":
+        return {"host": host, "output": "", "error": f"Timeout waiting for condition after {timeout} seconds",
+                "changed": False, "elapsed": int(waited)}
+
+    if state in ("present", "started"):
+        message = f"Path {path} exists" + (f" and matches '{search_regex}'" if search_regex else "")
     else:
-        return {"success": False, "message": f"Path {path} not in expected state"}
\ No newline at end of file
+        message = f"Path {path} does not exist" + (f" or no longer matches '{search_regex}'" if search_regex else "")
+    return {
+        "host": host,
+        "output": f"{message} (waited {waited}s, {watch})",
+        "error": "",
+        "changed": False,
+        "elapsed": int(waited)
+    }
@@ -1,8 +1,54 @@
+import shlex
 from utils.sudo import sudo_wrap
 
+UPDATES_MARKER = "---UPDATES---"
+
+def _probe_packages(host, user, password, packages, executor, check_updates):
+    """
+    Query installed state for every package in one round trip, plus one
+    check-update pass when upgrades matter. Returns (installed, updatable, error_result),
+    both sets of the requested names.
+    """
+    pkg_list = " ".join(shlex.quote(pkg) for pkg in packages)
+    # Each request is queried as given (name.arch, name-version, a capability) and reported back
+    # under that same string, with the name.arch of every package that satisfies it
+    commands = [
+        f"for p in {pkg_list}; do "
+        "if found=$(rpm -q --qf '%{NAME}.%{ARCH} ' \"$p\" 2>/dev/null) || "
+        "found=$(rpm -q --whatprovides --qf '%{NAME}.%{ARCH} ' \"$p\" 2>/dev/null); then "
+        "echo \"installed $p $found\"; fi; done"
+    ]
+    if check_updates:
+        commands.append(f"echo '{UPDATES_MARKER}'")
+        # Exit code 100 just means updates are available
+        commands.append(f"yum -q check-update {pkg_list} 2>/dev/null")
+    commands.append("true")
+
+    result = executor.run_command(host, user, password, "; ".join(commands), bounded=False)
+    if result.get("error"):
+        return None, None, result
+
+    installed_output, _, updates_output = result.get("output", "").partition(UPDATES_MARKER)
+
+    installed = {}  # requested name -> name.arch of the installed packages providing it
+    for line in installed_output.splitlines():
+        fields = line.split()
+        if len(fields) >= 2 and fields[0] == "installed":
+            installed[fields[1]] = set(fields[2:])
+
+    pending = set()
+    for line in updates_output.splitlines():
+        fields = line.split()
+        # "name.arch  version  repo"
+        if len(fields) == 3 and "." in fields[0]:
+            pending.add(fields[0])
+    updatable = {pkg for pkg, provided in installed.items() if provided & pending}
+
+    return set(installed), updatable, None
+
 def run(host, user, password, args, executor, become=False):
-    """YUM module for RedHat/CentOS systems"""
-    
+    """YUM module for RedHat/CentOS systems with idempotent state handling"""
+
     packages = args.get("name")
     if isinstance(packages, str):
         packages = [packages]
@@ -10,32 +56,61 @@ def run(host, user, password, args, executor, become=False):
         pass
     else:
         return {"host": host, "output": "", "error": "Package name must be string or list"}
-    
+
     state = args.get("state", "present")
     update_cache = args.get("update_cache", False)
-    
+
+    if state not in ("present", "absent", "latest"):
+        return {"host": host, "output": "", "error": f"Unknown state '{state}' for yum module"}
+
+    # One rpm query for all packages (and one check-update for latest)
+    installed, updatable, error_result = _probe_packages(
+        host, user, password, packages, executor, state == "latest"
+    )
+    if error_result:
+        return error_result
+
     commands = []
-    
-    # Update cache if requested
-    if update_cache:
-        commands.append("yum makecache")
-    
+    changed_packages = []
+
     # Handle different states
     if state == "present":
-        pkg_list = " ".join(packages)
-        commands.append(f"yum install -y {pkg_list}")
+        changed_packages = [pkg for pkg in packages if pkg not in installed]
+        if changed_packages:
+            commands.append(f"yum install -y {' '.join(changed_packages)}")
     elif state == "absent":
-        pkg_list = " ".join(packages)
-        commands.append(f"yum remove -y {pkg_list}")
+        changed_packages = [pkg for pkg in packages if pkg in installed]
+        if changed_packages:
+            commands.append(f"yum remove -y {' '.join(changed_packages)}")
     elif state == "latest":
-        pkg_list = " ".join(packages)
-        commands.append(f"yum update -y {pkg_list}")
-    else:
-        return {"host": host, "output": "", "error": f"Unknown state '{state}' for yum module"}
-    
+        missing = [pkg for pkg in packages if pkg not in installed]
+        outdated = [pkg for pkg in packages if pkg in installed and pkg in updatable]
+        changed_packages = missing + outdated
+        if missing:
+            commands.append(f"yum install -y {' '.join(missing)}")
+        if outdated:
+            commands.append(f"yum update -y {' '.join(outdated)}")
+
+    # Nothing to do: skip yum entirely, including its metadata loading
+    if not commands:
+        return {
+            "host": host,
+            "output": f"All packages already in desired state ({state})",
+            "error": "",
+            "changed": False,
+            "changed_packages": []
+        }
+
+    # Update cache if requested (only worth paying for when yum runs anyway)
+    if update_cache:
+        commands.insert(0, "yum makecache")
+
     if become:
         commands = [sudo_wrap(cmd) for cmd in commands]
 
     full_command = " && ".join(commands)
-    
-    return executor.run_command(host, user, password, full_command)
+
+    result = executor.run_command(host, user, password, full_command)
+    result["changed"] = True
+    result["changed_packages"] = changed_packages
+    return result
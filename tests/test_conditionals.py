@@ -0,0 +1,68 @@
+import unittest
+
+from core.conditionals import ConditionError, evaluate_condition, tokenize
+
+VARIABLES = {
+    "version": "1.2.3",
+    "ip": "10.0.0.1",
+    "path": "/etc/hosts",
+    "os": "Ubuntu 22.04",
+    "packages": ["nginx", "curl"],
+}
+
+def lookup(name):
+    return (name in VARIABLES, VARIABLES.get(name))
+
+def check(condition):
+    return evaluate_condition(condition, lookup)
+
+class TokenizeTest(unittest.TestCase):
+    def test_escaped_quotes_and_backslashes(self):
+        self.assertEqual(tokenize(r'"say \"hi\"" "a\\b" ' + r"'it\'s'"),
+                         [("string", 'say "hi"'), ("string", "a\\b"), ("string", "it's")])
+
+    def test_non_ascii_strings_are_kept(self):
+        self.assertEqual(tokenize('"café ünïcode 日本"'), [("string", "café ünïcode 日本")])
+
+    def test_other_escapes_are_left_alone(self):
+        self.assertEqual(tokenize(r'"C:\new\table"'), [("string", r"C:\new\table")])
+
+class LegacyComparisonTest(unittest.TestCase):
+    def test_unquoted_version(self):
+        self.assertTrue(check("{{ version }} == 1.2.3"))
+        self.assertFalse(check("{{ version }} == 1.2.4"))
+
+    def test_unquoted_ip(self):
+        self.assertTrue(check("ip == 10.0.0.1"))
+        self.assertTrue(check("ip != 10.0.0.2"))
+
+    def test_unquoted_path(self):
+        self.assertTrue(check("path == /etc/hosts"))
+        self.assertFalse(check("path == /etc/passwd"))
+
+    def test_unquoted_value_with_spaces(self):
+        self.assertTrue(check("os == Ubuntu 22.04"))
+        self.assertFalse(check("os == Ubuntu 20.04"))
+
+    def test_unquoted_membership(self):
+        self.assertTrue(check("hosts in /etc/hosts"))
+        self.assertTrue(check("passwd not in /etc/hosts"))
+
+    def test_quoted_right_side_is_stripped(self):
+        self.assertTrue(check("os == 'Ubuntu 22.04'"))
+        self.assertTrue(check("ip == \"10.0.0.1\""))
+
+    def test_parsable_conditions_are_unchanged(self):
+        self.assertTrue(check("'nginx' in packages and version is defined"))
+        self.assertFalse(check("missing is defined"))
+
+    def test_unparsable_left_side_still_fails(self):
+        with self.assertRaises(ConditionError):
+            check("/etc/hosts == path")
+
+    def test_unparsable_without_comparison_still_fails(self):
+        with self.assertRaises(ConditionError):
+            check("version @ 1")
+
+if __name__ == "__main__":
+    unittest.main()
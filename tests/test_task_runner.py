@@ -0,0 +1,84 @@
+import contextlib
+import io
+import time
+import unittest
+from unittest import mock
+
+from core import executor, task_runner
+
+HOSTS = {"web": [{"ip": ip, "username": "u", "password": "p"} for ip in ("10.0.0.1", "10.0.0.2", "10.0.0.3")]}
+
+def fake_run_command(host, user, password, command, bounded=True, captures=None):
+    # `fail-on <ip>` exits non-zero on that host only
+    rc = 1 if command == f"fail-on {host}" else 0
+    return executor.CommandResult(host, output=f"{host}: {command}", rc=rc)
+
+class SerialBatchTest(unittest.TestCase):
+    def run_playbook(self, playbook):
+        commands = []
+
+        def run_command(host, user, password, command, bounded=True, captures=None):
+            commands.append((host, command))
+            return fake_run_command(host, user, password, command, bounded, captures)
+
+        with mock.patch.object(executor, "run_command", run_command), \
+                mock.patch.object(executor, "warm_up", return_value=None), \
+                contextlib.redirect_stdout(io.StringIO()) as output:
+            task_runner.run_playbook(HOSTS, playbook)
+        return commands, output.getvalue()
+
+    def test_host_failed_in_earlier_play_does_not_abort_serial_play(self):
+        commands, output = self.run_playbook([
+            {"name": "first", "hosts": "web", "tasks": [{"name": "break one", "shell": "fail-on 10.0.0.1"}]},
+            {"name": "second", "hosts": "web", "serial": 1, "tasks": [{"name": "deploy", "shell": "deploy"}]},
+        ])
+        self.assertNotIn("ABORTING", output)
+        self.assertEqual(sorted(host for host, command in commands if command == "deploy"),
+                         ["10.0.0.2", "10.0.0.3"])
+
+    def test_earlier_failures_do_not_count_towards_max_fail_percentage(self):
+        commands, output = self.run_playbook([
+            {"name": "first", "hosts": "web", "tasks": [{"name": "break one", "shell": "fail-on 10.0.0.1"}]},
+            {"name": "second", "hosts": "web", "max_fail_percentage": 40,
+             "tasks": [{"name": "deploy", "shell": "fail-on 10.0.0.2"}, {"name": "after", "shell": "after"}]},
+        ])
+        # One failure out of the two hosts still running is 50%, over the limit
+        self.assertIn("ABORTING: 1/2 hosts failed", output)
+
+    def test_batch_failing_in_this_play_aborts(self):
+        commands, output = self.run_playbook([
+            {"name": "only", "hosts": "web", "serial": 1, "tasks": [{"name": "deploy", "shell": "fail-on 10.0.0.1"}]},
+        ])
+        self.assertIn("ABORTING: 1/1 hosts failed in batch 1", output)
+        self.assertEqual([host for host, _ in commands], ["10.0.0.1"])
+
+class FreeStrategyTest(unittest.TestCase):
+    def test_deferred_wait_for_gives_its_fork_back(self):
+        # Port 1 is closed, so each host's check returns right after its 1s delay
+        playbook = [{"name": "free", "hosts": "web", "strategy": "free", "forks": 1, "tasks": [
+            {"name": "wait", "wait_for": {"host": "127.0.0.1", "port": 1, "state": "stopped", "delay": 1}},
+            {"name": "after", "shell": "after"},
+        ]}]
+        for engine in ("thread", "async"):
+            ran_after = []
+
+            def run_command(host, user, password, command, bounded=True, captures=None):
+                ran_after.append(host)
+                return fake_run_command(host, user, password, command, bounded, captures)
+
+            with self.subTest(engine=engine), mock.patch.object(executor, "run_command", run_command), \
+                    mock.patch.object(task_runner.TaskTimings, "record") as record, \
+                    contextlib.redirect_stdout(io.StringIO()) as output:
+                started = time.monotonic()
+                task_runner.run_playbook(HOSTS, playbook, engine=engine)
+                elapsed = time.monotonic() - started
+            # Three hosts waiting one at a time would take 3s
+            self.assertLess(elapsed, 2.5)
+            self.assertEqual(sorted(ran_after), ["10.0.0.1", "10.0.0.2", "10.0.0.3"])
+            # Execution time is clocked until the deferred wait completes
+            wait_times = [call.args[2] for call in record.call_args_list if call.args[0] == "wait"]
+            self.assertEqual(len(wait_times), 3)
+            self.assertTrue(all(elapsed >= 0.9 for elapsed in wait_times))
+
+if __name__ == "__main__":
+    unittest.main()
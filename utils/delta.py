@@ -0,0 +1,240 @@
+"""
+rsync-style delta encoding used by the copy module's `delta: true` mode.
+
+The remote side reports a weak and a strong (md5) checksum for every block of
+the file it already has. The controller slides a window over the new file,
+emits "copy block N" for every block the remote already holds and literal
+bytes for everything else. The remote side then rebuilds the file from its old
+copy plus the delta.
+
+The weak checksum is the sum of the block's running byte sums, i.e. every byte
+weighted by its distance from the end of the block. Unlike adler32 it needs no
+modulus, so the checksums of every window in a stretch can be computed at once
+with one big-integer multiplication instead of rolling a window byte by byte
+in Python.
+"""
+import hashlib
+import math
+import mmap
+import os
+import shlex
+import struct
+from array import array
+from itertools import accumulate, compress, count
+
+MIN_BLOCK_SIZE = 2048
+MAX_BLOCK_SIZE = 128 * 1024
+
+# Delta records: b"C" + start block + block count, or b"D" + length + literal bytes
+COPY_RECORD = struct.Struct(">cII")
+DATA_HEADER = struct.Struct(">cI")
+MAX_LITERAL = 1024 * 1024
+
+# Give up on the delta once its literal bytes pass this share of the file; a full upload is as cheap
+DEFAULT_MAX_LITERAL_RATIO = 0.5
+# Most window offsets checksummed per big-integer pass
+SCAN_CHUNK = 256 * 1024
+# Each window checksum gets a 64-bit field; 255 * MAX_BLOCK_SIZE**2 / 2 fits with room to spare
+FIELD_BITS = 64
+
+SIGNATURE_SCRIPT = r'''
+import hashlib, sys
+from itertools import accumulate
+path, block_size = sys.argv[1], int(sys.argv[2])
+try:
+    f = open(path, "rb")
+except FileNotFoundError:
+    print("MISSING")
+    sys.exit(0)
+with f:
+    out = []
+    while True:
+        block = f.read(block_size)
+        if not block:
+            break
+        out.append("%d %s" % (sum(accumulate(block)), hashlib.md5(block).hexdigest()))
+print("\n".join(out))
+'''
+
+PATCH_SCRIPT = r'''
+import hashlib, struct, sys
+basis_path, delta_path, out_path, block_size, expected = sys.argv[1:6]
+block_size = int(block_size)
+digest = hashlib.sha256()
+with open(basis_path, "rb") as basis, open(delta_path, "rb") as delta, open(out_path, "wb") as out:
+    while True:
+        kind = delta.read(1)
+        if not kind:
+            break
+        if kind == b"C":
+            start, count = struct.unpack(">II", delta.read(8))
+            basis.seek(start * block_size)
+            remaining = count * block_size
+            while remaining:
+                chunk = basis.read(min(remaining, 1024 * 1024))
+                if not chunk:
+                    break
+                out.write(chunk)
+                digest.update(chunk)
+                remaining -= len(chunk)
+        else:
+            (length,) = struct.unpack(">I", delta.read(4))
+            chunk = delta.read(length)
+            out.write(chunk)
+            digest.update(chunk)
+if digest.hexdigest() != expected:
+    print("CHECKSUM_MISMATCH")
+    sys.exit(1)
+print("PATCHED")
+'''
+
+def block_size_for(size):
+    """rsync's heuristic: roughly sqrt(file size), clamped to a sane range"""
+    return max(MIN_BLOCK_SIZE, min(MAX_BLOCK_SIZE, 1 << max(0, math.ceil(math.log2(max(1, math.isqrt(size)))))))
+
+def signature_command(path, block_size, python="python3"):
+    return f"{python} -c {shlex.quote(SIGNATURE_SCRIPT)} {shlex.quote(path)} {block_size}"
+
+def patch_command(basis_path, delta_path, out_path, block_size, expected_sha256, python="python3"):
+    return (f"{python} -c {shlex.quote(PATCH_SCRIPT)} {shlex.quote(basis_path)} {shlex.quote(delta_path)} "
+            f"{shlex.quote(out_path)} {block_size} {expected_sha256}")
+
+def parse_signatures(output):
+    """Parse signature script output into {weak: {strong: block_index}}, or None if the file is missing"""
+    if output.strip() == "MISSING":
+        return None
+    signatures = {}
+    for index, line in enumerate(line for line in output.splitlines() if line.strip()):
+        weak, strong = line.split()
+        # Keep the first block for duplicate content
+        signatures.setdefault(int(weak), {}).setdefault(strong, index)
+    return signatures
+
+def write_delta(src, signatures, block_size, out, max_literal_ratio=None):
+    """
+    Write the delta for local file `src` against the remote `signatures` to the
+    binary file object `out`. Returns the number of literal bytes emitted, or
+    None once they pass max_literal_ratio of the file (send it whole instead).
+    """
+    with open(src, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return 0
+        max_literal = size * max_literal_ratio if max_literal_ratio is not None else None
+        # Map the file instead of reading it so large artifacts stay out of the heap
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data, memoryview(data) as view:
+            return _write_delta(view, signatures, block_size, out, max_literal)
+
+def weak_checksum(block):
+    """Sum of the running byte sums of block (the SIGNATURE_SCRIPT weak checksum)"""
+    return sum(accumulate(block))
+
+def _window_checksums(data, start, stop, block_size):
+    """
+    Weak checksums of the windows starting at every offset in [start, stop), as an
+    array. The bytes become 64-bit fields of one integer, which is multiplied by the
+    weights 1..block_size (written as (1 - (n+1)z^n + n z^(n+1)) / (1 - z)^2) so every
+    field of the product is one window's checksum. The per-byte work happens in C.
+    """
+    chunk = data[start:stop + block_size - 1]
+    fields = bytearray(len(chunk) * FIELD_BITS // 8)
+    fields[::FIELD_BITS // 8] = chunk
+    value = int.from_bytes(fields, "little")
+    shifted = value << (FIELD_BITS * block_size)
+    product = value - (block_size + 1) * shifted + block_size * (shifted << FIELD_BITS)
+    product //= ((1 << FIELD_BITS) - 1) ** 2
+    width = FIELD_BITS // 8
+    raw = product.to_bytes((len(chunk) + block_size + 1) * width, "little")
+    checksums = array("Q")
+    checksums.frombytes(raw[(block_size - 1) * width:(block_size - 1 + stop - start) * width])
+    return checksums
+
+def _write_delta(data, signatures, block_size, out, max_literal=None):
+    literal_bytes = 0
+    literal_start = 0
+    pending_copy = None  # [start_block, count]
+
+    def flush_literal(end):
+        nonlocal literal_bytes, literal_start
+        position = literal_start
+        while position < end:
+            chunk = data[position:min(end, position + MAX_LITERAL)]
+            out.write(DATA_HEADER.pack(b"D", len(chunk)))
+            out.write(chunk)
+            position += len(chunk)
+        literal_bytes += end - literal_start
+        literal_start = end
+
+    def flush_copy():
+        nonlocal pending_copy
+        if pending_copy:
+            out.write(COPY_RECORD.pack(b"C", pending_copy[0], pending_copy[1]))
+            pending_copy = None
+
+    def match_block(offset, length, weak):
+        candidates = signatures.get(weak)
+        if not candidates:
+            return None
+        return candidates.get(hashlib.md5(data[offset:offset + length]).hexdigest())
+
+    def add_copy(block_index):
+        nonlocal pending_copy
+        if pending_copy and pending_copy[0] + pending_copy[1] == block_index:
+            pending_copy[1] += 1
+        else:
+            flush_copy()
+            pending_copy = [block_index, 1]
+
+    # Aligned blocks are looked up by md5 alone: cheaper than their weak checksum and just as exact
+    strong_blocks = {}
+    for blocks in signatures.values():
+        for strong, index in blocks.items():
+            strong_blocks.setdefault(strong, index)
+
+    size = len(data)
+    last_window = size - block_size
+    offset = 0
+    # Screened stretches start short (an edit is often followed by a match) and double up to SCAN_CHUNK
+    scan = block_size
+    while offset <= last_window:
+        if max_literal is not None and literal_bytes + offset - literal_start > max_literal:
+            return None
+        # Unchanged stretches match block after block; only check every offset after a miss
+        block_index = strong_blocks.get(hashlib.md5(data[offset:offset + block_size]).hexdigest())
+        if block_index is None:
+            start, stop = offset + 1, min(offset + scan, last_window + 1)
+            checksums = _window_checksums(data, start, stop, block_size) if start < stop else ()
+            for candidate in compress(count(start), map(signatures.__contains__, checksums)):
+                block_index = match_block(candidate, block_size, checksums[candidate - start])
+                if block_index is not None:
+                    offset = candidate
+                    break
+            else:
+                offset = stop
+                scan = min(scan * 2, SCAN_CHUNK)
+                continue
+            scan = block_size
+        if literal_start < offset:
+            # Earlier copies must be written before the literal run they precede
+            flush_copy()
+            flush_literal(offset)
+        add_copy(block_index)
+        offset = literal_start = offset + block_size
+
+    # The short tail can still match the remote's (short) last block
+    offset = max(offset, size - block_size + 1, 0)
+    if offset < size:
+        tail_length = size - offset
+        block_index = match_block(offset, tail_length, weak_checksum(data[offset:size]))
+        if block_index is not None:
+            if literal_start < offset:
+                flush_copy()
+                flush_literal(offset)
+            add_copy(block_index)
+            literal_start = size
+
+    if max_literal is not None and literal_bytes + size - literal_start > max_literal:
+        return None
+    flush_copy()
+    flush_literal(size)
+    return literal_bytes
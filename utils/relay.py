@@ -0,0 +1,93 @@
+"""
+Peer-to-peer relay used by the copy module's `distribute: true` mode.
+
+A host that already holds the file serves it once on a TCP port, bound to the
+address its peers reach it on; the receiving host connects to it, writes the
+bytes to a temp path and prints their sha256 so the controller can verify the
+copy before moving it into place.
+
+Both sides read a random per-transfer token from stdin (so it never shows up in
+`ps`). The receiver sends it first and the server only serves a connection that
+presents it; anything else is dropped and the server keeps waiting.
+"""
+import secrets
+import shlex
+
+SERVE_SCRIPT = r'''
+import hmac, socket, sys, time
+path, address, port, timeout = sys.argv[1], sys.argv[2], int(sys.argv[3]), float(sys.argv[4])
+token = sys.stdin.readline().strip().encode()
+if not token:
+    print("RELAY_NO_TOKEN")
+    sys.exit(1)
+try:
+    server = socket.create_server((address, port), family=socket.getaddrinfo(address, port)[0][0])
+except OSError as e:
+    print("RELAY_BIND_FAILED %s" % e)
+    sys.exit(1)
+deadline = time.time() + timeout
+while True:
+    server.settimeout(max(0.0, deadline - time.time()))
+    try:
+        conn, _ = server.accept()
+    except (socket.timeout, BlockingIOError):
+        print("RELAY_TIMEOUT")
+        sys.exit(1)
+    with conn:
+        conn.settimeout(5)
+        presented = b""
+        try:
+            while len(presented) < len(token):
+                chunk = conn.recv(len(token) - len(presented))
+                if not chunk:
+                    break
+                presented += chunk
+        except OSError:
+            continue
+        if not hmac.compare_digest(presented, token):
+            continue
+        conn.settimeout(None)
+        with open(path, "rb") as f:
+            conn.sendfile(f)
+    print("SERVED")
+    break
+'''
+
+RECEIVE_SCRIPT = r'''
+import hashlib, socket, sys, time
+peer, port, out_path, timeout = sys.argv[1], int(sys.argv[2]), sys.argv[3], float(sys.argv[4])
+token = sys.stdin.readline().strip().encode()
+deadline = time.time() + timeout
+while True:
+    try:
+        conn = socket.create_connection((peer, port), timeout=timeout)
+        break
+    except OSError:
+        # The peer's listener may not be up yet
+        if time.time() > deadline:
+            print("RELAY_UNREACHABLE")
+            sys.exit(1)
+        time.sleep(0.2)
+conn.sendall(token)
+digest = hashlib.sha256()
+with conn, open(out_path, "wb") as out:
+    while True:
+        chunk = conn.recv(1024 * 1024)
+        if not chunk:
+            break
+        out.write(chunk)
+        digest.update(chunk)
+print(digest.hexdigest())
+'''
+
+def new_token():
+    """Random secret for one transfer; feed it to both commands on stdin"""
+    return secrets.token_hex(16)
+
+def serve_command(path, address, port, timeout, python="python3"):
+    return (f"{python} -c {shlex.quote(SERVE_SCRIPT)} {shlex.quote(path)} {shlex.quote(address)} "
+            f"{int(port)} {timeout}")
+
+def receive_command(peer, port, out_path, timeout, python="python3"):
+    return (f"{python} -c {shlex.quote(RECEIVE_SCRIPT)} {shlex.quote(peer)} {int(port)} "
+            f"{shlex.quote(out_path)} {timeout}")